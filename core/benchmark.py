@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+import glob
+import inspect
+import json
+import os
+import platform
+import queue
+import resource
+import traceback
+from time import time
+
+import pandas as pd
+import torch
+
+import core.model as arch
+from core.config import Config
+from core.model.abstract_model import AbstractModel
+from core.model.finetuning import finetuning_model
+from core.model.meta import meta_model
+from core.model.metric import metric_model
+from core.probe import _measure_cpu_peak, synthetic_batch, synthetic_episodes
+from core.utils import ModelType, StageProfiler, get_instance, init_seed
+
+ABSTRACT_MODELS = [
+    finetuning_model.FinetuningModel,
+    meta_model.MetaModel,
+    metric_model.MetricModel,
+]
+
+
+def get_classifier_names():
+    """
+    Get the names of all classifiers in core/model/{meta,metric,finetuning}.
+    """
+    names = []
+    for module in [arch.meta, arch.metric, arch.finetuning]:
+        for name, obj in inspect.getmembers(module, inspect.isclass):
+            if issubclass(obj, AbstractModel) and obj not in ABSTRACT_MODELS:
+                names.append(name)
+
+    return sorted(set(names))
+
+
+def get_backbone_configs(backbone_dir="./config/backbones"):
+    """
+    Get the backbone settings of config/backbones.
+
+    Returns:
+        dict: The `backbone` setting of each file, by file name.
+    """
+    backbones = {}
+    for path in sorted(glob.glob(os.path.join(backbone_dir, "*.yaml"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        backbones[name] = Config._load_config_files(path)["backbone"]
+
+    return backbones
+
+
+def get_reference_configs(config_dirs=("./config", "./reproduce")):
+    """
+    Collect the config files that train each classifier, to take its settings from.
+
+    Returns:
+        dict: The config files of each classifier name, with the backbone name they use.
+    """
+    references = {}
+    for config_dir in config_dirs:
+        paths = sorted(
+            set(glob.glob(os.path.join(config_dir, "**", "*.yaml"), recursive=True))
+        )
+        for path in paths:
+            if os.sep + "headers" + os.sep in path or os.sep + "backbones" + os.sep in path:
+                continue
+            try:
+                config = Config._load_config_files(path)
+            except Exception:
+                continue
+            if "classifier" not in config:
+                continue
+            backbone = config.get("backbone") or {}
+            references.setdefault(config["classifier"]["name"], []).append(
+                (path, backbone.get("name"))
+            )
+
+    return references
+
+
+def get_benchmark_config(
+    classifier, backbone, backbone_config, shot_num, references, overrides
+):
+    """
+    Build the config of one benchmark run, from a config training the classifier with this backbone, or
+    with another backbone which is replaced by `backbone_config`.
+
+    Returns:
+        tuple: A tuple of (config, reference file, whether the backbone was replaced).
+    """
+    # the configs of config/classifiers only set the classifier, prefer complete training configs
+    candidates = sorted(
+        references.get(classifier, []), key=lambda candidate: candidate[1] is None
+    )
+    exact = [path for path, name in candidates if name == backbone]
+    if exact:
+        reference, adapted = exact[0], False
+    elif candidates:
+        reference, adapted = candidates[0][0], True
+    else:
+        reference, adapted = None, True
+
+    variable_dict = dict(
+        overrides,
+        shot_num=shot_num,
+        test_shot=shot_num,
+    )
+    config = Config(reference, variable_dict).get_config_dict()
+    if reference is None:
+        config["classifier"] = {"name": classifier, "kwargs": None}
+    if adapted:
+        # replace the whole setting, the config merge would mix the kwargs of both backbones
+        config["backbone"] = backbone_config
+
+    return config, reference, adapted
+
+
+def benchmark_model(config, device, episodes):
+    """
+    Time the train and eval steps of a model on synthetic data.
+
+    A train step is forward, backward and optimizer step on `episode_size` episodes (a batch of
+    `batch_size` images for the finetuning methods), an eval step is the forward of `episode_size`
+    episodes in the test setting. One step of each is run first as a warmup.
+
+    Args:
+        config (dict): Parsed config file.
+        device (torch.device): The device to run on.
+        episodes (int): The number of train and of eval episodes (train batches for finetuning methods).
+
+    Returns:
+        dict: episodes/sec, images/sec, time per step, peak memory and mean time per stage of "train"
+            and "eval".
+    """
+    init_seed(config["seed"], False)
+    emb_func = get_instance(arch, "backbone", config)
+    model_kwargs = {
+        "way_num": config["way_num"],
+        "shot_num": config["shot_num"] * config["augment_times"],
+        "query_num": config["query_num"],
+        "test_way": config["test_way"],
+        "test_shot": config["test_shot"] * config["augment_times"],
+        "test_query": config["test_query"],
+        "emb_func": emb_func,
+        "device": device,
+    }
+    model = get_instance(arch, "classifier", config, **model_kwargs).to(device)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = (
+        get_instance(torch.optim, "optimizer", config, params=params) if params else None
+    )
+    profiler = StageProfiler(model, device, time_stages=True)
+    is_finetuning = model.model_type == ModelType.FINETUNING
+    episode_size = config["episode_size"]
+
+    def train_step(batch):
+        if optimizer is not None:
+            optimizer.zero_grad()
+        output, acc, loss = model(batch)
+        with profiler.stage("backward"):
+            loss.backward()
+        if optimizer is not None:
+            with profiler.stage("optimizer_step"):
+                optimizer.step()
+
+    def eval_step(batch):
+        with torch.set_grad_enabled(model.model_type != ModelType.METRIC):
+            model(batch)
+
+    results = {}
+    model.train()
+    if is_finetuning:
+        batch = synthetic_batch(config, config["batch_size"], device)
+        steps, images = episodes, config["batch_size"]
+    else:
+        batch = synthetic_episodes(model, config, episode_size, device)
+        steps = max(1, episodes // episode_size)
+        images = batch[0].size(0)
+    results["train"] = _time_steps(
+        train_step, batch, steps, images, profiler, device, "train"
+    )
+    if not is_finetuning:
+        results["train"]["episodes_per_sec"] = (
+            steps * episode_size / results["train"]["time"]
+        )
+
+    model.eval()
+    model.reverse_setting_info()
+    batch = synthetic_episodes(model, config, episode_size, device)
+    steps = max(1, episodes // episode_size)
+    results["eval"] = _time_steps(
+        eval_step, batch, steps, batch[0].size(0), profiler, device, "test"
+    )
+    results["eval"]["episodes_per_sec"] = steps * episode_size / results["eval"]["time"]
+    model.reverse_setting_info()
+    profiler.remove()
+
+    return results
+
+
+def _time_steps(step, batch, steps, images, profiler, device, mode):
+    """
+    Run a warmup step then time `steps` steps on the same batch, with the stages filed under `mode`.
+
+    On CPU the peak memory is the RSS sampled during the warmup step, which leaves the timed steps
+    without the sampling thread.
+    """
+    peak_memory = None
+    if device.type != "cuda" and os.path.exists("/proc/self/statm"):
+        peak_memory = _measure_cpu_peak(step, batch)
+    else:
+        step(batch)
+    profiler.set_mode(mode)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    begin = time()
+    for _ in range(steps):
+        step(batch)
+        profiler.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time() - begin
+
+    return {
+        "time": elapsed,
+        "step_time": elapsed / steps,
+        "images_per_sec": steps * images / elapsed,
+        "peak_memory": _get_peak_memory(device) if peak_memory is None else peak_memory,
+        "stages": profiler.means(),
+    }
+
+
+def _get_peak_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    # without /proc, the peak RSS of the process, each run has its own process when isolated
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _benchmark_worker(config, device, episodes, result_queue):
+    try:
+        result_queue.put(benchmark_model(config, torch.device(device), episodes))
+    except Exception:
+        result_queue.put({"error": traceback.format_exc()})
+
+
+def _run_isolated(ctx, config, device, episodes):
+    """
+    Run `benchmark_model` in a new process, an error result if it dies.
+    """
+    result_queue = ctx.Queue()
+    process = ctx.Process(
+        target=_benchmark_worker, args=(config, device, episodes, result_queue)
+    )
+    process.start()
+    # get the result before joining, the process only exits once it is flushed
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                result = {"error": "exit code {}".format(process.exitcode)}
+                break
+    process.join()
+
+    return result
+
+
+def run_benchmark(
+    classifiers=None,
+    backbones=None,
+    shots=(1, 5),
+    episodes=10,
+    device="cpu",
+    variable_dict=None,
+    isolate=True,
+    output=None,
+    baseline=None,
+    tolerance=0.1,
+):
+    """
+    Benchmark the throughput of classifier x backbone x shot on synthetic data, no dataset needed.
+
+    The settings of a classifier come from a config in config/ or reproduce/ training it, preferably with
+    the same backbone, otherwise its backbone is replaced by the one of config/backbones. Each run is
+    5-way with 15 queries unless `variable_dict` says otherwise.
+
+    Args:
+        classifiers (list, optional): Classifier names, all in core/model/{meta,metric,finetuning} if None.
+        backbones (list, optional): Backbone file names of config/backbones, all if None.
+        shots (tuple, optional): The shot numbers. Defaults to (1, 5).
+        episodes (int, optional): The number of train and of eval episodes of each run. Defaults to 10.
+        device (str, optional): The device to run on. Defaults to "cpu".
+        variable_dict (dict, optional): Settings overriding those of the configs. Defaults to None.
+        isolate (bool, optional): Run each benchmark in its own process, so that a crash does not stop the
+            benchmark. Defaults to True.
+        output (str, optional): Write the results to this JSON file. Defaults to None.
+        baseline (str, optional): A JSON file of a previous benchmark to compare with. Defaults to None.
+        tolerance (float, optional): Report a regression when the images/sec drop by more than this
+            fraction of the baseline. Defaults to 0.1.
+
+    Returns:
+        dict: The environment, the results of each "classifier-backbone-5w{shot}s" run and the comparison
+            with the baseline.
+    """
+    classifiers = classifiers if classifiers is not None else get_classifier_names()
+    backbone_configs = get_backbone_configs()
+    backbones = backbones if backbones is not None else list(backbone_configs.keys())
+    references = get_reference_configs()
+    overrides = {
+        "way_num": 5,
+        "query_num": 15,
+        "test_way": 5,
+        "test_query": 15,
+        "episode_size": 1,
+        "batch_size": 32,
+        "augment_times": 1,
+        "n_gpu": 1,
+        "device_ids": "" if device == "cpu" else str(torch.device(device).index or 0),
+        "use_cpu": device == "cpu",
+        "deterministic": False,
+    }
+    overrides.update(variable_dict or {})
+    ctx = torch.multiprocessing.get_context("spawn")
+
+    results = {}
+    for classifier in classifiers:
+        for backbone in backbones:
+            for shot_num in shots:
+                key = "{}-{}-{}w{}s".format(
+                    classifier, backbone, overrides["way_num"], shot_num
+                )
+                config, reference, adapted = get_benchmark_config(
+                    classifier,
+                    backbone_configs[backbone]["name"],
+                    backbone_configs[backbone],
+                    shot_num,
+                    references,
+                    overrides,
+                )
+                if isolate:
+                    result = _run_isolated(ctx, config, device, episodes)
+                else:
+                    try:
+                        result = benchmark_model(config, torch.device(device), episodes)
+                    except Exception:
+                        result = {"error": traceback.format_exc()}
+                result.update(reference=reference, adapted_backbone=adapted)
+                results[key] = result
+                print(
+                    "{}: {}".format(
+                        key,
+                        "failed, " + result["error"].strip().split("\n")[-1]
+                        if "error" in result
+                        else "train {:.1f} img/s, eval {:.1f} img/s".format(
+                            result["train"]["images_per_sec"],
+                            result["eval"]["images_per_sec"],
+                        ),
+                    )
+                )
+
+    report = {
+        "environment": {
+            "device": device,
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "gpu": torch.cuda.get_device_name(torch.device(device))
+            if device != "cpu"
+            else None,
+            "episodes": episodes,
+            "overrides": overrides,
+        },
+        "results": results,
+    }
+    print(format_results(results))
+    if baseline is not None:
+        with open(baseline, "r", encoding="utf-8") as fin:
+            report["comparison"] = compare_benchmark(
+                results, json.load(fin)["results"], tolerance
+            )
+    if output is not None:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w", encoding="utf-8") as fout:
+            json.dump(report, fout, indent=2)
+
+    return report
+
+
+def format_results(results):
+    """
+    Format the results of a benchmark as a table.
+    """
+    rows = {}
+    for key, result in results.items():
+        if "error" in result:
+            rows[key] = {"status": "failed"}
+            continue
+        rows[key] = {"status": "ok"}
+        for stage in ["train", "eval"]:
+            rows[key].update(
+                {
+                    "{} ep/s".format(stage): result[stage].get("episodes_per_sec"),
+                    "{} img/s".format(stage): result[stage]["images_per_sec"],
+                    "{} peak MB".format(stage): result[stage]["peak_memory"] / 1024**2,
+                }
+            )
+
+    return (
+        pd.DataFrame.from_dict(rows, orient="index")
+        .to_string(float_format="{:.1f}".format, na_rep="-")
+    )
+
+
+def compare_benchmark(results, baseline, tolerance=0.1):
+    """
+    Compare the images/sec of the runs in both the results and the baseline.
+
+    Args:
+        results (dict): The results of `run_benchmark`.
+        baseline (dict): The results of a previous benchmark.
+        tolerance (float, optional): Report a regression when the images/sec drop by more than this
+            fraction of the baseline. Defaults to 0.1.
+
+    Returns:
+        dict: The train and eval speed ratios (new / baseline) of each run, and its regressed stages.
+    """
+    comparison = {}
+    for key, result in results.items():
+        if key not in baseline or "error" in result or "error" in baseline[key]:
+            continue
+        ratios = {
+            stage: result[stage]["images_per_sec"]
+            / baseline[key][stage]["images_per_sec"]
+            for stage in ["train", "eval"]
+        }
+        comparison[key] = {
+            "ratio": ratios,
+            "regressions": [
+                stage for stage, ratio in ratios.items() if ratio < 1 - tolerance
+            ],
+        }
+
+    table = pd.DataFrame.from_dict(
+        {
+            key: {
+                "train x": value["ratio"]["train"],
+                "eval x": value["ratio"]["eval"],
+                "regression": " ".join(value["regressions"]) or "-",
+            }
+            for key, value in comparison.items()
+        },
+        orient="index",
+    )
+    print("compared with the baseline (new / baseline images/sec):")
+    print(table.to_string(float_format="{:.2f}".format))
+
+    return comparison
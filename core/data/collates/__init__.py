@@ -24,7 +24,11 @@ def get_collate_function(config, trfms, mode, model_type):
     ), "model_type should not be ModelType.ABSTRACT"
 
     if mode == "train" and model_type == ModelType.FINETUNING:
-        collate_function = GeneralCollateFunction(trfms, config["augment_times"])
+        collate_function = GeneralCollateFunction(
+            trfms,
+            config["augment_times"],
+            config["teacher_cache_seeds"] if use_teacher_cache(config, mode, model_type) else None,
+        )
     else:
         collate_function = FewShotAugCollateFunction(
             trfms,
@@ -36,3 +40,23 @@ def get_collate_function(config, trfms, mode, model_type):
         )
 
     return collate_function
+
+
+def use_teacher_cache(config, mode, model_type):
+    """Whether the batches carry the keys of a teacher-logit cache: for the finetuning-train of a single dataloader
+    with `teacher_cache` set.
+
+    Args:
+        config (dict): A LFS setting dict.
+        mode (str): Model mode in ['train', 'test', 'val']
+        model_type (ModelType): An ModelType enum value of model.
+
+    Returns:
+        bool: Whether the teacher-logit cache is used.
+    """
+    return (
+        config["teacher_cache"] is not None
+        and mode == "train"
+        and model_type == ModelType.FINETUNING
+        and config["dataloader_num"] == 1
+    )
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import itertools
+import random
 from collections import Iterable
 
+import numpy as np
 import torch
 
 
@@ -11,16 +13,20 @@ class GeneralCollateFunction(object):
     For finetuning-train.
     """
 
-    def __init__(self, trfms, times):
+    def __init__(self, trfms, times, aug_seeds=None):
         """Initialize a `GeneralCollateFunction`.
 
         Args:
             trfms (list): A list of torchvision transforms.
             times (int): Specify the augment times. (0 or 1 for not to augment)
+            aug_seeds (int, optional): With a teacher-logit cache, the dataset returns (image, label, index) and
+                each sample is augmented deterministically from one of `aug_seeds` seeds of its image, drawn at
+                random. The batch then ends with the keys `index * aug_seeds + seed` of the samples. Defaults to None.
         """
         super(GeneralCollateFunction, self).__init__()
         self.trfms = trfms
         self.times = times
+        self.aug_seeds = aug_seeds
 
     def method(self, batch):
         """Apply transforms and augmentations on a batch.
@@ -32,17 +38,32 @@ class GeneralCollateFunction(object):
             batch (list of tuple): A batch returned by dataset.
 
         Returns:
-            tuple: A tuple of (images, targets), here len(images)=len(targets).
+            tuple: A tuple of (images, targets), here len(images)=len(targets), followed by the keys of the samples
+                with `aug_seeds`.
         """
         try:
-            images, targets = zip(*batch)
+            if self.aug_seeds is None:
+                images, targets = zip(*batch)
+            else:
+                images, targets, indexes = zip(*batch)
 
             images = list(
                 itertools.chain.from_iterable(
                     [[image] * self.times for image in images]
                 )
             )
-            images = [self.trfms(image).unsqueeze(0) for image in images]
+            if self.aug_seeds is None:
+                images = [self.trfms(image).unsqueeze(0) for image in images]
+            else:
+                keys = [
+                    index * self.aug_seeds + random.randrange(self.aug_seeds)
+                    for index in indexes
+                    for _ in range(self.times)
+                ]
+                images = [
+                    _seeded_transform(self.trfms, image, key).unsqueeze(0)
+                    for image, key in zip(images, keys)
+                ]
 
             targets = list(
                 itertools.chain.from_iterable(
@@ -59,7 +80,9 @@ class GeneralCollateFunction(object):
 
             targets = torch.tensor(targets, dtype=torch.int64)
 
-            return images, targets
+            if self.aug_seeds is None:
+                return images, targets
+            return images, targets, torch.tensor(keys, dtype=torch.int64)
         except TypeError:
             raise TypeError(
                 "Error, probably because the transforms are passed to the dataset, the transforms should be "
@@ -70,6 +93,22 @@ class GeneralCollateFunction(object):
         return self.method(batch)
 
 
+def _seeded_transform(trfms, image, seed):
+    """Apply random transforms on an image with the python, numpy and torch (CPU) RNGs seeded by `seed`, then
+    restore the RNGs so the other samples keep their randomness.
+    """
+    states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.random.default_generator.manual_seed(seed)
+    try:
+        return trfms(image)
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+
 class FewShotAugCollateFunction(object):
     """`Collate_fn` for few-shot dataloader.
 
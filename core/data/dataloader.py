@@ -5,8 +5,8 @@ from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 
 from core.data.dataset import GeneralDataset
-from .collates import get_collate_function, get_augment_method,get_mean_std
-from .samplers import DistributedCategoriesSampler, get_sampler
+from .collates import get_collate_function, get_augment_method,get_mean_std, use_teacher_cache
+from .samplers import DistributedCategoriesSampler, SeekableBatchSampler, get_sampler
 from ..utils import ModelType
 
 MEAN = [120.39586422 / 255.0, 115.59361427 / 255.0, 104.54012653 / 255.0]
@@ -49,6 +49,8 @@ def get_dataloader(config, mode, model_type, distribute):
         data_root=config["data_root"],
         mode=mode,
         use_memory=config["use_memory"],
+        cache_dir=config["shared_cache"],
+        return_index=use_teacher_cache(config, mode, model_type),
     )
 
     if config["dataloader_num"] == 1 or mode in ["val", "test"]:
@@ -73,17 +75,19 @@ def get_dataloader(config, mode, model_type, distribute):
                 level="warning",
             )
 
+        # the seekable finetuning sampler batches the images itself
+        batched = few_shot or isinstance(sampler, SeekableBatchSampler)
         dataloader = MultiEpochsDataLoader(
             dataset=dataset,
-            sampler=None if few_shot else sampler,
-            batch_sampler=sampler if few_shot else None,
+            sampler=None if batched else sampler,
+            batch_sampler=sampler if batched else None,
             batch_size=1
-            if few_shot
+            if batched
             else (config["batch_size"] // data_scale),  # batch_size is default set to 1
-            shuffle=False if few_shot or distribute else True,
+            shuffle=False if batched or distribute else True,
             num_workers=workers,  # num_workers for each gpu
-            drop_last=False if few_shot else True,
-            pin_memory=True,
+            drop_last=False if batched else True,
+            pin_memory=torch.cuda.is_available() and not config["use_cpu"],
             collate_fn=collate_function,
         )
 
@@ -102,7 +106,7 @@ def get_dataloader(config, mode, model_type, distribute):
             dataset,
             batch_sampler=sampler,
             num_workers=config["n_gpu"] * 4,
-            pin_memory=True,
+            pin_memory=torch.cuda.is_available() and not config["use_cpu"],
             collate_fn=collate_function,
         )
         collate_function = get_collate_function(
@@ -121,7 +125,7 @@ def get_dataloader(config, mode, model_type, distribute):
             shuffle=True,
             num_workers=config["n_gpu"] * 4,
             drop_last=True,
-            pin_memory=True,
+            pin_memory=torch.cuda.is_available() and not config["use_cpu"],
             collate_fn=collate_function,
         )
 
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import csv
+import hashlib
 import os
 import pickle
+import shutil
 
+import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 
@@ -52,6 +55,8 @@ class GeneralDataset(Dataset):
         loader=default_loader,
         use_memory=True,
         trfms=None,
+        cache_dir=None,
+        return_index=False,
     ):
         """Initializing `GeneralDataset`.
 
@@ -61,6 +66,10 @@ class GeneralDataset(Dataset):
             loader (fn, optional): specific which loader to use(see line 10-40 in this file). Defaults to default_loader.
             use_memory (bool, optional): option to use memory cache to accelerate reading. Defaults to True.
             trfms (list, optional): A transform list (in LFS, its useless). Defaults to None.
+            cache_dir (str, optional): A directory of decoded-image memmap caches shared by concurrent runs (see
+                `build_image_cache`), replaces `use_memory` if set. Defaults to None.
+            return_index (bool, optional): Return the index of an item after its label, for the keys of a
+                teacher-logit cache. Defaults to False.
         """
         super(GeneralDataset, self).__init__()
         assert mode in [
@@ -74,8 +83,18 @@ class GeneralDataset(Dataset):
         self.loader = loader
         self.use_memory = use_memory
         self.trfms = trfms
+        self.cache_dir = cache_dir
+        self.return_index = return_index
+        self.image_cache = None
 
-        if use_memory:
+        if cache_dir is not None:
+            (
+                self.data_list,
+                self.label_list,
+                self.class_label_dict,
+            ) = self._generate_data_list()
+            self.image_cache_path = build_image_cache(data_root, mode, cache_dir, loader)
+        elif use_memory:
             cache_path = os.path.join(data_root, "{}.pth".format(mode))
             (
                 self.data_list,
@@ -159,6 +178,37 @@ class GeneralDataset(Dataset):
             pickle.dump((data_list, label_list, class_label_dict), fout)
         return data_list, label_list, class_label_dict
 
+    def _load_from_image_cache(self, idx):
+        """Read a decoded image from the shared memmap cache.
+
+        The memmaps are opened lazily, so that each dataloader worker maps the cache files itself and all
+        processes reading them share the same pages of the OS page cache.
+
+        Args:
+            idx (int): The image index.
+
+        Returns:
+            PIL.Image: The RGB image.
+        """
+        if self.image_cache is None:
+            self.image_cache = (
+                np.load(os.path.join(self.image_cache_path, "images.npy"), mmap_mode="r"),
+                np.load(os.path.join(self.image_cache_path, "index.npy")),
+            )
+        images, index = self.image_cache
+        offset, height, width = index[idx]
+        return Image.fromarray(
+            np.array(images[offset : offset + height * width * 3]).reshape(
+                height, width, 3
+            )
+        )
+
+    def __getstate__(self):
+        # do not pickle the memmaps to spawned workers, they reopen them
+        state = self.__dict__.copy()
+        state["image_cache"] = None
+        return state
+
     def __len__(self):
         return self.length
 
@@ -169,9 +219,11 @@ class GeneralDataset(Dataset):
             idx (int): The __getitem__ id.
 
         Returns:
-            tuple: A tuple of (image, label)
+            tuple: A tuple of (image, label), followed by idx with `return_index`.
         """
-        if self.use_memory:
+        if self.cache_dir is not None:
+            data = self._load_from_image_cache(idx)
+        elif self.use_memory:
             data = self.data_list[idx]
         else:
             image_name = self.data_list[idx]
@@ -182,4 +234,86 @@ class GeneralDataset(Dataset):
             data = self.trfms(data)
         label = self.label_list[idx]
 
+        if self.return_index:
+            return data, label, idx
         return data, label
+
+
+def get_image_cache_path(data_root, mode, cache_dir):
+    """Get the directory of the decoded-image cache of a split, keyed by the absolute data_root and the
+    modification time of its CSV file, so that a changed split is cached again.
+
+    Args:
+        data_root (str): The dataset root.
+        mode (str): mode in train/test/val.
+        cache_dir (str): The root directory of the shared caches.
+
+    Returns:
+        str: The cache directory of the split.
+    """
+    data_root = os.path.abspath(data_root)
+    meta_csv = os.path.join(data_root, "{}.csv".format(mode))
+    key = "{}:{}".format(data_root, os.path.getmtime(meta_csv))
+    return os.path.join(
+        cache_dir,
+        "{}-{}".format(
+            os.path.basename(data_root), hashlib.md5(key.encode()).hexdigest()[:8]
+        ),
+        mode,
+    )
+
+
+def build_image_cache(data_root, mode, cache_dir, loader=default_loader):
+    """Decode all images of a split once into a uint8 memmap cache, if it does not exist yet.
+
+    The cache holds `images.npy`, the flattened HxWx3 RGB images one after the other, and `index.npy`,
+    the (offset, height, width) of each image in the order of the split CSV. It is written to a temporary
+    directory and renamed when complete, so concurrent runs never read a partial cache.
+
+    Args:
+        data_root (str): The dataset root.
+        mode (str): mode in train/test/val.
+        cache_dir (str): The root directory of the shared caches.
+        loader (fn, optional): The image loader. Defaults to default_loader.
+
+    Returns:
+        str: The cache directory of the split.
+    """
+    cache_path = get_image_cache_path(data_root, mode, cache_dir)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    print("dump the image cache to {}, please wait...".format(cache_path))
+    data_list = GeneralDataset(data_root, mode, loader, use_memory=False).data_list
+    image_paths = [os.path.join(data_root, "images", path) for path in data_list]
+    # read the image sizes from the headers to allocate the memmap before decoding
+    index = np.zeros((len(image_paths), 3), dtype=np.int64)
+    offset = 0
+    for i, path in enumerate(image_paths):
+        with Image.open(path) as img:
+            width, height = img.size
+        index[i] = (offset, height, width)
+        offset += height * width * 3
+
+    tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        images = np.lib.format.open_memmap(
+            os.path.join(tmp_path, "images.npy"), mode="w+", dtype=np.uint8, shape=(offset,)
+        )
+        for path, (offset, height, width) in zip(image_paths, index):
+            images[offset : offset + height * width * 3] = np.asarray(
+                loader(path).convert("RGB"), dtype=np.uint8
+            ).reshape(-1)
+        images.flush()
+        del images
+        np.save(os.path.join(tmp_path, "index.npy"), index)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another run finished the same cache first
+        if not os.path.exists(cache_path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return cache_path
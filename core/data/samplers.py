@@ -6,12 +6,29 @@ from torch.utils.data.distributed import DistributedSampler
 
 
 def get_sampler(dataset, few_shot, distribute, mode, config):
+    # a seekable train sampler is needed to resume from the middle of an epoch, and gives each copy
+    # of an ensemble an episode (or batch) stream of its own seed
+    seekable = mode == "train" and (
+        config["checkpoint_episode"] > 0
+        or bool(config["preempt_signals"])
+        or config["ensemble_size"] > 1
+    )
+    start_epoch, start_batch = (
+        config["resume_position"]
+        if seekable and "resume_position" in config
+        else (0, 0)
+    )
     if few_shot:
         if distribute:
             sampler = DistributedCategoriesSampler(
                 label_list=dataset.label_list,
                 label_num=dataset.label_num,
-                episode_size=config["episode_size"] // config["n_gpu"],
+                episode_size=(
+                    config["episode_size"]
+                    if mode == "train"
+                    else config["eval_episode_size"]
+                )
+                // config["n_gpu"],
                 episode_num=(
                     (
                         config["train_episode"]
@@ -25,14 +42,19 @@ def get_sampler(dataset, few_shot, distribute, mode, config):
                 if mode == "train"
                 else config["test_shot"] + config["test_query"],
                 rank=config["rank"],
-                seed=0,
+                seed=config["seed"],
                 world_size=config["n_gpu"],
+                seekable=seekable,
+                start_epoch=start_epoch,
+                start_batch=start_batch,
             )
         else:
             sampler = CategoriesSampler(
                 label_list=dataset.label_list,
                 label_num=dataset.label_num,
-                episode_size=config["episode_size"],
+                episode_size=config["episode_size"]
+                if mode == "train"
+                else config["eval_episode_size"],
                 episode_num=(
                     config["train_episode"]
                     if mode == "train"
@@ -42,15 +64,88 @@ def get_sampler(dataset, few_shot, distribute, mode, config):
                 image_num=config["shot_num"] + config["query_num"]
                 if mode == "train"
                 else config["test_shot"] + config["test_query"],
+                seed=config["seed"],
+                seekable=seekable,
+                start_epoch=start_epoch,
+                start_batch=start_batch,
             )
     else:
-        if distribute:
+        if seekable:
+            data_scale = 1 if config["n_gpu"] == 0 else config["n_gpu"]
+            sampler = SeekableBatchSampler(
+                data_num=len(dataset),
+                batch_size=config["batch_size"] // data_scale,
+                rank=config["rank"] if distribute else 0,
+                world_size=config["n_gpu"] if distribute else 1,
+                seed=config["seed"],
+                start_epoch=start_epoch,
+                start_batch=start_batch,
+            )
+        elif distribute:
             sampler = DistributedSampler(dataset, rank=config["rank"], shuffle=True)
         else:
             sampler = None
     return sampler
 
 
+def get_episode_generator(seed, rank, epoch, batch_idx):
+    """Build the generator of one episode batch of a seekable sampler.
+
+    The generator only depends on its position, so any episode batch can be reproduced without
+    replaying the ones before it.
+
+    Args:
+        seed (int): The sampler seed.
+        rank (int): The process rank.
+        epoch (int): The epoch index.
+        batch_idx (int): The episode batch index in the epoch.
+
+    Returns:
+        torch.Generator: A seeded generator.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(
+        int(
+            np.random.SeedSequence([seed, rank, epoch, batch_idx]).generate_state(
+                1, np.uint64
+            )[0]
+        )
+    )
+    return generator
+
+
+def seekable_iter(sampler, rank):
+    """Iterate one pass of a seekable categories sampler.
+
+    Every pass consumes `sampler.start_batch` (the first pass may start in the middle of an epoch)
+    and advances `sampler.epoch`, so the passes stay aligned with the train epochs even when the
+    dataloader prefetches across epoch boundaries.
+
+    Args:
+        sampler (Sampler): A `CategoriesSampler` or `DistributedCategoriesSampler`.
+        rank (int): The process rank.
+
+    Yields:
+        torch.Tensor: The stacked tensor of a FSL task batch(multi-task).
+    """
+    epoch, start_batch = sampler.epoch, sampler.start_batch
+    sampler.epoch, sampler.start_batch = epoch + 1, 0
+    for batch_idx in range(start_batch, len(sampler)):
+        generator = get_episode_generator(sampler.seed, rank, epoch, batch_idx)
+        batch = []
+        for i_episode in range(sampler.episode_size):
+            classes = torch.randperm(len(sampler.idx_list), generator=generator)[
+                : sampler.way_num
+            ]
+            for c in classes:
+                idxes = sampler.idx_list[c.item()]
+                pos = torch.randperm(idxes.size(0), generator=generator)[
+                    : sampler.image_num
+                ]
+                batch.append(idxes[pos])
+        yield torch.stack(batch).reshape(-1)
+
+
 class CategoriesSampler(Sampler):
     """A Sampler to sample a FSL task.
 
@@ -66,6 +161,10 @@ class CategoriesSampler(Sampler):
         episode_num,
         way_num,
         image_num,
+        seed=0,
+        seekable=False,
+        start_epoch=0,
+        start_batch=0,
     ):
         """Init a CategoriesSampler and generate a label-index list.
 
@@ -76,6 +175,12 @@ class CategoriesSampler(Sampler):
             episode_num (int): FSL setting.
             way_num (int): FSL setting.
             image_num (int): FSL setting.
+            seed (int, optional): The seed of a seekable sampler. Defaults to 0.
+            seekable (bool, optional): Sample each episode batch from a generator seeded by
+                (seed, epoch, batch) so that the sampler is seekable. Defaults to False.
+            start_epoch (int, optional): The epoch of the first pass when seekable. Defaults to 0.
+            start_batch (int, optional): The episode batch the first pass starts from when
+                seekable. Defaults to 0.
         """
         super(CategoriesSampler, self).__init__(label_list)
 
@@ -83,6 +188,10 @@ class CategoriesSampler(Sampler):
         self.episode_num = episode_num
         self.way_num = way_num
         self.image_num = image_num
+        self.seed = seed
+        self.seekable = seekable
+        self.epoch = start_epoch
+        self.start_batch = start_batch
 
         label_list = np.array(label_list)
         self.idx_list = []
@@ -100,6 +209,10 @@ class CategoriesSampler(Sampler):
         Yields:
             torch.Tensor: The stacked tensor of a FSL task batch(multi-task).
         """
+        if self.seekable:
+            yield from seekable_iter(self, rank=0)
+            return
+
         batch = []
         for i_batch in range(self.episode_num):
             classes = torch.randperm(len(self.idx_list))[: self.way_num]
@@ -131,6 +244,9 @@ class DistributedCategoriesSampler(Sampler):
         rank,
         seed=0,
         world_size=1,
+        seekable=False,
+        start_epoch=0,
+        start_batch=0,
     ):
         """Init a CategoriesSampler and generate a label-index list.
 
@@ -141,6 +257,11 @@ class DistributedCategoriesSampler(Sampler):
             episode_num (int): FSL setting.
             way_num (int): FSL setting.
             image_num (int): FSL setting.
+            seekable (bool, optional): Sample each episode batch from a generator seeded by
+                (seed, rank, epoch, batch) so that the sampler is seekable. Defaults to False.
+            start_epoch (int, optional): The epoch of the first pass when seekable. Defaults to 0.
+            start_batch (int, optional): The episode batch the first pass starts from when
+                seekable. Defaults to 0.
         """
         super(DistributedCategoriesSampler, self).__init__(label_list)
 
@@ -151,7 +272,9 @@ class DistributedCategoriesSampler(Sampler):
         self.rank = rank
         self.seed = seed
         self.world_size = world_size
-        self.epoch = 0
+        self.seekable = seekable
+        self.epoch = start_epoch
+        self.start_batch = start_batch
 
         label_list = np.array(label_list)
         self.idx_list = []
@@ -179,6 +302,10 @@ class DistributedCategoriesSampler(Sampler):
         Yields:
             torch.Tensor: The stacked tensor of a FSL task batch(multi-task).
         """
+        if self.seekable:
+            yield from seekable_iter(self, rank=self.rank)
+            return
+
         batch = []
         for i_batch in range(self.episode_num):
             classes = torch.randperm(len(self.idx_list), generator=self.cls_g)[
@@ -208,3 +335,70 @@ class DistributedCategoriesSampler(Sampler):
         # self.cls_g.manual_seed(self.seed + self.epoch)
         # # FIXME not so random, 10000 means no method could train 10000 epochs, so cls_g will not have the same seed with img_g
         # self.img_g.manual_seed(self.seed + self.epoch + 10000)
+
+
+class SeekableBatchSampler(Sampler):
+    """A batch sampler of the shuffled images of a finetuning train set that is seekable.
+
+    Each epoch is a permutation drawn from a generator seeded by (seed, epoch), the same on every
+    rank, which is padded and split across the ranks as `DistributedSampler` does. The last
+    incomplete batch of a rank is dropped.
+
+    Args:
+        Sampler (torch.utils.data.Sampler): Base sampler from PyTorch.
+    """
+
+    def __init__(
+        self,
+        data_num,
+        batch_size,
+        rank=0,
+        world_size=1,
+        seed=0,
+        start_epoch=0,
+        start_batch=0,
+    ):
+        """Init a SeekableBatchSampler.
+
+        Args:
+            data_num (int): The number of images.
+            batch_size (int): The batch size of each rank.
+            rank (int, optional): The process rank. Defaults to 0.
+            world_size (int, optional): The number of processes. Defaults to 1.
+            seed (int, optional): The sampler seed. Defaults to 0.
+            start_epoch (int, optional): The epoch of the first pass. Defaults to 0.
+            start_batch (int, optional): The batch the first pass starts from. Defaults to 0.
+        """
+        super(SeekableBatchSampler, self).__init__(None)
+
+        self.data_num = data_num
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.seekable = True
+        self.epoch = start_epoch
+        self.start_batch = start_batch
+        self.num_samples = (data_num + world_size - 1) // world_size
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def __iter__(self):
+        """Iterate one pass, see `seekable_iter`.
+
+        Yields:
+            list: The image indices of a batch.
+        """
+        epoch, start_batch = self.epoch, self.start_batch
+        self.epoch, self.start_batch = epoch + 1, 0
+        generator = get_episode_generator(self.seed, 0, epoch, 0)
+        indices = torch.randperm(self.data_num, generator=generator)
+        padding = self.num_samples * self.world_size - self.data_num
+        if padding > 0:
+            indices = torch.cat([indices, indices[:padding]])
+        indices = indices[self.rank :: self.world_size].tolist()
+        for batch_idx in range(start_batch, len(self)):
+            yield indices[
+                batch_idx * self.batch_size : (batch_idx + 1) * self.batch_size
+            ]
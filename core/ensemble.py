@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+import builtins
+import copy
+import datetime
+import os
+from logging import getLogger
+from time import time
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from torch.func import functional_call, stack_module_state, vmap
+
+import core.model as arch
+from core.data import get_dataloader
+from core.utils import (
+    GradualWarmupScheduler,
+    ModelType,
+    SaveType,
+    create_dirs,
+    feed_features,
+    get_instance,
+    get_local_time,
+    init_logger_config,
+    init_seed,
+    init_threads,
+    prepare_device,
+    save_model,
+)
+
+
+class EnsembleTrainer(object):
+    """
+    Train `ensemble_size` independent copies of a metric model in lockstep, with the seeds seed,
+    seed + 1, ... .
+
+    The backbones of the copies are stacked and run by one vectorized forward (torch.func.vmap), which
+    keeps a small backbone such as Conv64F busy where a single run leaves the device mostly idle. The
+    heads of the copies run one after the other on their own features. Each copy has its own
+    initialization, train/val/test episode streams and results, and is saved to its own result dir
+    (seed{seed}), which `Test` can load as a normal run. The optimizers update elementwise, so one
+    optimizer over the stacked parameters keeps a separate state per copy.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.config["rank"] = 0
+        self.ensemble_size = config["ensemble_size"]
+        self.seeds = [config["seed"] + k for k in range(self.ensemble_size)]
+        self.result_path, self.log_path, self.copy_paths = self._init_files(config)
+        self.logger = self._init_logger()
+        self.device = self._init_device(config)
+        if config["eval_episode_size"] == "auto":
+            print("eval_episode_size auto is not probed by ensemble training", level="warning")
+        if config["eval_episode_size"] in [None, "auto"]:
+            config["eval_episode_size"] = config["episode_size"]
+        print(self.config)
+        self.models = self._init_model(config)
+        self.params, self.buffers, self.base_emb_func = self._stack_emb_funcs()
+        (
+            self.train_loaders,
+            self.val_loaders,
+            self.test_loaders,
+        ) = self._init_dataloader(config)
+        self.optimizer, self.scheduler = self._init_optim(config)
+        self.best_val_acc = [float("-inf")] * self.ensemble_size
+        self.best_test_acc = [float("-inf")] * self.ensemble_size
+
+    def train_loop(self):
+        """
+        The train loop of the ensemble: train-val-test and save each copy when its val-acc increases.
+
+        Returns:
+            pandas.DataFrame: The best val/test acc of each seed.
+        """
+        experiment_begin = time()
+        for epoch_idx in range(self.config["epoch"]):
+            print("============ Train on the train set ============")
+            print("learning rate: {}".format(self.scheduler.get_last_lr()))
+            train_acc = self._train(epoch_idx)
+            print(" * Acc@1 {}".format(_format_accs(train_acc)))
+            if ((epoch_idx + 1) % self.config["val_per_epoch"]) == 0:
+                print("============ Validation on the val set ============")
+                val_acc = self._validate(epoch_idx, self.val_loaders)
+                print(" * Acc@1 {}".format(_format_accs(val_acc)))
+                is_best = [
+                    acc > best for acc, best in zip(val_acc, self.best_val_acc)
+                ]
+                lazy_test = self.config["lazy_test"]
+                if lazy_test is None or (lazy_test == "best" and any(is_best)):
+                    print("============ Testing on the test set ============")
+                    test_acc = self._validate(epoch_idx, self.test_loaders)
+                    print(" * Acc@1 {}".format(_format_accs(test_acc)))
+                else:
+                    test_acc = [None] * self.ensemble_size
+                self._sync_emb_funcs()
+                for k in range(self.ensemble_size):
+                    if is_best[k]:
+                        self.best_val_acc[k] = val_acc[k]
+                        self.best_test_acc[k] = test_acc[k]
+                        self._save_model(k, epoch_idx, SaveType.BEST)
+            self.scheduler.step()
+
+        if self.config["lazy_test"] == "end":
+            self._test_best_models()
+
+        print(
+            "End of experiment, took {}".format(
+                str(datetime.timedelta(seconds=int(time() - experiment_begin)))
+            )
+        )
+        results = pd.DataFrame(
+            {
+                "seed": self.seeds,
+                "best_val_acc": self.best_val_acc,
+                "best_test_acc": self.best_test_acc,
+                "result_path": self.copy_paths,
+            }
+        )
+        print(results.to_string(index=False))
+        print(
+            "best test acc: {:.3f} +- {:.3f}".format(
+                np.mean(self.best_test_acc), np.std(self.best_test_acc)
+            )
+        )
+        results.to_csv(os.path.join(self.result_path, "ensemble.csv"), index=False)
+        print("Result DIR: {}".format(self.result_path))
+
+        return results
+
+    def _train(self, epoch_idx):
+        """
+        The train stage of all copies.
+
+        Args:
+            epoch_idx (int): Epoch index.
+
+        Returns:
+            list: The acc of each copy.
+        """
+        self.base_emb_func.train()
+        for model in self.models:
+            model.train()
+        episode_size = self.config["episode_size"]
+        num_batch = len(self.train_loaders[0][0])
+        accs = [[] for _ in range(self.ensemble_size)]
+        losses = []
+
+        end = time()
+        for batch_idx, batches in enumerate(
+            zip(*[zip(*loader) for loader in self.train_loaders])
+        ):
+            data_time = time() - end
+            batches = [
+                [elem for each_batch in batch for elem in each_batch]
+                for batch in batches
+            ]
+            self.optimizer.zero_grad()
+            outputs = self._forward(batches)
+            loss = sum(copy_loss for _, _, copy_loss in outputs)
+            loss.backward()
+            self.optimizer.step()
+
+            losses.append(loss.item() / self.ensemble_size)
+            for k, (_, acc, _) in enumerate(outputs):
+                accs[k].append(acc)
+
+            if ((batch_idx + 1) * episode_size % self.config["log_interval"] == 0) or (
+                batch_idx + 1
+            ) == num_batch:
+                print(
+                    "Epoch-({}): [{}/{}]\tTime {:.3f}\tData {:.3f}\t"
+                    "Loss {:.3f} ({:.3f})\tAcc@1 {}".format(
+                        epoch_idx,
+                        (batch_idx + 1) * episode_size,
+                        num_batch * episode_size,
+                        time() - end,
+                        data_time,
+                        losses[-1],
+                        np.mean(losses),
+                        _format_accs([np.mean(acc) for acc in accs]),
+                    )
+                )
+            end = time()
+
+        return [float(np.mean(acc)) for acc in accs]
+
+    def _validate(self, epoch_idx, loaders):
+        """
+        The val/test stage of all copies, each on its own episodes.
+
+        Returns:
+            list: The acc of each copy.
+        """
+        self.base_emb_func.eval()
+        for model in self.models:
+            model.eval()
+            model.reverse_setting_info()
+        accs = [[] for _ in range(self.ensemble_size)]
+
+        with torch.no_grad():
+            for batches in zip(*[zip(*loader) for loader in loaders]):
+                batches = [
+                    [elem for each_batch in batch for elem in each_batch]
+                    for batch in batches
+                ]
+                for k, (_, acc) in enumerate(self._forward(batches)):
+                    accs[k].append(acc)
+
+        for model in self.models:
+            model.reverse_setting_info()
+
+        return [float(np.mean(acc)) for acc in accs]
+
+    def _forward(self, batches):
+        """
+        Embed the images of all copies with one vectorized backbone forward, then run the head of
+        each copy on its own features.
+
+        Args:
+            batches (list): The batch of each copy.
+
+        Returns:
+            list: The outputs of each copy's model, (output, acc, loss) when training or (output, acc).
+        """
+        images = torch.stack([batch[0] for batch in batches]).to(self.device)
+        feats = vmap(self._embed, randomness="different")(
+            self.params, self.buffers, images
+        )
+        outputs = []
+        for model, batch, feat in zip(self.models, batches, feats):
+            with feed_features(model, feat):
+                outputs.append(model(batch))
+
+        return outputs
+
+    def _embed(self, params, buffers, images):
+        return functional_call(self.base_emb_func, (params, buffers), (images,))
+
+    def _test_best_models(self):
+        """
+        Test the best model of each copy once, for `lazy_test: end`.
+        """
+        print("============ Testing the best models on the test set ============")
+        for k, copy_path in enumerate(self.copy_paths):
+            state_dict = torch.load(
+                os.path.join(copy_path, "checkpoints", "model_best.pth"),
+                map_location="cpu",
+            )
+            self.models[k].load_state_dict(state_dict)
+        self._restack_emb_funcs()
+        self.best_test_acc = self._validate(self.config["epoch"], self.test_loaders)
+        print(" * Acc@1 {}".format(_format_accs(self.best_test_acc)))
+
+    def _init_files(self, config):
+        """
+        Init the result dir of the ensemble, and the result dir of each copy with the config of its seed.
+
+        Returns:
+            tuple: A tuple of (result_path, log_path, copy_paths).
+        """
+        result_dir = "{}-{}-{}-{}-{}-ensemble{}{}-{}".format(
+            config["classifier"]["name"],
+            config["data_root"].split("/")[-1],
+            config["backbone"]["name"],
+            config["way_num"],
+            config["shot_num"],
+            self.ensemble_size,
+            ("-" + config["tag"]) if config["tag"] is not None else "",
+            get_local_time(),
+        )
+        result_path = os.path.join(config["result_root"], result_dir)
+        log_path = os.path.join(result_path, "log_files")
+        create_dirs([result_path, log_path])
+        copy_paths = []
+        for seed in self.seeds:
+            copy_path = os.path.join(result_path, "seed{}".format(seed))
+            create_dirs([copy_path, os.path.join(copy_path, "checkpoints")])
+            copy_config = dict(config, seed=seed, ensemble_size=1)
+            with open(
+                os.path.join(copy_path, "config.yaml"), "w", encoding="utf-8"
+            ) as fout:
+                fout.write(yaml.dump(copy_config))
+            copy_paths.append(copy_path)
+
+        init_logger_config(
+            config["log_level"],
+            log_path,
+            config["classifier"]["name"],
+            config["backbone"]["name"],
+        )
+
+        return result_path, log_path, copy_paths
+
+    def _init_logger(self):
+        logger = getLogger(__name__)
+
+        # hack print as the trainer does
+        def use_logger(*msg, level="info", all_rank=False):
+            for m in msg:
+                getattr(logger, level)(m)
+
+        builtins.print = use_logger
+
+        return logger
+
+    def _init_device(self, config):
+        device, _ = prepare_device(
+            0, config["device_ids"], 1, None, None, use_cpu=config["use_cpu"]
+        )
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        init_threads(
+            0,
+            1,
+            device,
+            config["num_threads"],
+            config["num_interop_threads"],
+            config["cpu_affinity"],
+        )
+
+        return device
+
+    def _init_model(self, config):
+        """
+        Init a model for each copy, initialized from its own seed.
+
+        Returns:
+            list: The model of each copy.
+        """
+        models = []
+        for seed in self.seeds:
+            init_seed(seed, config["deterministic"])
+            emb_func = get_instance(arch, "backbone", config)
+            model_kwargs = {
+                "way_num": config["way_num"],
+                "shot_num": config["shot_num"] * config["augment_times"],
+                "query_num": config["query_num"],
+                "test_way": config["test_way"],
+                "test_shot": config["test_shot"] * config["augment_times"],
+                "test_query": config["test_query"],
+                "emb_func": emb_func,
+                "device": self.device,
+            }
+            model = get_instance(arch, "classifier", config, **model_kwargs)
+            if config["pretrain_path"] is not None:
+                state_dict = torch.load(config["pretrain_path"], map_location="cpu")
+                model.emb_func.load_state_dict(state_dict, strict=False)
+            models.append(model.to(self.device))
+        init_seed(config["seed"], config["deterministic"])
+
+        assert (
+            models[0].model_type == ModelType.METRIC
+        ), "ensemble training supports metric methods only"
+        print(models[0])
+
+        return models
+
+    def _stack_emb_funcs(self):
+        """
+        Stack the backbone parameters and buffers of the copies along a new first dim, the backbones of
+        the models only keep a copy of them to be saved.
+
+        Returns:
+            tuple: A tuple of (stacked parameters, stacked buffers, a stateless backbone to call them with).
+        """
+        emb_funcs = [model.emb_func for model in self.models]
+        params, buffers = stack_module_state(emb_funcs)
+        for emb_func in emb_funcs:
+            emb_func.requires_grad_(False)
+        base_emb_func = copy.deepcopy(emb_funcs[0]).to("meta")
+
+        return params, buffers, base_emb_func
+
+    @torch.no_grad()
+    def _sync_emb_funcs(self):
+        """
+        Copy the stacked parameters and buffers back to the backbone of each copy.
+        """
+        for k, model in enumerate(self.models):
+            for name, tensor in _named_tensors(model.emb_func):
+                tensor.copy_(self._get_stacked(name)[k])
+
+    @torch.no_grad()
+    def _restack_emb_funcs(self):
+        """
+        Copy the backbone of each copy into the stacked parameters and buffers.
+        """
+        for k, model in enumerate(self.models):
+            for name, tensor in _named_tensors(model.emb_func):
+                self._get_stacked(name)[k].copy_(tensor)
+
+    def _get_stacked(self, name):
+        return self.params[name] if name in self.params else self.buffers[name]
+
+    def _init_dataloader(self, config):
+        """
+        Init the dataloaders of each copy, sampling the episodes from its own seed.
+
+        Returns:
+            tuple: A tuple of (train_loaders, val_loaders and test_loaders).
+        """
+        loaders = {"train": [], "val": [], "test": []}
+        for seed in self.seeds:
+            copy_config = dict(
+                config, seed=seed, workers=config["workers"] // self.ensemble_size
+            )
+            init_seed(seed, config["deterministic"])
+            for mode in loaders:
+                loaders[mode].append(
+                    get_dataloader(copy_config, mode, ModelType.METRIC, False)
+                )
+        init_seed(config["seed"], config["deterministic"])
+
+        return loaders["train"], loaders["val"], loaders["test"]
+
+    def _init_optim(self, config):
+        """
+        Init one optimizer and scheduler over the stacked backbones and the heads of all copies.
+
+        Returns:
+            tuple: A tuple of optimizer and scheduler.
+        """
+        if config["optimizer"].get("other") is not None:
+            print(
+                "optimizer.other is not supported by ensemble training, ignored",
+                level="warning",
+            )
+        params = list(self.params.values())
+        for model in self.models:
+            params.extend(p for p in model.parameters() if p.requires_grad)
+        optimizer = get_instance(torch.optim, "optimizer", config, params=params)
+        scheduler = GradualWarmupScheduler(optimizer, self.config)
+        print(optimizer)
+
+        return optimizer, scheduler
+
+    def _save_model(self, k, epoch, save_type):
+        """
+        Save the model and the `save_part`s of copy k, as `Trainer._save_model` does.
+        """
+        checkpoints_path = os.path.join(self.copy_paths[k], "checkpoints")
+        model = self.models[k]
+        save_model(model, None, None, checkpoints_path, "model", epoch, save_type=save_type)
+        if self.config["save_part"] is not None:
+            for save_part in self.config["save_part"]:
+                if hasattr(model, save_part):
+                    save_model(
+                        getattr(model, save_part),
+                        None,
+                        None,
+                        checkpoints_path,
+                        save_part,
+                        epoch,
+                        save_type=save_type,
+                    )
+
+
+def _named_tensors(module):
+    yield from module.named_parameters()
+    yield from module.named_buffers()
+
+
+def _format_accs(accs):
+    return " ".join("-" if acc is None else "{:.3f}".format(acc) for acc in accs)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import atexit
+import builtins
+import os
+import queue
+from logging import getLogger
+
+import numpy as np
+import torch
+
+import core.model as arch
+from core.data import get_dataloader
+from core.pipeline import log_knn_reports
+from core.utils import (
+    ModelType,
+    SaveType,
+    get_instance,
+    init_logger_config,
+    init_seed,
+    save_model,
+)
+
+
+class AsyncEvaluator(object):
+    """
+    The asynchronous evaluator.
+
+    Run the val/test stages on snapshots of the training model in a separate process, so that
+    training does not wait for them. The evaluator process saves the best model itself, and the
+    trainer collects the results to keep track of the best accuracies.
+    """
+
+    def __init__(self, config, checkpoints_path, log_path, best_val_acc):
+        ctx = torch.multiprocessing.get_context("spawn")
+        # one snapshot in evaluation and at most one waiting, training blocks beyond that
+        self.snapshot_queue = ctx.Queue(maxsize=1)
+        self.result_queue = ctx.Queue()
+        self.pending = 0
+        # not daemonic: the evaluation dataloaders may start their own workers
+        self.process = ctx.Process(
+            target=eval_worker,
+            args=(
+                config,
+                checkpoints_path,
+                log_path,
+                best_val_acc,
+                os.getpid(),
+                self.snapshot_queue,
+                self.result_queue,
+            ),
+        )
+        self.process.start()
+        # multiprocessing joins non-daemonic children at exit, do not hang if the trainer stops early
+        atexit.register(self.process.terminate)
+
+    def submit(self, epoch_idx, model):
+        """
+        Hand a CPU snapshot of the model weights to the evaluator process.
+
+        Args:
+            epoch_idx (int): Epoch index.
+            model (nn.Module): The (unwrapped) training model.
+        """
+        snapshot = {
+            k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()
+        }
+        while True:
+            try:
+                self.snapshot_queue.put((epoch_idx, snapshot), timeout=1)
+                break
+            except queue.Full:
+                self._check_alive()
+        self.pending += 1
+
+    def collect(self, block=False):
+        """
+        Collect the finished evaluations.
+
+        Args:
+            block (bool, optional): Wait until all submitted snapshots are evaluated. Defaults to False.
+
+        Returns:
+            list: A list of (epoch_idx, val_acc, test_acc) in submission order, test_acc is None
+                if the test set was skipped by `lazy_test`.
+        """
+        results = []
+        while self.pending > 0:
+            try:
+                result = self.result_queue.get(block=block, timeout=1 if block else None)
+            except queue.Empty:
+                if not block:
+                    break
+                self._check_alive()
+                continue
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+            self.pending -= 1
+
+        return results
+
+    def close(self):
+        self.snapshot_queue.put(None)
+        self.process.join()
+
+    def _check_alive(self):
+        # the queues never get or take anything more from a dead evaluator
+        if not self.process.is_alive():
+            raise RuntimeError(
+                "the async evaluator exited with code {}".format(self.process.exitcode)
+            )
+
+
+def eval_worker(
+    config,
+    checkpoints_path,
+    log_path,
+    best_val_acc,
+    parent_pid,
+    snapshot_queue,
+    result_queue,
+):
+    """
+    The evaluator process: build the model and the val/test dataloaders on `async_eval_device`,
+    then evaluate the snapshots until a None is received.
+    """
+    config = dict(config, n_gpu=1, rank=0)
+    init_logger_config(
+        config["log_level"],
+        log_path,
+        config["classifier"]["name"],
+        config["backbone"]["name"],
+        is_train=False,
+    )
+    logger = getLogger(__name__)
+
+    # hack print as the trainer does
+    def use_logger(*msg, level="info", all_rank=False):
+        for m in msg:
+            getattr(logger, level)(m)
+
+    builtins.print = use_logger
+
+    try:
+        init_seed(config["seed"], config["deterministic"])
+        device = torch.device(config["async_eval_device"])
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+
+        emb_func = get_instance(arch, "backbone", config)
+        model_kwargs = {
+            "way_num": config["way_num"],
+            "shot_num": config["shot_num"] * config["augment_times"],
+            "query_num": config["query_num"],
+            "test_way": config["test_way"],
+            "test_shot": config["test_shot"] * config["augment_times"],
+            "test_query": config["test_query"],
+            "emb_func": emb_func,
+            "device": device,
+        }
+        model = get_instance(arch, "classifier", config, **model_kwargs).to(device)
+        val_loader = get_dataloader(config, "val", model.model_type, False)
+        test_loader = get_dataloader(config, "test", model.model_type, False)
+    except Exception as e:
+        result_queue.put(e)
+        raise
+
+    while True:
+        try:
+            item = snapshot_queue.get(timeout=60)
+        except queue.Empty:
+            # stop with an orphaned evaluator, e.g. after the trainer crashed
+            if os.getppid() != parent_pid:
+                break
+            continue
+        if item is None:
+            break
+
+        epoch_idx, snapshot = item
+        try:
+            model.load_state_dict(snapshot)
+            val_acc = _evaluate(model, val_loader)
+            # with lazy_test, only a new best val acc is tested (best) or none at all (end)
+            test_acc = None
+            if config["lazy_test"] is None or (
+                config["lazy_test"] == "best" and val_acc > best_val_acc
+            ):
+                test_acc = _evaluate(model, test_loader)
+            print(
+                "Epoch-({}): val Acc@1 {:.3f}\ttest Acc@1 {}".format(
+                    epoch_idx,
+                    val_acc,
+                    "-" if test_acc is None else "{:.3f}".format(test_acc),
+                )
+            )
+            if val_acc > best_val_acc:
+                best_val_acc = val_acc
+                _save_best_model(model, config, checkpoints_path, epoch_idx)
+        except Exception as e:
+            result_queue.put(e)
+            raise
+        result_queue.put((epoch_idx, val_acc, test_acc))
+
+
+def _evaluate(model, loader):
+    """
+    Evaluate the model on all episodes of a val/test loader.
+
+    Returns:
+        float: Acc.
+    """
+    model.eval()
+    model.reverse_setting_info()
+    accuracies = []
+    with torch.set_grad_enabled(model.model_type != ModelType.METRIC):
+        for batch in zip(*loader):
+            output, acc = model([elem for each_batch in batch for elem in each_batch])
+            accuracies.append(acc)
+    model.reverse_setting_info()
+    log_knn_reports(model)
+
+    return float(np.mean(accuracies))
+
+
+def _save_best_model(model, config, checkpoints_path, epoch_idx):
+    """
+    Save the best model and its `save_part`s, as `Trainer._save_model` does.
+    """
+    save_model(
+        model, None, None, checkpoints_path, "model", epoch_idx, save_type=SaveType.BEST
+    )
+    if config["save_part"] is not None:
+        for save_part in config["save_part"]:
+            if hasattr(model, save_part):
+                save_model(
+                    getattr(model, save_part),
+                    None,
+                    None,
+                    checkpoints_path,
+                    save_part,
+                    epoch_idx,
+                    save_type=SaveType.BEST,
+                )
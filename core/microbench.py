@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import os
+import platform
+import weakref
+from time import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from core.model.backbone.utils.bdc_pool import BDCovpool
+from core.model.finetuning.renet import CCALayer
+from core.model.meta.r2d2 import R2D2Layer
+from core.model.metric.adm import ADMLayer
+from core.model.metric.adm_kl import KLLayer
+from core.model.metric.convm_net import ConvMLayer
+from core.model.metric.cpea_net import CPEALayer
+from core.model.metric.dn4 import DN4Layer
+from core.model.metric.dsn import DSNLayer
+from core.model.metric.frn import FRNLayer
+from core.model.metric.mcl import MCLLayer
+from core.model.metric.meta_baseline_kendall import diffkendall_for_batches
+from core.model.metric.proto_net import ProtoLayer
+
+AXES = ["episode_size", "way", "shot", "query", "channels", "spatial"]
+
+# the point every scaling curve goes through, one axis varies at a time
+BASE_POINT = {
+    "episode_size": 1,
+    "way": 5,
+    "shot": 5,
+    "query": 15,
+    "channels": 64,
+    "spatial": 5,
+}
+
+DEFAULT_GRID = {
+    "episode_size": [1, 2, 4, 8],
+    "way": [5, 10, 20],
+    "shot": [1, 5, 10, 20],
+    "query": [5, 15, 30],
+    "channels": [64, 160, 320, 640],
+    "spatial": [3, 5, 10],
+}
+
+
+def _feat_map(e, n, c, s, device):
+    return torch.randn(e, n, c, s, s, device=device)
+
+
+def _vector(e, n, c, device):
+    return torch.randn(e, n, c, device=device)
+
+
+def _support_target(e, way, shot, device):
+    return torch.arange(way, device=device).repeat_interleave(shot).repeat(e, 1)
+
+
+def _dn4(e, way, shot, query, c, s, device):
+    layer = DN4Layer(n_k=3).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+    return layer, inputs, lambda q, sp: layer(q, sp, way, shot, query)
+
+
+def _proto(e, way, shot, query, c, s, device):
+    layer = ProtoLayer().to(device)
+    inputs = [_vector(e, way * query, c, device), _vector(e, way * shot, c, device)]
+    return layer, inputs, lambda q, sp: layer(q, sp, way, shot, query)
+
+
+def _r2d2(e, way, shot, query, c, s, device):
+    layer = R2D2Layer().to(device)
+    inputs = [_vector(e, way * query, c, device), _vector(e, way * shot, c, device)]
+    target = _support_target(e, way, shot, device)
+    return layer, inputs, lambda q, sp: layer(way, shot, q, sp, target)[0]
+
+
+def _frn(e, way, shot, query, c, s, device):
+    layer = FRNLayer(num_channel=c).to(device)
+    inputs = [
+        torch.randn(e, way * query * s * s, c, device=device),
+        torch.randn(e, way, shot * s * s, c, device=device),
+    ]
+    return (
+        layer,
+        inputs,
+        lambda q, sp: layer.get_recon_dist(q, sp, layer.r[0], layer.r[1]),
+    )
+
+
+def _adm(e, way, shot, query, c, s, device):
+    layer = ADMLayer(way, shot, query, 3, device).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+    return layer, inputs, layer
+
+
+def _kl(e, way, shot, query, c, s, device):
+    layer = KLLayer(way, shot, query, 3, device).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+    return layer, inputs, layer
+
+
+def _convm(e, way, shot, query, c, s, device):
+    layer = ConvMLayer(way, shot, query, n_local=s * s).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+    return layer, inputs, layer
+
+
+def _dsn(e, way, shot, query, c, s, device):
+    layer = DSNLayer().to(device)
+    inputs = [_vector(e, way * query, c, device), _vector(e, way * shot, c, device)]
+    return layer, inputs, lambda q, sp: layer(q, sp, way, shot)[0]
+
+
+def _mcl(e, way, shot, query, c, s, device):
+    layer = MCLLayer(n_k=3, katz_factor=0.999, gamma=20, gamma2=10).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+    target = _support_target(e, way, shot, device)
+    return layer, inputs, lambda q, sp: layer(sp, target, q, None, way, shot)
+
+
+def _cca(e, way, shot, query, c, s, device):
+    layer = CCALayer(c, way, shot, query, 0.2, 5.0).to(device)
+    inputs = [_feat_map(e, way * query, c, s, device), _feat_map(e, way * shot, c, s, device)]
+
+    # RENet runs the layer on the images of one episode
+    def forward(q, sp):
+        return torch.stack([layer(sp[i], q[i])[0] for i in range(e)])
+
+    return layer, inputs, forward
+
+
+def _cpea(e, way, shot, query, c, s, device):
+    layer = CPEALayer(in_dim=c).to(device)
+    # the patch tokens of a ViT-S/16 on 224x224 images and a class token, fc2 is built for 196 tokens
+    inputs = [
+        torch.randn(e, way * query, 197, c, device=device),
+        torch.randn(e, way * shot, 197, c, device=device),
+    ]
+
+    def forward(q, sp):
+        return torch.stack([torch.cat(layer(q[i], sp[i], shot)) for i in range(e)])
+
+    return layer, inputs, forward
+
+
+def _diffkendall(e, way, shot, query, c, s, device):
+    # the prototypes as MetaBaselineKendall computes them
+    inputs = [_vector(e, way * query, c, device), _vector(e, way * shot, c, device)]
+
+    def forward(q, sp):
+        proto = sp.reshape(e, way, shot, c).mean(2)
+        return diffkendall_for_batches(proto, q)
+
+    return None, inputs, forward
+
+
+def _bdcovpool(e, way, shot, query, c, s, device):
+    # the images of the episodes go through the pooling of the backbone
+    t = torch.log(torch.full((1, 1), 1.0 / (2 * s * s), device=device)).requires_grad_()
+    inputs = [torch.randn(e * way * (shot + query), c, s, s, device=device)]
+    return t, inputs, lambda x: BDCovpool(x, t)
+
+
+# name: (builder, the axes the head depends on, the expected exponent of the cost along each axis)
+# the exponents follow the dominant term of the head, e.g. the hw x shw similarity of DN4 is quadratic
+# in the number of positions. The spatial exponent is that of the number of positions h * w.
+HEADS = {
+    "DN4Layer": (
+        _dn4,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 1, "spatial": 2},
+    ),
+    "ProtoLayer": (
+        _proto,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 1},
+    ),
+    "R2D2Layer": (
+        _r2d2,
+        {"episode_size": 1, "way": 3, "shot": 3, "query": 1, "channels": 1},
+    ),
+    "FRNLayer.get_recon_dist": (
+        _frn,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 3, "spatial": 1},
+    ),
+    "ADMLayer": (
+        _adm,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 3, "spatial": 2},
+    ),
+    "KLLayer": (
+        _kl,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 3, "spatial": 1},
+    ),
+    "ConvMLayer": (
+        _convm,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 2, "spatial": 2},
+    ),
+    "DSNLayer": (
+        _dsn,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 2},
+    ),
+    "MCLLayer": (
+        _mcl,
+        {"episode_size": 1, "way": 4, "shot": 1, "query": 1, "channels": 1, "spatial": 3},
+    ),
+    "CCALayer": (
+        _cca,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 1, "spatial": 2},
+    ),
+    "CPEALayer": (
+        _cpea,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 1},
+    ),
+    "diffkendall_for_batches": (
+        _diffkendall,
+        {"episode_size": 1, "way": 2, "shot": 1, "query": 1, "channels": 2},
+    ),
+    "BDCovpool": (
+        _bdcovpool,
+        {"episode_size": 1, "way": 1, "shot": 1, "query": 1, "channels": 3, "spatial": 1},
+    ),
+}
+
+
+class _LiveTensorMemory(TorchDispatchMode):
+    """
+    Track the peak bytes of the tensors allocated by the ops run under the mode.
+
+    The CPU allocator has no peak statistics, so the storages of the op outputs are counted until the
+    last tensor using them is freed. The tensors that exist before the mode, e.g. the inputs and
+    parameters of a head, are not counted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+        # {storage pointer: [bytes, number of live tensors using it]}
+        self.storages = {}
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        outputs = func(*args, **(kwargs or {}))
+        flat = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+        for output in flat:
+            if isinstance(output, torch.Tensor):
+                self._track(output)
+        return outputs
+
+    def _track(self, tensor):
+        storage = tensor.untyped_storage()
+        ptr = storage.data_ptr()
+        if ptr == 0:
+            return
+        if ptr not in self.storages:
+            self.storages[ptr] = [storage.nbytes(), 0]
+            self.live += storage.nbytes()
+            self.peak = max(self.peak, self.live)
+        self.storages[ptr][1] += 1
+        weakref.finalize(tensor, self._release, ptr)
+
+    def _release(self, ptr):
+        entry = self.storages.get(ptr)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.live -= entry[0]
+            del self.storages[ptr]
+
+
+def benchmark_head(name, point, device, steps=10, backward=False):
+    """
+    Time one head on synthetic tensors of one grid point and measure its memory.
+
+    Args:
+        name (str): The head name, a key of HEADS.
+        point (dict): The value of each axis, see BASE_POINT.
+        device (torch.device): The device to run on.
+        steps (int, optional): The number of timed steps, after one warmup step. Defaults to 10.
+        backward (bool, optional): Time forward and backward of the sum of the outputs instead of the
+            forward only. Defaults to False.
+
+    Returns:
+        dict: The time per step (sec) and the peak memory (bytes) of a step. On CUDA the memory is the
+            peak allocated memory above that of the inputs, on CPU the peak bytes of the tensors the
+            step allocates.
+    """
+    builder, _ = HEADS[name]
+    torch.manual_seed(0)
+    module, inputs, forward = builder(
+        point["episode_size"],
+        point["way"],
+        point["shot"],
+        point["query"],
+        point["channels"],
+        point["spatial"],
+        device,
+    )
+    if isinstance(module, torch.nn.Module):
+        module.train(backward)
+    for x in inputs:
+        x.requires_grad_(backward)
+
+    def step():
+        with torch.set_grad_enabled(backward):
+            output = forward(*inputs)
+            if backward:
+                output.sum().backward()
+
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    begin = time()
+    for _ in range(steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    step_time = (time() - begin) / steps
+
+    if device.type == "cuda":
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        torch.cuda.synchronize(device)
+        peak_memory = torch.cuda.max_memory_allocated(device) - base
+    else:
+        with _LiveTensorMemory() as memory:
+            step()
+        peak_memory = memory.peak
+
+    return {"time": step_time, "peak_memory": peak_memory}
+
+
+def fit_exponent(values, measures):
+    """
+    Fit measure ~ value^k by least squares in log-log space.
+
+    Returns:
+        float: The exponent k, None with less than two usable points.
+    """
+    points = [
+        (math.log(value), math.log(measure))
+        for value, measure in zip(values, measures)
+        if measure is not None and measure > 0
+    ]
+    if len(set(x for x, _ in points)) < 2:
+        return None
+    x, y = np.array(points).T
+
+    return float(np.polyfit(x, y, 1)[0])
+
+
+def run_microbench(
+    heads=None,
+    grid=None,
+    base_point=None,
+    device="cpu",
+    steps=10,
+    backward=False,
+    max_time=10.0,
+    tolerance=0.3,
+    output=None,
+):
+    """
+    Drive the per-episode heads over a grid of (episode_size, way, shot, query, channels, spatial) with
+    synthetic tensors and report their time and memory scaling curves.
+
+    A scaling curve varies one axis of `base_point` over its values in `grid`, the others stay at the
+    base point. The exponent of each curve is fitted in log-log space (the spatial one with respect to
+    the number of positions h * w) and a curve is flagged when it grows faster than the dominant term
+    of the head implies by more than `tolerance`, or faster than linear where the head is expected to
+    be linear. A curve stops at the first point slower than `max_time` or failing, e.g. out of memory.
+
+    Args:
+        heads (list, optional): Head names, all of HEADS if None.
+        grid (dict, optional): The values of each axis. Defaults to DEFAULT_GRID.
+        base_point (dict, optional): The point the curves go through. Defaults to BASE_POINT.
+        device (str, optional): The device to run on. Defaults to "cpu".
+        steps (int, optional): The number of timed steps per point. Defaults to 10.
+        backward (bool, optional): Time forward and backward instead of the forward only.
+            Defaults to False.
+        max_time (float, optional): Stop a curve after a point with a step slower than this (sec).
+            Defaults to 10.0.
+        tolerance (float, optional): The slack of the fitted exponents over the expected ones.
+            Defaults to 0.3.
+        output (str, optional): Write the report to this JSON file. Defaults to None.
+
+    Returns:
+        dict: The environment, the points of each curve of each head and the fitted exponents.
+    """
+    heads = heads if heads is not None else list(HEADS.keys())
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    base_point = dict(BASE_POINT, **(base_point or {}))
+    device = torch.device(device)
+
+    results = {}
+    for name in heads:
+        _, expected = HEADS[name]
+        results[name] = {}
+        for axis in AXES:
+            if axis not in expected:
+                continue
+            values = sorted(set(grid[axis]) | {base_point[axis]})
+            points = []
+            for value in values:
+                point = dict(base_point, **{axis: value})
+                try:
+                    result = benchmark_head(name, point, device, steps, backward)
+                except Exception as e:
+                    error = "{}: {}".format(type(e).__name__, str(e).strip().split("\n")[0])
+                    points.append({"value": value, "error": error})
+                    print("{} {}={}: failed, {}".format(name, axis, value, error))
+                    break
+                finally:
+                    if device.type == "cuda":
+                        torch.cuda.empty_cache()
+                points.append(dict(result, value=value))
+                if result["time"] > max_time:
+                    break
+            results[name][axis] = _fit_curve(axis, points, expected[axis], tolerance)
+        print(
+            "{}: {}".format(
+                name,
+                ", ".join(
+                    "{} {}".format(axis, curve["flag"])
+                    for axis, curve in results[name].items()
+                    if curve["flag"] != "ok"
+                )
+                or "ok",
+            )
+        )
+
+    report = {
+        "environment": {
+            "device": str(device),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "num_threads": torch.get_num_threads(),
+            "gpu": torch.cuda.get_device_name(device) if device.type == "cuda" else None,
+            "steps": steps,
+            "backward": backward,
+            "base_point": base_point,
+        },
+        "results": results,
+    }
+    print(format_microbench(results))
+    if output is not None:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w", encoding="utf-8") as fout:
+            json.dump(report, fout, indent=2)
+
+    return report
+
+
+def _fit_curve(axis, points, expected, tolerance):
+    """
+    Fit the time and memory exponents of a scaling curve and flag its blow-ups.
+    """
+    ok_points = [point for point in points if "error" not in point]
+    # the cost of the spatial axis goes with the number of positions
+    values = [
+        point["value"] ** 2 if axis == "spatial" else point["value"] for point in ok_points
+    ]
+    time_exponent = fit_exponent(values, [point["time"] for point in ok_points])
+    memory_exponent = fit_exponent(values, [point["peak_memory"] for point in ok_points])
+    # a head that is expected to be linear along the axis is flagged as soon as it is super-linear
+    limit = max(expected, 1) + tolerance
+    blow_ups = [
+        key
+        for key, exponent in [("time", time_exponent), ("memory", memory_exponent)]
+        if exponent is not None and exponent > limit
+    ]
+    if blow_ups:
+        flag = "super-linear {}".format("/".join(blow_ups))
+    elif len(ok_points) < len(points):
+        flag = "failed"
+    else:
+        flag = "ok"
+
+    return {
+        "points": points,
+        "expected_exponent": expected,
+        "time_exponent": time_exponent,
+        "memory_exponent": memory_exponent,
+        "flag": flag,
+    }
+
+
+def format_microbench(results):
+    """
+    Format the curves of a microbenchmark as a table, one row per head and axis.
+    """
+    rows = {}
+    for name, curves in results.items():
+        for axis, curve in curves.items():
+            rows[(name, axis)] = {
+                "values": " ".join(str(point["value"]) for point in curve["points"]),
+                "time (ms)": " ".join(
+                    "{:.2f}".format(point["time"] * 1000)
+                    for point in curve["points"]
+                    if "error" not in point
+                ),
+                "memory (MB)": " ".join(
+                    "{:.1f}".format(point["peak_memory"] / 1024**2)
+                    for point in curve["points"]
+                    if "error" not in point
+                ),
+                "expected": curve["expected_exponent"],
+                "time exp": curve["time_exponent"],
+                "memory exp": curve["memory_exponent"],
+                "flag": curve["flag"],
+            }
+
+    return (
+        pd.DataFrame.from_dict(rows, orient="index")
+        .to_string(float_format="{:.2f}".format, na_rep="-")
+    )
@@ -40,6 +40,28 @@ class AbstractModel(nn.Module):
     def eval(self):
         return super(AbstractModel, self).eval()
 
+    def train_epoch_end(self):
+        """
+        Called by the trainer on every rank when a train epoch ends, or is preempted.
+        """
+        pass
+
+    def get_resume_state(self):
+        """
+        The state of this rank that is kept out of the state dict but needed to resume a train epoch,
+        e.g. per-rank running statistics. Saved by the trainer with a mid-epoch resumable state.
+
+        Returns:
+            object: A picklable state, None if there is none.
+        """
+        return None
+
+    def set_resume_state(self, state):
+        """
+        Restore the state returned by `get_resume_state` on this rank.
+        """
+        pass
+
     def _init_network(self):
         init_weights(self, self.init_type)
 
@@ -92,8 +92,8 @@ class BatchNorm2d_fw(nn.BatchNorm2d): #used in MAML to forward input with fast w
         self.bias.fast = None
 
     def forward(self, x):
-        running_mean = torch.zeros(x.data.size()[1]).cuda()
-        running_var = torch.ones(x.data.size()[1]).cuda()
+        running_mean = torch.zeros(x.data.size()[1], device=x.device)
+        running_var = torch.ones(x.data.size()[1], device=x.device)
         if self.weight.fast is not None and self.bias.fast is not None:
             out = F.batch_norm(x, running_mean, running_var, self.weight.fast, self.bias.fast, training = True, momentum = 1)
             #batch_norm momentum hack: follow hack of Kate Rakelly in pytorch-maml/src/layers.py
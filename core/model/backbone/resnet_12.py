@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from core.model.backbone.utils.checkpoint import checkpoint_module
 from core.model.backbone.utils.dropblock import DropBlock
 
 
@@ -183,6 +184,7 @@ class ResNet(nn.Module):
         dropblock_size=5,
         is_flatten=True,
         maxpool_last2=True,
+        use_checkpoint=False,
     ):
         self.inplanes = 3
         super(ResNet, self).__init__()
@@ -219,6 +221,8 @@ class ResNet(nn.Module):
         self.dropout = nn.Dropout(p=1 - self.keep_prob, inplace=False)
         self.drop_rate = drop_rate
         self.is_flatten = is_flatten
+        # recompute the activations of each layer in backward to save memory
+        self.use_checkpoint = use_checkpoint
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(
@@ -269,10 +273,8 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            x = checkpoint_module(layer, x) if self.use_checkpoint else layer(x)
         if self.keep_avg_pool:
             x = self.avgpool(x)
         if self.is_flatten:
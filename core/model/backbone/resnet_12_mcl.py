@@ -16,8 +16,7 @@ class DropBlock(nn.Module):
             batch_size, channels, height, width = x.shape
             bernoulli = Bernoulli(gamma)
             mask = bernoulli.sample((batch_size, channels, height - (self.block_size - 1), width - (self.block_size - 1)))
-            if torch.cuda.is_available():
-                mask = mask.cuda()
+            mask = mask.to(x.device)
             block_mask = self._compute_block_mask(mask)
             countM = block_mask.size()[0] * block_mask.size()[1] * block_mask.size()[2] * block_mask.size()[3]
             count_ones = block_mask.sum()
@@ -41,8 +40,7 @@ class DropBlock(nn.Module):
             ]
         ).t()
         offsets = torch.cat((torch.zeros(self.block_size**2, 2).long(), offsets.long()), 1)
-        if torch.cuda.is_available():
-            offsets = offsets.cuda()
+        offsets = offsets.to(mask.device)
 
         if nr_blocks > 0:
             non_zero_idxs = non_zero_idxs.repeat(self.block_size ** 2, 1)
@@ -6,6 +6,8 @@ from torch import nn, einsum
 import numpy as np
 from einops import rearrange, repeat
 
+from core.model.backbone.utils.checkpoint import checkpoint_module
+
 
 class CyclicShift(nn.Module):
     def __init__(self, displacement):
@@ -246,8 +248,10 @@ class StageModule(nn.Module):
         head_dim,
         window_size,
         relative_pos_embedding,
+        use_checkpoint=False,
     ):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
         assert (
             layers % 2 == 0
         ), "Stage layers need to be divisible by 2 for regular and shifted block."
@@ -288,8 +292,12 @@ class StageModule(nn.Module):
     def forward(self, x):
         x = self.patch_partition(x)
         for regular_block, shifted_block in self.layers:
-            x = regular_block(x)
-            x = shifted_block(x)
+            if self.use_checkpoint:
+                x = checkpoint_module(regular_block, x)
+                x = checkpoint_module(shifted_block, x)
+            else:
+                x = regular_block(x)
+                x = shifted_block(x)
         return x.permute(0, 3, 1, 2)
 
 
@@ -306,7 +314,8 @@ class SwinTransformer(nn.Module):
         window_size=7,
         downscaling_factors=(4, 2, 2, 2),
         relative_pos_embedding=True,
-        pool=True
+        pool=True,
+        use_checkpoint=False
     ):
         super().__init__()
         self.pool = pool
@@ -320,6 +329,7 @@ class SwinTransformer(nn.Module):
             head_dim=head_dim,
             window_size=window_size,
             relative_pos_embedding=relative_pos_embedding,
+            use_checkpoint=use_checkpoint,
         )
         self.stage2 = StageModule(
             in_channels=hidden_dim,
@@ -330,6 +340,7 @@ class SwinTransformer(nn.Module):
             head_dim=head_dim,
             window_size=window_size,
             relative_pos_embedding=relative_pos_embedding,
+            use_checkpoint=use_checkpoint,
         )
         self.stage3 = StageModule(
             in_channels=hidden_dim * 2,
@@ -340,6 +351,7 @@ class SwinTransformer(nn.Module):
             head_dim=head_dim,
             window_size=window_size,
             relative_pos_embedding=relative_pos_embedding,
+            use_checkpoint=use_checkpoint,
         )
         self.stage4 = StageModule(
             in_channels=hidden_dim * 4,
@@ -350,6 +362,7 @@ class SwinTransformer(nn.Module):
             head_dim=head_dim,
             window_size=window_size,
             relative_pos_embedding=relative_pos_embedding,
+            use_checkpoint=use_checkpoint,
         )
 
         # self.mlp_head = nn.Sequential(
@@ -2,4 +2,5 @@
 from .dropblock import DropBlock
 from .maml_module import convert_maml_module
 from .mtl_module import convert_mtl_module
-from .bdc_pool import BdcPool
\ No newline at end of file
+from .bdc_pool import BdcPool
+from .checkpoint import checkpoint_module
\ No newline at end of file
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+def _get_side_state(module):
+    """Get the state a forward pass updates as a side effect: the running stats of the BN layers and
+    the batch counters of the blocks, e.g. the one resnet12 uses to schedule DropBlock."""
+    state = {}
+    for name, m in module.named_modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            if m.track_running_stats:
+                state[name] = {
+                    "running_mean": m.running_mean.clone(),
+                    "running_var": m.running_var.clone(),
+                    "num_batches_tracked": m.num_batches_tracked.clone(),
+                }
+        elif isinstance(getattr(m, "num_batches_tracked", None), int):
+            state[name] = {"num_batches_tracked": m.num_batches_tracked}
+
+    return state
+
+
+@torch.no_grad()
+def _set_side_state(module, state):
+    modules = dict(module.named_modules())
+    for name, attrs in state.items():
+        for key, value in attrs.items():
+            if isinstance(value, torch.Tensor):
+                getattr(modules[name], key).copy_(value)
+            else:
+                setattr(modules[name], key, value)
+
+
+def checkpoint_module(module, *args):
+    """Call `module(*args)` with activation checkpointing when training.
+
+    The activations inside the module are dropped after the forward pass and recomputed in the
+    backward pass. The recomputation replays the forward pass exactly: the RNG states are restored, so
+    Dropout, DropBlock and DropPath draw the same masks, and it starts from the BN running stats and
+    block counters of the first pass, which are restored after it so they are only updated once.
+
+    Args:
+        module (nn.Module): A block or stage of the backbone.
+        *args: The inputs of the module.
+
+    Returns:
+        The output of the module.
+    """
+    if not (module.training and torch.is_grad_enabled()):
+        return module(*args)
+
+    before = _get_side_state(module)
+    recompute = []
+
+    def run(*inputs):
+        if not recompute:
+            recompute.append(True)
+            return module(*inputs)
+        after = _get_side_state(module)
+        _set_side_state(module, before)
+        try:
+            return module(*inputs)
+        finally:
+            _set_side_state(module, after)
+
+    return checkpoint(run, *args, use_reentrant=False, preserve_rng_state=True)
@@ -6,6 +6,8 @@ from torch import nn
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
 
+from core.model.backbone.utils.checkpoint import checkpoint_module
+
 # helpers
 
 
@@ -73,8 +75,11 @@ class Attention(nn.Module):
 
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout=0.0):
+    def __init__(
+        self, dim, depth, heads, dim_head, mlp_dim, dropout=0.0, use_checkpoint=False
+    ):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(
@@ -93,8 +98,12 @@ class Transformer(nn.Module):
 
     def forward(self, x):
         for attn, ff in self.layers:
-            x = attn(x) + x
-            x = ff(x) + x
+            if self.use_checkpoint:
+                x = checkpoint_module(attn, x) + x
+                x = checkpoint_module(ff, x) + x
+            else:
+                x = attn(x) + x
+                x = ff(x) + x
         return x
 
 
@@ -112,7 +121,8 @@ class ViT(nn.Module):
         channels=3,
         dim_head=64,
         dropout=0.0,
-        emb_dropout=0.0
+        emb_dropout=0.0,
+        use_checkpoint=False
     ):
         super().__init__()
         image_height, image_width = pair(image_size)
@@ -142,7 +152,9 @@ class ViT(nn.Module):
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
         self.dropout = nn.Dropout(emb_dropout)
 
-        self.transformer = Transformer(dim, depth, heads, dim_head, mlp_dim, dropout)
+        self.transformer = Transformer(
+            dim, depth, heads, dim_head, mlp_dim, dropout, use_checkpoint
+        )
 
         self.pool = pool
         # self.to_latent = nn.Identity()
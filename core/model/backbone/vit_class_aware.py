@@ -20,6 +20,7 @@ import torch.nn as nn
 from functools import partial
 
 # from .utils import trunc_normal_
+from core.model.backbone.utils.checkpoint import checkpoint_module
 from timm.models.registry import register_model
 import warnings
 
@@ -233,8 +234,11 @@ class VisionTransformer(nn.Module):
         init_values=0,
         use_mean_pooling=False,
         masked_im_modeling=False,
+        use_checkpoint=False,
     ):
         super().__init__()
+        # recompute the activations of each block in backward to save memory
+        self.use_checkpoint = use_checkpoint
         self.num_features = self.embed_dim = embed_dim
         self.return_all_tokens = return_all_tokens
 
@@ -343,7 +347,7 @@ class VisionTransformer(nn.Module):
             x = self.prepare_tokens(x)
 
         for blk in self.blocks:
-            x = blk(x)
+            x = checkpoint_module(blk, x) if self.use_checkpoint else blk(x)
 
         x = self.norm(x)
         if self.fc_norm is not None:
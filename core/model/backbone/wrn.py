@@ -7,6 +7,8 @@ from torch import nn
 import math
 import torch.nn.functional as F
 
+from core.model.backbone.utils.checkpoint import checkpoint_module
+
 
 class BasicBlock(nn.Module):
     def __init__(self, in_planes, out_planes, stride, dropRate=0.0):
@@ -59,11 +61,21 @@ class BasicBlock(nn.Module):
 
 
 class NetworkBlock(nn.Module):
-    def __init__(self, nb_layers, in_planes, out_planes, block, stride, dropRate=0.0):
+    def __init__(
+        self,
+        nb_layers,
+        in_planes,
+        out_planes,
+        block,
+        stride,
+        dropRate=0.0,
+        use_checkpoint=False,
+    ):
         super(NetworkBlock, self).__init__()
         self.layer = self._make_layer(
             block, in_planes, out_planes, nb_layers, stride, dropRate
         )
+        self.use_checkpoint = use_checkpoint
 
     def _make_layer(self, block, in_planes, out_planes, nb_layers, stride, dropRate):
         layers = []
@@ -79,12 +91,22 @@ class NetworkBlock(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        return self.layer(x)
+        if not self.use_checkpoint:
+            return self.layer(x)
+        for block in self.layer:
+            x = checkpoint_module(block, x)
+        return x
 
 
 class WideResNet(nn.Module):
     def __init__(
-        self, depth, widen_factor=1, dropRate=0.0, is_flatten=True, avg_pool=True
+        self,
+        depth,
+        widen_factor=1,
+        dropRate=0.0,
+        is_flatten=True,
+        avg_pool=True,
+        use_checkpoint=False,
     ):
         super(WideResNet, self).__init__()
         self.is_flatten = is_flatten
@@ -103,11 +125,17 @@ class WideResNet(nn.Module):
             3, nChannels[0], kernel_size=3, stride=1, padding=1, bias=False
         )
         # 1st block
-        self.block1 = NetworkBlock(n, nChannels[0], nChannels[1], block, 1, dropRate)
+        self.block1 = NetworkBlock(
+            n, nChannels[0], nChannels[1], block, 1, dropRate, use_checkpoint
+        )
         # 2nd block
-        self.block2 = NetworkBlock(n, nChannels[1], nChannels[2], block, 2, dropRate)
+        self.block2 = NetworkBlock(
+            n, nChannels[1], nChannels[2], block, 2, dropRate, use_checkpoint
+        )
         # 3rd block
-        self.block3 = NetworkBlock(n, nChannels[2], nChannels[3], block, 2, dropRate)
+        self.block3 = NetworkBlock(
+            n, nChannels[2], nChannels[3], block, 2, dropRate, use_checkpoint
+        )
         # global average pooling and classifier
         self.bn1 = nn.BatchNorm2d(nChannels[3])
         self.relu = nn.ReLU(inplace=True)
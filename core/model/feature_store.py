@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+
+# the header of a feature store: magic, version, num_class, feat_dim
+FEATURE_STORE_MAGIC = b"LFSFEAT\0"
+FEATURE_STORE_VERSION = 1
+_HEADER = np.dtype(
+    [("magic", "S8"), ("version", "<u4"), ("num_class", "<u4"), ("feat_dim", "<u4")]
+)
+# pad the header so that the counts and the means are 64-byte aligned
+_HEADER_SIZE = 64
+
+
+def save_feature_store(path, means, counts):
+    """
+    Save the class-mean features of a pretraining to a feature store.
+
+    The store is a header (magic, version, num_class, feat_dim) followed by the int64 counts of
+    samples of the classes and the float32 [num_class, feat_dim] means, so `load_feature_store` can
+    memory-map it. It is written to a temporary file and renamed, a reader never maps a partial store.
+
+    Args:
+        path (str): The path of the store.
+        means (np.ndarray): The class means, [num_class, feat_dim].
+        counts (np.ndarray): The number of samples of each class, [num_class].
+    """
+    num_class, feat_dim = means.shape
+    header = np.zeros(1, dtype=_HEADER)
+    header[0] = (FEATURE_STORE_MAGIC, FEATURE_STORE_VERSION, num_class, feat_dim)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes().ljust(_HEADER_SIZE, b"\0"))
+        f.write(np.ascontiguousarray(counts, dtype="<i8").tobytes())
+        f.write(np.ascontiguousarray(means, dtype="<f4").tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_feature_store(path, with_counts=False):
+    """
+    Memory-map the class-mean features of a feature store.
+
+    A plain `.npy` array of the means, the format before the feature store, is memory-mapped as well.
+
+    Args:
+        path (str): The path of the store.
+        with_counts (bool, optional): Also return the counts of the classes, None for a `.npy` array.
+            Defaults to False.
+
+    Returns:
+        np.ndarray: The copy-on-write mapped means [num_class, feat_dim], and the counts with `with_counts`.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(FEATURE_STORE_MAGIC))
+    if magic != FEATURE_STORE_MAGIC:
+        means = np.load(path, mmap_mode="c")
+        return (means, None) if with_counts else means
+
+    header = np.fromfile(path, dtype=_HEADER, count=1)[0]
+    assert (
+        header["version"] == FEATURE_STORE_VERSION
+    ), "the feature store {} has version {}, expect {}".format(
+        path, header["version"], FEATURE_STORE_VERSION
+    )
+    num_class, feat_dim = int(header["num_class"]), int(header["feat_dim"])
+    counts = np.memmap(path, dtype="<i8", mode="c", offset=_HEADER_SIZE, shape=(num_class,))
+    means = np.memmap(
+        path,
+        dtype="<f4",
+        mode="c",
+        offset=_HEADER_SIZE + counts.nbytes,
+        shape=(num_class, feat_dim),
+    )
+    return (means, counts) if with_counts else means
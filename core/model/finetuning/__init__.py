@@ -10,4 +10,5 @@ from .renet import RENet
 from .deepbdc_pretrain import DeepBDC_Pretrain
 from .s2m2 import S2M2
 from .frn_pretrain import FRN_Pretrain
-from .metabaseline_pretrain import MetabaselinePretrain
\ No newline at end of file
+from .metabaseline_pretrain import MetabaselinePretrain
+from .matchingnetifsl_pretrain import IfslPretrain
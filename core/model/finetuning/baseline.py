@@ -21,6 +21,7 @@ import torch
 from torch import nn
 
 from core.utils import accuracy
+from .batch_heads import BatchLinear
 from .finetuning_model import FinetuningModel
 
 
@@ -47,16 +48,9 @@ class Baseline(FinetuningModel):
         support_feat, query_feat, support_target, query_target = self.split_by_episode(
             feat, mode=1
         )
-        episode_size = support_feat.size(0)
-
-        output_list = []
-        for i in range(episode_size):
-            output = self.set_forward_adaptation(
-                support_feat[i], support_target[i], query_feat[i]
-            )
-            output_list.append(output)
-
-        output = torch.cat(output_list, dim=0)
+        output = self.set_forward_adaptation(
+            support_feat, support_target, query_feat
+        ).reshape(-1, self.way_num)
         acc = accuracy(output, query_target.reshape(-1))
 
         return output, acc
@@ -77,29 +71,16 @@ class Baseline(FinetuningModel):
         return output, acc, loss
 
     def set_forward_adaptation(self, support_feat, support_target, query_feat):
-        classifier = nn.Linear(self.feat_dim, self.way_num)
-        optimizer = self.sub_optimizer(classifier, self.inner_param["inner_optim"])
-
-        classifier = classifier.to(self.device)
-
-        classifier.train()
-        support_size = support_feat.size(0)
-        for epoch in range(self.inner_param["inner_train_iter"]):
-            rand_id = torch.randperm(support_size)
-            for i in range(0, support_size, self.inner_param["inner_batch_size"]):
-                select_id = rand_id[
-                    i : min(i + self.inner_param["inner_batch_size"], support_size)
-                ]
-                batch = support_feat[select_id]
-                target = support_target[select_id]
-
-                output = classifier(batch)
-
-                loss = self.loss_func(output, target)
-
-                optimizer.zero_grad()
-                loss.backward(retain_graph=True)
-                optimizer.step()
+        episode_size = support_feat.size(0)
+        classifier = BatchLinear(episode_size, self.feat_dim, self.way_num).to(self.device)
+        self.train_batch_head(
+            classifier,
+            support_feat,
+            support_target,
+            self.inner_param["inner_optim"],
+            self.inner_param["inner_train_iter"],
+            self.inner_param["inner_batch_size"],
+        )
 
         output = classifier(query_feat)
         return output
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import math
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class BatchLinear(nn.Module):
+    """
+    One `nn.Linear` per episode, the weights of the episodes are stacked and applied with bmm.
+    """
+
+    def __init__(self, episode_size, in_features, out_features):
+        super(BatchLinear, self).__init__()
+        # the initialization of nn.Linear, kaiming_uniform_(a=sqrt(5)) gives the same bound
+        bound = 1 / math.sqrt(in_features)
+        self.weight = nn.Parameter(
+            torch.empty(episode_size, out_features, in_features).uniform_(-bound, bound)
+        )
+        self.bias = nn.Parameter(
+            torch.empty(episode_size, out_features).uniform_(-bound, bound)
+        )
+
+    def forward(self, x, target=None):
+        # x: [episode_size, n, in_features] -> [episode_size, n, out_features]
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+
+class BatchDistLinear(nn.Module):
+    """
+    One weight-normed cosine classifier (`DistLinear` of Baseline++, `distLinear` of S2M2) per episode.
+    """
+
+    def __init__(self, episode_size, in_features, out_features):
+        super(BatchDistLinear, self).__init__()
+        bound = 1 / math.sqrt(in_features)
+        weight_v = torch.empty(episode_size, out_features, in_features).uniform_(
+            -bound, bound
+        )
+        # split the weight update component to direction and norm, as weight_norm(dim=0) does
+        self.weight_v = nn.Parameter(weight_v)
+        self.weight_g = nn.Parameter(weight_v.norm(p=2, dim=2, keepdim=True))
+        self.scale_factor = 2 if out_features <= 200 else 10
+
+    def forward(self, x, target=None):
+        x_normalized = x.div(x.norm(p=2, dim=2, keepdim=True) + 0.00001)
+        weight = self.weight_g * self.weight_v / self.weight_v.norm(p=2, dim=2, keepdim=True)
+        cos_dist = torch.bmm(x_normalized, weight.transpose(1, 2))
+        return self.scale_factor * cos_dist
+
+
+class BatchNegLayer(nn.Module):
+    """
+    One negative margin cosine classifier (`NegLayer` of NegNet) per episode.
+    """
+
+    def __init__(
+        self, episode_size, in_features, out_features, margin=0.40, scale_factor=30.0
+    ):
+        super(BatchNegLayer, self).__init__()
+        self.margin = margin
+        self.scale_factor = scale_factor
+        bound = 1 / math.sqrt(in_features)
+        self.weight = nn.Parameter(
+            torch.empty(episode_size, out_features, in_features).uniform_(-bound, bound)
+        )
+
+    def forward(self, x, target=None):
+        cosine = torch.bmm(
+            F.normalize(x, dim=2), F.normalize(self.weight, dim=2).transpose(1, 2)
+        )
+        # when test, no label, just return
+        if target is None:
+            return cosine * self.scale_factor
+
+        one_hot = F.one_hot(target, cosine.size(2)).bool()
+        output = torch.where(one_hot, cosine - self.margin, cosine)
+        return output * self.scale_factor
@@ -12,14 +12,12 @@ Adapted from https://github.com/Fei-Long121/DeepBDC
 
 import torch
 from torch import nn
-import numpy as np
 import copy
 from core.utils import accuracy
 import torch.nn.functional as F
 from .finetuning_model import FinetuningModel
+from .logistic_regression import BatchLogisticRegression
 from ..metric.deepbdc import ProtoLayer
-from sklearn import metrics
-from sklearn.linear_model import LogisticRegression
 from .. import DistillKLLoss
 
 
@@ -41,6 +39,8 @@ class DistillLayer(nn.Module):
         )
 
         self.dropout = nn.Dropout(dropout_rate)
+        # a TeacherLogitCache, set by the trainer with `teacher_cache`
+        self.cache = None
 
 
     def _load_state_dict(self, model, state_dict_path, is_distill):
@@ -52,14 +52,18 @@ class DistillLayer(nn.Module):
         return new_model
 
     @torch.no_grad()
-    def forward(self, x):
+    def forward(self, x, key=None):
         output = None
-        if self.emb_func is not None and self.classifier is not None:
-            output = self.emb_func(x)
-            output = self.dropout(output)
-            output = self.classifier(output)
+        if self.emb_func is not None and self.cls_classifier is not None:
+            if self.cache is not None and key is not None:
+                output = self.cache.lookup(key, x, self._teacher)
+            else:
+                output = self._teacher(x)
         return output
 
+    def _teacher(self, x):
+        return self.cls_classifier(self.dropout(self.emb_func(x)))
+
 
 
 class DeepBDC_Pretrain(FinetuningModel):
@@ -138,36 +142,18 @@ class DeepBDC_Pretrain(FinetuningModel):
         )
         # support_feat -- [t, ws, c],       query_feat -- [t, wq, c], 
         # support_target -- [t, ws],        query_feat -- [t, wq]
-        episode_size = support_feat.size(0)
-
-        output_list = []
-        acc_list = []
-        for idx in range(episode_size):
-            SF = support_feat[idx]      # [ws, c]
-            QF = query_feat[idx]        # [ws, c]
-            ST = support_target[idx].reshape(-1)
-            QT = query_target[idx].reshape(-1)
-
-            classifier = self.set_forward_adaptation(SF, ST)
-
-            QF = F.normalize(QF, p=2, dim=1).detach().cpu().numpy()
-            QT = QT.detach().cpu().numpy()
+        classifier = self.set_forward_adaptation(support_feat, support_target)
 
-            output = classifier.predict(QF)
-            acc = metrics.accuracy_score(QT, output) * 100
-
-            output_list.append(output)
-            acc_list.append(acc)
-
-        output = np.stack(output_list, axis=0)
-        acc = sum(acc_list) / episode_size
+        query_feat = F.normalize(query_feat, p=2, dim=-1)
+        output = classifier.decision_function(query_feat).reshape(-1, self.way_num)
+        acc = accuracy(output, query_target.reshape(-1))
         return output, acc
 
 
     def set_forward_loss(self, batch):
         """
         """
-        image, target = batch
+        image, target = batch[:2]
         image = image.to(self.device)
         target = target.to(self.device)
 
@@ -176,7 +162,9 @@ class DeepBDC_Pretrain(FinetuningModel):
         output = self.classifier(output)
 
         if self.is_distill:
-            distill_output = self.distill_layer(image)
+            # the keys of the teacher-logit cache
+            key = batch[2] if len(batch) > 2 else None
+            distill_output = self.distill_layer(image, key)
             loss = 0.5 * self.ce_loss_fn(output, target) \
                     + 0.5 * self.kl_loss_fn(output, distill_output)
         else:
@@ -187,18 +175,10 @@ class DeepBDC_Pretrain(FinetuningModel):
 
 
     def set_forward_adaptation(self, support_feat, support_target):
-        classifier = LogisticRegression(
-            random_state=0,
-            solver="lbfgs",
-            C=self.penalty_C,
-            max_iter=1000,
-            penalty="l2",
-            multi_class="multinomial",
-        )
-        support_feat = F.normalize(support_feat, p=2, dim=1).detach().cpu().numpy()
-        support_target = support_target.detach().cpu().numpy()
+        classifier = BatchLogisticRegression(C=self.penalty_C, max_iter=1000)
 
-        classifier.fit(support_feat, support_target)
+        support_feat = F.normalize(support_feat, p=2, dim=-1)
+        classifier.fit(support_feat, support_target, self.way_num)
 
         return classifier
 
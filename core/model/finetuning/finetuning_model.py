@@ -2,6 +2,7 @@
 from abc import abstractmethod
 
 import torch
+from torch.nn import functional as F
 
 from core.model.abstract_model import AbstractModel
 from core.utils import ModelType
@@ -29,3 +30,57 @@ class FinetuningModel(AbstractModel):
         if config["kwargs"] is not None:
             kwargs.update(config["kwargs"])
         return getattr(torch.optim, config["name"])(model.parameters(), **kwargs)
+
+    def train_batch_head(
+        self, classifier, support_feat, support_target, optim_config, train_iter, batch_size
+    ):
+        """
+        Train the heads of all episodes of a batch at once on their support features.
+
+        Each epoch goes through the support samples of every episode in its own random order, in
+        mini-batches of `batch_size`. The loss is the sum of the mean cross entropy of the episodes, so
+        each head gets the gradient of its own loss, and an element-wise optimizer from `sub_optimizer`
+        (SGD, Adam, ...) steps the stacked weights as separate optimizers would step each head.
+
+        Args:
+            classifier (nn.Module): A batched head, e.g. `BatchLinear`, called as classifier(x, target).
+            support_feat (torch.Tensor): [episode_size, support_size, feat_dim].
+            support_target (torch.Tensor): [episode_size, support_size].
+            optim_config (dict): The name and kwargs of the optimizer.
+            train_iter (int): The number of epochs.
+            batch_size (int): The mini-batch size of each episode.
+
+        Returns:
+            nn.Module: The trained classifier.
+        """
+        optimizer = self.sub_optimizer(classifier, optim_config)
+        classifier.train()
+        episode_size, support_size, _ = support_feat.size()
+        episode_idx = torch.arange(episode_size, device=support_feat.device).unsqueeze(1)
+        support_feat = support_feat.detach()
+
+        with torch.enable_grad():
+            for epoch in range(train_iter):
+                rand_id = torch.rand(
+                    episode_size, support_size, device=support_feat.device
+                ).argsort(dim=1)
+                for i in range(0, support_size, batch_size):
+                    select_id = rand_id[:, i : i + batch_size]
+                    batch = support_feat[episode_idx, select_id]
+                    target = support_target[episode_idx, select_id]
+
+                    output = classifier(batch, target)
+                    loss = (
+                        F.cross_entropy(
+                            output.reshape(-1, output.size(-1)),
+                            target.reshape(-1),
+                            reduction="sum",
+                        )
+                        / target.size(1)
+                    )
+
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+
+        return classifier
@@ -16,6 +16,7 @@ import torch.nn.functional as F
 import numpy as np
 from core.utils import accuracy
 from .finetuning_model import FinetuningModel
+from ..solver import ridge_hat
 
 
 class FRNLayer(nn.Module):
@@ -57,10 +58,11 @@ class FRNLayer(nn.Module):
         return log_prediction
         pass
 
-    def get_recon_dist(self, query, support, alpha, beta, Woodbury=True):
+    def get_recon_dist(self, query, support, alpha, beta, Woodbury=None):
         # query: n, way*query_shot*resolution, d
         # support: n, way, shot*resolution, d
-        # Woodbury: whether to use the Woodbury Identity as the implementation or not
+        # Woodbury: whether to use the Woodbury Identity (Equation 10, a d*d system) or Equation 8 (a
+        # shot*resolution square system), None for the smaller system
 
         # correspond to kr/d in the paper
         reg = support.size(1) / support.size(2)
@@ -71,25 +73,9 @@ class FRNLayer(nn.Module):
         # correspond to gamma in the paper
         rho = beta.exp()
 
-        st = support.permute(0, 2, 1)  # n, way, d, shot*resolution
-
-        if Woodbury:
-            # correspond to Equation 10 in the paper
-
-            sts = st.matmul(support)  # n, way, d, d
-            m_inv = (
-                sts + torch.eye(sts.size(-1)).to(sts.device).unsqueeze(0).mul(lam)
-            ).inverse()  # n, way, d, d
-            hat = m_inv.matmul(sts)  # n, way, d, d
-
-        else:
-            # correspond to Equation 8 in the paper
-
-            sst = support.matmul(st)  # n, way, shot*resolution, shot*resolution
-            m_inv = (
-                sst + torch.eye(sst.size(-1)).to(sst.device).unsqueeze(0).mul(lam)
-            ).inverse()  # n, way, shot*resolution, shot*resolutionsf
-            hat = st.matmul(m_inv).matmul(support)  # n, way, d, d
+        hat = ridge_hat(
+            support, lam, dual=None if Woodbury is None else not Woodbury
+        )  # n, way, d, d
 
         Q_bar = query.matmul(hat).mul(rho)  # n, way, way*query_shot*resolution, d
 
@@ -120,7 +106,7 @@ class FRN_Pretrain(FinetuningModel):
         print(kwargs)
         super(FRN_Pretrain, self).__init__(**kwargs)
         self.frn_layer = FRNLayer(self.num_cat, self.num_channel)
-        self.loss_func = nn.NLLLoss().cuda()
+        self.loss_func = nn.NLLLoss()
 
     def set_forward(self, batch):
         image, global_target = batch
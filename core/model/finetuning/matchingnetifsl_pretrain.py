@@ -1,7 +1,9 @@
 import torch
+import torch.distributed as dist
 from torch import nn
-import numpy as np
 
+from core.utils import accuracy
+from ..feature_store import save_feature_store
 from .finetuning_model import FinetuningModel
 
 
@@ -18,9 +20,9 @@ class IfslPretrain(FinetuningModel):
         self.classifier = nn.Linear(self.feat_dim, self.num_class)
         self.classifier=self._load_state_dict(self.classifier,cls_classifier_path)
         self.loss_func = nn.CrossEntropyLoss()
-        self.features = np.zeros((self.num_class, self.feat_dim))
-        self.temp_features = np.zeros((self.num_class, self.feat_dim))
-        self.counts = np.zeros((self.num_class))
+        # the running sums of the features of each class, accumulated on the device
+        self.register_buffer("feature_sum", torch.zeros(self.num_class, self.feat_dim), persistent=False)
+        self.register_buffer("feature_count", torch.zeros(self.num_class), persistent=False)
 
 
     def _load_state_dict(self, model, state_dict_path):
@@ -56,18 +58,50 @@ class IfslPretrain(FinetuningModel):
         if self.norm is True:
             feat=self.normalize(feat)
         if self.featuring is True:
-            fs = feat.detach().cpu().numpy()
-            ids=target.detach().cpu().numpy()
-            for i in range(ids.shape[0]):
-                self.temp_features[ids[i]]+=fs[i]
-                self.counts[ids[i]]+=1
-            for i in range(self.num_class):
-                if self.counts[i]>0:
-                    self.features[i]=self.temp_features[i]/self.counts[i]
-            np.save(self.feature_path,self.features)
+            with torch.no_grad():
+                self.feature_sum.index_add_(0, target, feat.detach().to(self.feature_sum.dtype))
+                self.feature_count.index_add_(
+                    0, target, torch.ones_like(target, dtype=self.feature_count.dtype)
+                )
         loss =(0 if self.featuring is True else 1.0) * self.loss_func(output, target)
-        acc = 100 * torch.count_nonzero(torch.argmax(output, dim=1) == target).detach().cpu().item() / target.size(0)
+        acc = accuracy(output, target)
         return output, acc, loss
 
+    def train_epoch_end(self):
+        # store the class means when a train epoch ends
+        if self.featuring is True:
+            self.save_features()
+
+    def get_resume_state(self):
+        # the sums of this rank, the buffers are not persistent as each rank has its own
+        return {
+            "feature_sum": self.feature_sum.cpu(),
+            "feature_count": self.feature_count.cpu(),
+        }
+
+    def set_resume_state(self, state):
+        self.feature_sum.copy_(state["feature_sum"])
+        self.feature_count.copy_(state["feature_count"])
+
+    def save_features(self):
+        """
+        Save the running class means of the features to the feature store at `feature_path`.
+        """
+        feature_sum, feature_count = self.feature_sum, self.feature_count
+        if dist.is_initialized():
+            feature_sum, feature_count = feature_sum.clone(), feature_count.clone()
+            dist.all_reduce(feature_sum)
+            dist.all_reduce(feature_count)
+            if dist.get_rank() != 0:
+                return
+        # a model that has not trained on any sample, e.g. a freshly built one, never overwrites the store
+        if not feature_count.any():
+            return
+        # the classes without samples keep zero features
+        means = feature_sum / feature_count.clamp(min=1).unsqueeze(1)
+        save_feature_store(
+            self.feature_path, means.cpu().numpy(), feature_count.long().cpu().numpy()
+        )
+
     def set_forward_adaptation(self):
         pass
@@ -20,71 +20,14 @@ from torch import nn
 import torch.nn.functional as F
 from core.utils import accuracy
 from .finetuning_model import FinetuningModel
-from itertools import combinations
-import random
+from ..kendall import MAX_CHUNK_NUMEL, kendall_ranking_correlation_for_batches
 
-def compute_c_pair(c):
-    return list(combinations(list(range(c)), 2))
-
-def diffkendall(support, query, c_pair, beta=1, T=0.0125):
-    '''The differentiable Kendall's rank correlation.'''
-    support_prank = support[:, c_pair].diff().squeeze()
-    query_prank = query[:, c_pair].diff().squeeze(-1)
-    score = support_prank.repeat([query.shape[0], 1, 1]) * query_prank.unsqueeze(1).repeat([1, support.shape[0], 1])
-    score = 1 / (1 + (-score * beta).exp())
-    score = 2 * score - 1
-    score = score.mean(dim=-1)
-    score = score / T
-    return score
-
-def diffkendall_for_batches(support, query, beta=1, T=0.0125):
-    c = support.shape[-1]
-    c_pair = compute_c_pair(c)
-    batches = support.shape[0]
-    scores = [diffkendall(support[i], query[i], c_pair, beta, T) for i in range(batches)]
-    return torch.stack(scores)
-
-def kendall_ranking_correlation(support, query, c_pair):
-    '''Kendall's rank correlation.'''
-    support_prank = support[:, c_pair].diff(dim=-1).sign().squeeze()
-    query_prank = query[:, c_pair].diff(dim=-1).sign().squeeze()
-    score = torch.mm(query_prank, support_prank.T)
-    return score / len(c_pair)
-
-def kendall_ranking_correlation_for_batches(support, query):
-    c = support.shape[-1]
-    c_pair = compute_c_pair(c)
-    batches = support.shape[0]
-    
-    scores = [kendall_ranking_correlation(support[i], query[i], c_pair) for i in range(batches)]
-    return torch.stack(scores)
-
-
-
-# def compute_c_pair(c):
-#     return list(combinations(list(range(c)), 2))
-
-# def kendall_ranking_correlation(support, query, c_pair):
-#     '''Kendall's rank correlation.'''
-#     support_prank = support[:, c_pair].diff(dim=-1).sign().squeeze()
-#     query_prank = query[:, c_pair].diff(dim=-1).sign().squeeze()
-#     score = torch.mm(query_prank, support_prank.T)
-#     return score / len(c_pair)
-
-# def kendall_ranking_correlation_for_batches(support, query):
-#     c = support.shape[-1]
-#     c_pair = compute_c_pair(c)
-#     c_pair_tensor = torch.tensor(c_pair, dtype=torch.long)
-#     support_prank = support[:, :, c_pair_tensor].diff(dim=-1).sign()
-#     query_prank = query[:, :, c_pair_tensor].diff(dim=-1).sign()
-#     support_prank = support_prank.view(support.shape[0], -1, len(c_pair))
-#     query_prank = query_prank.view(query.shape[0], -1, len(c_pair))
-#     scores = torch.bmm(query_prank, support_prank.transpose(1, 2)) / len(c_pair)
-#     return scores
 
 class ProtoLayer(nn.Module):
-    def __init__(self):
+    def __init__(self, num_pairs=None, max_chunk_numel=MAX_CHUNK_NUMEL):
         super(ProtoLayer, self).__init__()
+        self.num_pairs = num_pairs
+        self.max_chunk_numel = max_chunk_numel
 
     def forward(
         self,
@@ -105,17 +48,26 @@ class ProtoLayer(nn.Module):
                 torch.transpose(F.normalize(y, p=2, dim=-1), -1, -2)
                 # FEAT did not normalize the query_feat
             ),
-            "kendall":lambda x, y: kendall_ranking_correlation_for_batches(y, x)
+            "kendall": lambda x, y: kendall_ranking_correlation_for_batches(
+                y, x, self.num_pairs, self.max_chunk_numel
+            ),
         }[mode](query_feat, proto_feat)
         
 class MetabaselineKendallPretrain(FinetuningModel):
-    def __init__(self, feat_dim, num_class, **kwargs):
+    def __init__(
+        self,
+        feat_dim,
+        num_class,
+        num_pairs=None,
+        max_chunk_numel=MAX_CHUNK_NUMEL,
+        **kwargs
+    ):
         super(MetabaselineKendallPretrain, self).__init__(**kwargs)
         self.feat_dim = feat_dim
         self.num_class = num_class
 
         self.classifier = nn.Linear(self.feat_dim, self.num_class)
-        self.proto_layer = ProtoLayer()
+        self.proto_layer = ProtoLayer(num_pairs, max_chunk_numel)
         self.loss_func = nn.CrossEntropyLoss()
 
     def set_forward(self, batch):
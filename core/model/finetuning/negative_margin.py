@@ -13,6 +13,7 @@ from torch import nn
 
 from core.utils import accuracy
 from torch.nn import Parameter
+from .batch_heads import BatchNegLayer
 from .finetuning_model import FinetuningModel
 import math
 from torch.optim.lr_scheduler import _LRScheduler
@@ -63,51 +64,29 @@ class NegNet(FinetuningModel):
         support_feat, query_feat, support_target, query_target = self.split_by_episode(
             feat, mode=1
         )
-        episode_size = support_feat.size(0)
-        # support_target = support_target.reshape(episode_size, self.way_num*self.shot_num)
-
-        output_list = []
-        for i in range(episode_size):
-            output = self.set_forward_adaptation(
-                support_feat[i], support_target[i], query_feat[i]
-            )
-            output_list.append(output)
-
-        output = torch.cat(output_list, dim=0)
+        output = self.set_forward_adaptation(
+            support_feat, support_target, query_feat
+        ).reshape(-1, self.test_way)
         acc = accuracy(output, query_target.reshape(-1))
         return output, acc
 
     def set_forward_adaptation(self, support_feat, support_target, query_feat):
-        classifier = NegLayer(
+        episode_size = support_feat.size(0)
+        classifier = BatchNegLayer(
+            episode_size,
             self.feat_dim,
             self.test_way,
             self.inner_param["inner_margin"],
             self.inner_param["inner_scale_factor"],
+        ).to(self.device)
+        self.train_batch_head(
+            classifier,
+            support_feat,
+            support_target,
+            self.inner_param["inner_optim"],
+            self.inner_param["inner_train_iter"],
+            4,
         )
-        optimizer = self.sub_optimizer(classifier, self.inner_param["inner_optim"])
-
-        classifier = classifier.to(self.device)
-        classifier.train()
-
-        loss_func = nn.CrossEntropyLoss()
-
-        support_size = support_feat.size(0)
-        batch_size = 4
-        for epoch in range(self.inner_param["inner_train_iter"]):
-            rand_id = torch.randperm(support_size)
-            for i in range(0, support_size, batch_size):
-                select_id = rand_id[i : min(i + batch_size, support_size)]
-                batch = support_feat[select_id]
-                target = support_target[select_id]
-                # print("target:")
-                # print(target)
-                output = classifier(batch, target)
-
-                loss = loss_func(output, target)
-
-                optimizer.zero_grad()
-                loss.backward(retain_graph=True)  # retain_graph = True
-                optimizer.step()
 
         output = classifier(query_feat)
         return output
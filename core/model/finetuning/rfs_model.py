@@ -23,15 +23,13 @@ Adapted from https://github.com/WangYueFt/rfs.
 """
 import copy
 
-import numpy as np
 import torch
-from sklearn import metrics
-from sklearn.linear_model import LogisticRegression
 from torch import nn
 from torch.nn import functional as F
 
 from core.utils import accuracy
 from .finetuning_model import FinetuningModel
+from .logistic_regression import BatchLogisticRegression
 from .. import DistillKLLoss
 
 
@@ -48,6 +46,8 @@ class DistillLayer(nn.Module):
         super(DistillLayer, self).__init__()
         self.emb_func = self._load_state_dict(emb_func, emb_func_path, is_distill)
         self.classifier = self._load_state_dict(classifier, classifier_path, is_distill)
+        # a TeacherLogitCache, set by the trainer with `teacher_cache`
+        self.cache = None
 
     def _load_state_dict(self, model, state_dict_path, is_distill):
         new_model = None
@@ -58,13 +58,18 @@ class DistillLayer(nn.Module):
         return new_model
 
     @torch.no_grad()
-    def forward(self, x):
+    def forward(self, x, key=None):
         output = None
         if self.emb_func is not None and self.classifier is not None:
-            output = self.emb_func(x)
-            output = self.classifier(output)
+            if self.cache is not None and key is not None:
+                output = self.cache.lookup(key, x, self._teacher)
+            else:
+                output = self._teacher(x)
         return output
 
+    def _teacher(self, x):
+        return self.classifier(self.emb_func(x))
+
 
 class RFSModel(FinetuningModel):
     def __init__(
@@ -115,29 +120,11 @@ class RFSModel(FinetuningModel):
         support_feat, query_feat, support_target, query_target = self.split_by_episode(
             feat, mode=1
         )
-        episode_size = support_feat.size(0)
-
-        output_list = []
-        acc_list = []
-        for idx in range(episode_size):
-            SF = support_feat[idx]
-            QF = query_feat[idx]
-            ST = support_target[idx]
-            QT = query_target[idx]
-
-            classifier = self.set_forward_adaptation(SF, ST)
-
-            QF = F.normalize(QF, p=2, dim=1).detach().cpu().numpy()
-            QT = QT.detach().cpu().numpy()
-
-            output = classifier.predict(QF)
-            acc = metrics.accuracy_score(QT, output) * 100
+        classifier = self.set_forward_adaptation(support_feat, support_target)
 
-            output_list.append(output)
-            acc_list.append(acc)
-
-        output = np.stack(output_list, axis=0)
-        acc = sum(acc_list) / episode_size
+        query_feat = F.normalize(query_feat, p=2, dim=-1)
+        output = classifier.decision_function(query_feat).reshape(-1, self.way_num)
+        acc = accuracy(output, query_target.reshape(-1))
         return output, acc
 
     def set_forward_loss(self, batch):
@@ -146,13 +133,18 @@ class RFSModel(FinetuningModel):
         :param batch:
         :return:
         """
-        image, global_target = batch
+        image, global_target = batch[:2]
         image = image.to(self.device)
         global_target = global_target.to(self.device)
 
         feat = self.emb_func(image)
         output = self.classifier(feat)
-        distill_output = self.distill_layer(image)
+        # the teacher is skipped without a distillation loss
+        distill_output = None
+        if self.alpha != 0:
+            # the keys of the teacher-logit cache
+            key = batch[2] if len(batch) > 2 else None
+            distill_output = self.distill_layer(image, key)
 
         gamma_loss = self.ce_loss_func(output, global_target)
         alpha_loss = self.kl_loss_func(output, distill_output)
@@ -163,18 +155,9 @@ class RFSModel(FinetuningModel):
         return output, acc, loss
 
     def set_forward_adaptation(self, support_feat, support_target):
-        classifier = LogisticRegression(
-            penalty="l2",
-            random_state=0,
-            C=1.0,
-            solver="lbfgs",
-            max_iter=1000,
-            multi_class="multinomial",
-        )
-
-        support_feat = F.normalize(support_feat, p=2, dim=1).detach().cpu().numpy()
-        support_target = support_target.detach().cpu().numpy()
+        classifier = BatchLogisticRegression(C=1.0, max_iter=1000)
 
-        classifier.fit(support_feat, support_target)
+        support_feat = F.normalize(support_feat, p=2, dim=-1)
+        classifier.fit(support_feat, support_target, self.way_num)
 
         return classifier
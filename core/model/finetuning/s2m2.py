@@ -5,7 +5,8 @@ from re import T
 import torch
 from torch import nn
 
-from core.utils import accuracy
+from core.utils import accuracy, rotate_images
+from .batch_heads import BatchDistLinear
 from .finetuning_model import FinetuningModel
 from torch.nn.utils.weight_norm import WeightNorm
 import numpy as np
@@ -57,14 +58,9 @@ class S2M2(FinetuningModel):
 
 
         support_feat, query_feat, support_target, query_target = self.split_by_episode(feat, mode=1)
-        episode_size = support_feat.size(0)
-
-        output_list = []
-        for i in range(episode_size):
-            output = self.set_forward_adaptation(support_feat[i], support_target[i], query_feat[i])
-            output_list.append(output)
-
-        output = torch.cat(output_list, dim=0)
+        output = self.set_forward_adaptation(
+            support_feat, support_target, query_feat
+        ).reshape(-1, self.test_way)
 
 
         acc = accuracy(output, query_target.reshape(-1))
@@ -107,53 +103,21 @@ class S2M2(FinetuningModel):
         return output, acc, loss_re
 
     def set_forward_adaptation(self, support_feat, support_target, query_feat):
-        classifier = distLinear(self.feat_dim, self.test_way)
-        optimizer = self.sub_optimizer(classifier, self.inner_param["inner_optim"])
-
-        classifier = classifier.to(self.device)
-
-        classifier.train()
-        support_size = support_feat.size(0)
-
-        for epoch in range(self.inner_param["inner_train_iter"]):
-            rand_id = torch.randperm(support_size)
-            for i in range(0, support_size, self.inner_param["inner_batch_size"]):
-                optimizer.zero_grad()
-                select_id = rand_id[i : min(i + self.inner_param["inner_batch_size"], support_size)]
-                batch = support_feat[select_id]
-                target = support_target[select_id]
-                #print(batch.size())
-                output = classifier(batch)
-
-                loss = self.loss_func(output, target)
-
-
-                loss.backward()
-                optimizer.step()
+        episode_size = support_feat.size(0)
+        classifier = BatchDistLinear(episode_size, self.feat_dim, self.test_way).to(self.device)
+        self.train_batch_head(
+            classifier,
+            support_feat,
+            support_target,
+            self.inner_param["inner_optim"],
+            self.inner_param["inner_train_iter"],
+            self.inner_param["inner_batch_size"],
+        )
 
         output = classifier(query_feat)
         return output
     
-    def  rot_image_generation(self, image, target): 
-        bs=image.shape[0]
-        indices = np.arange(bs)
-        np.random.shuffle(indices)
-        split_size=bs//4
-        image_rot=[]
-        target_class =[]
-        target_rot_class=[]
-
-        for j in indices[0:split_size]:
-            x90 = image[j].transpose(2,1).flip(1)
-            x180 = x90.transpose(2,1).flip(1)
-            x270 =  x180.transpose(2,1).flip(1)
-            image_rot += [image[j], x90, x180, x270]
-            target_class += [target[j] for _ in range(4)]
-            target_rot_class += [torch.tensor(0),torch.tensor(1),torch.tensor(2),torch.tensor(3)]
-        image_rot =torch.stack(image_rot,0).to(self.device)
-        target_class =torch.stack(target_class,0).to(self.device)
-        target_rot_class=torch.stack(target_rot_class,0).to(self.device)
-        image_rot=torch.tensor(image_rot).to(self.device)
-        target_class=torch.tensor(target_class).to(self.device)
-        target_rot_class=torch.tensor(target_rot_class).to(self.device)
-        return image_rot,target_class,target_rot_class
\ No newline at end of file
+    def rot_image_generation(self, image, target):
+        # the 4 rotations of a random quarter of the batch
+        index = torch.randperm(image.size(0), device=image.device)[: image.size(0) // 4]
+        return rotate_images(image[index], target[index])
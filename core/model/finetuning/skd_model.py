@@ -21,15 +21,13 @@ Adapted from https://github.com/brjathu/SKD.
 
 import copy
 
-import numpy as np
 import torch
-from sklearn import metrics
-from sklearn.linear_model import LogisticRegression
 from torch import nn
 from torch.nn import functional as F
 
-from core.utils import accuracy
+from core.utils import accuracy, rotate_images
 from .finetuning_model import FinetuningModel
+from .logistic_regression import BatchLogisticRegression
 from .. import DistillKLLoss
 from core.model.loss import L2DistLoss
 
@@ -49,6 +47,8 @@ class DistillLayer(nn.Module):
         self.cls_classifier = self._load_state_dict(
             cls_classifier, cls_classifier_path, is_distill
         )
+        # a TeacherLogitCache, set by the trainer with `teacher_cache`
+        self.cache = None
 
     def _load_state_dict(self, model, state_dict_path, is_distill):
         new_model = None
@@ -59,14 +59,19 @@ class DistillLayer(nn.Module):
         return new_model
 
     @torch.no_grad()
-    def forward(self, x):
+    def forward(self, x, key=None):
         output = None
         if self.emb_func is not None and self.cls_classifier is not None:
-            output = self.emb_func(x)
-            output = self.cls_classifier(output)
+            if self.cache is not None and key is not None:
+                output = self.cache.lookup(key, x, self._teacher)
+            else:
+                output = self._teacher(x)
 
         return output
 
+    def _teacher(self, x):
+        return self.cls_classifier(self.emb_func(x))
+
 
 class SKDModel(FinetuningModel):
     def __init__(
@@ -119,29 +124,11 @@ class SKDModel(FinetuningModel):
         support_feat, query_feat, support_target, query_target = self.split_by_episode(
             feat, mode=1
         )
-        episode_size = support_feat.size(0)
-
-        output_list = []
-        acc_list = []
-        for idx in range(episode_size):
-            SF = support_feat[idx]
-            QF = query_feat[idx]
-            ST = support_target[idx].reshape(-1)
-            QT = query_target[idx].reshape(-1)
-
-            classifier = self.set_forward_adaptation(SF, ST)
-
-            QF = F.normalize(QF, p=2, dim=1).detach().cpu().numpy()
-            QT = QT.detach().cpu().numpy()
+        classifier = self.set_forward_adaptation(support_feat, support_target)
 
-            output = classifier.predict(QF)
-            acc = metrics.accuracy_score(QT, output) * 100
-
-            output_list.append(output)
-            acc_list.append(acc)
-
-        output = np.stack(output_list, axis=0)
-        acc = sum(acc_list) / episode_size
+        query_feat = F.normalize(query_feat, p=2, dim=-1)
+        output = classifier.decision_function(query_feat).reshape(-1, self.way_num)
+        acc = accuracy(output, query_target.reshape(-1))
         return output, acc
 
     def set_forward_loss(self, batch):
@@ -150,7 +137,7 @@ class SKDModel(FinetuningModel):
         :param batch:
         :return:
         """
-        image, target = batch
+        image, target = batch[:2]
         image = image.to(self.device)
         target = target.to(self.device)
 
@@ -162,7 +149,12 @@ class SKDModel(FinetuningModel):
 
         feat = self.emb_func(generated_image)
         output = self.cls_classifier(feat)
-        distill_output = self.distill_layer(image)
+        # the teacher is skipped without a distillation loss
+        distill_output = None
+        if self.is_distill and self.gamma != 0:
+            # the keys of the teacher-logit cache
+            key = batch[2] if len(batch) > 2 else None
+            distill_output = self.distill_layer(image, key)
 
         if self.is_distill:
             gamma_loss = self.kl_loss_func(output[:batch_size], distill_output)
@@ -181,46 +173,17 @@ class SKDModel(FinetuningModel):
         return output, acc, loss
 
     def set_forward_adaptation(self, support_feat, support_target):
-        classifier = LogisticRegression(
-            random_state=0,
-            solver="lbfgs",
-            max_iter=1000,
-            penalty="l2",
-            multi_class="multinomial",
-        )
+        classifier = BatchLogisticRegression(max_iter=1000)
 
-        support_feat = F.normalize(support_feat, p=2, dim=1).detach().cpu().numpy()
-        support_target = support_target.detach().cpu().numpy()
-
-        classifier.fit(support_feat, support_target)
+        support_feat = F.normalize(support_feat, p=2, dim=-1)
+        classifier.fit(support_feat, support_target, self.way_num)
 
         return classifier
 
     def rot_image_generation(self, image, target):
-        batch_size = image.size(0)
-        images_90 = image.transpose(2, 3).flip(2)
-        images_180 = image.flip(2).flip(3)
-        images_270 = image.flip(2).transpose(2, 3)
-
         if self.is_distill:
-            generated_image = torch.cat((image, images_180), dim=0)
-            generated_target = target.repeat(2)
-
-            rot_target = torch.zeros(batch_size * 4)
-            rot_target[batch_size:] += 1
-            rot_target = rot_target.long().to(self.device)
-        else:
-            generated_image = torch.cat(
-                [image, images_90, images_180, images_270], dim=0
-            )
-            generated_target = target.repeat(4)
-
-            rot_target = torch.zeros(batch_size * 4)
-            rot_target[batch_size:] += 1
-            rot_target[batch_size * 2 :] += 1
-            rot_target[batch_size * 3 :] += 1
-            rot_target = (
-                F.one_hot(rot_target.to(torch.int64), 4).float().to(self.device)
-            )
+            # the rotation targets are not used by the distillation
+            return rotate_images(image, target, rotations=(0, 2))
 
-        return generated_image, generated_target, rot_target
+        generated_image, generated_target, rot_target = rotate_images(image, target)
+        return generated_image, generated_target, F.one_hot(rot_target, 4).float()
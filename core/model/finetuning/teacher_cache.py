@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import torch
+import yaml
+
+
+def get_teacher_cache_path(cache_dir, config):
+    """
+    Get the directory of the teacher-logit cache of a distillation run.
+
+    It is keyed by the classifier config (the teacher checkpoints are among its kwargs) with the
+    modification time of the checkpoints, the train split and its augmentation, so that a new teacher
+    or a changed augmentation is cached again.
+
+    Args:
+        cache_dir (str): The root directory of the teacher caches.
+        config (dict): Parsed config file.
+
+    Returns:
+        str: The cache directory of the run.
+    """
+    kwargs = config["classifier"]["kwargs"] or {}
+    mtimes = {
+        k: os.path.getmtime(v)
+        for k, v in kwargs.items()
+        if k.endswith("_path") and isinstance(v, str) and os.path.exists(v)
+    }
+    key = yaml.dump(
+        {
+            "classifier": config["classifier"],
+            "mtimes": mtimes,
+            "data_root": os.path.abspath(config["data_root"]),
+            "image_size": config["image_size"],
+            "augment": config["augment"],
+            "augment_method": config.get("augment_method"),
+            "augment_times": config["augment_times"],
+            "teacher_cache_seeds": config["teacher_cache_seeds"],
+        }
+    )
+    return os.path.join(
+        cache_dir,
+        "{}-{}".format(
+            config["classifier"]["name"], hashlib.md5(key.encode()).hexdigest()[:8]
+        ),
+    )
+
+
+class TeacherLogitCache(object):
+    """
+    The fp16 logits of a distillation teacher for each (image index, augmentation seed) of the train split.
+
+    The cache holds `logits.npy`, the [num_keys, num_class] fp16 logits, and `filled.npy`, whether the
+    logits of each key are computed. A key is `index * teacher_cache_seeds + seed`, the train collate
+    function augments each image deterministically from its key (see `GeneralCollateFunction`), so the
+    teacher sees the same image for a key in every epoch. The teacher only runs on the keys missing
+    from the cache, whose logits it fills in.
+    """
+
+    def __init__(self, cache_path, num_keys, num_class):
+        """
+        Args:
+            cache_path (str): The cache directory, created if it does not exist yet.
+            num_keys (int): The number of (image index, augmentation seed) keys.
+            num_class (int): The number of classes of the teacher.
+        """
+        if not os.path.exists(cache_path):
+            # allocate the memmaps in a temporary directory, concurrent ranks never open a partial cache
+            tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+            os.makedirs(tmp_path, exist_ok=True)
+            try:
+                np.lib.format.open_memmap(
+                    os.path.join(tmp_path, "logits.npy"),
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(num_keys, num_class),
+                ).flush()
+                np.lib.format.open_memmap(
+                    os.path.join(tmp_path, "filled.npy"),
+                    mode="w+",
+                    dtype=np.bool_,
+                    shape=(num_keys,),
+                ).flush()
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                # another rank allocated the same cache first
+                if not os.path.exists(cache_path):
+                    raise
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        self.cache_path = cache_path
+        self.logits = np.load(os.path.join(cache_path, "logits.npy"), mmap_mode="r+")
+        self.filled = np.load(os.path.join(cache_path, "filled.npy"), mmap_mode="r+")
+        assert self.logits.shape == (
+            num_keys,
+            num_class,
+        ), "the teacher cache {} holds {} logits, expect {}".format(
+            cache_path, self.logits.shape, (num_keys, num_class)
+        )
+
+    @torch.no_grad()
+    def lookup(self, keys, x, teacher):
+        """
+        Get the teacher logits of a batch, running the teacher on the images missing from the cache.
+
+        The computed logits are rounded to fp16 as the cached ones, so the output does not depend on
+        which keys were cached.
+
+        Args:
+            keys (torch.Tensor): The keys of the images, [batch_size].
+            x (torch.Tensor): The images, [batch_size, C, H, W].
+            teacher (callable): Maps images to the teacher logits.
+
+        Returns:
+            torch.Tensor: The teacher logits, [batch_size, num_class].
+        """
+        keys = keys.cpu().numpy()
+        hit = torch.from_numpy(self.filled[keys].copy())
+        output = torch.empty(len(keys), self.logits.shape[1], device=x.device)
+
+        if hit.any():
+            output[hit.to(x.device)] = torch.from_numpy(
+                self.logits[keys[hit.numpy()]].astype(np.float32)
+            ).to(x.device)
+        if not hit.all():
+            miss = ~hit
+            logits = teacher(x[miss.to(x.device)]).half()
+            output[miss.to(x.device)] = logits.float()
+            self.logits[keys[miss.numpy()]] = logits.cpu().numpy()
+            self.filled[keys[miss.numpy()]] = True
+
+        return output
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Batched Kendall's rank correlations of DiffKendall (MetaBaselineKendall and its pretraining).
+
+Both correlations compare the channels of the features pairwise, c * (c - 1) / 2 pairs (about 204k
+for the 640-dim ResNet-12 features). The pairs are taken in chunks over all the episodes at once, so
+the [episode, query, support, pairs] intermediate stays within `max_chunk_numel` elements.
+"""
+from functools import lru_cache
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# 2 ** 25 fp32 elements, 128MB of each intermediate of a chunk
+MAX_CHUNK_NUMEL = 2 ** 25
+
+
+@lru_cache(maxsize=None)
+def get_pair_index(c, device):
+    """
+    Get the channel pairs (i, j), i < j, in the order of `itertools.combinations(range(c), 2)`.
+
+    Args:
+        c (int): The number of channels.
+        device (torch.device): The device of the indices.
+
+    Returns:
+        tuple: The first and the second channels of the pairs, two [c * (c - 1) / 2] LongTensors.
+    """
+    i, j = torch.triu_indices(c, c, 1, device=device)
+    return i, j
+
+
+def _get_pairs(c, device, num_pairs):
+    i, j = get_pair_index(c, device)
+    if num_pairs is not None and num_pairs < i.size(0):
+        # a random subset of the pairs for an approximate score
+        sample = torch.randperm(i.size(0), device=device)[:num_pairs]
+        i, j = i[sample], j[sample]
+    return i, j
+
+
+def _chunks(num_pairs, numel_per_pair, max_chunk_numel):
+    chunk_size = max(1, max_chunk_numel // numel_per_pair)
+    for start in range(0, num_pairs, chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+def _diffkendall_chunk(support, query, i, j, beta):
+    # t, w, p and t, wq, p
+    support_prank = support[..., j] - support[..., i]
+    query_prank = query[..., j] - query[..., i]
+    # t, wq, w, p -> t, wq, w
+    score = torch.sigmoid(beta * query_prank.unsqueeze(2) * support_prank.unsqueeze(1))
+    return (2 * score - 1).sum(-1)
+
+
+def diffkendall_for_batches(
+    support, query, beta=1, T=0.0125, num_pairs=None, max_chunk_numel=MAX_CHUNK_NUMEL
+):
+    """
+    The differentiable Kendall's rank correlation, the mean of 2 * sigmoid(beta * ds * dq) - 1 over the
+    channel pairs of a support and a query feature.
+
+    With gradients, each chunk is recomputed in the backward pass instead of keeping its intermediate.
+
+    Args:
+        support (torch.Tensor): The support features (prototypes), [t, w, c].
+        query (torch.Tensor): The query features, [t, wq, c].
+        beta (float, optional): The sharpness of the sigmoid. Defaults to 1.
+        T (float, optional): The temperature the score is divided by. Defaults to 0.0125.
+        num_pairs (int, optional): Score a random subset of num_pairs pairs. Defaults to None, all pairs.
+        max_chunk_numel (int, optional): The number of elements of the intermediate of a chunk of pairs.
+            Defaults to MAX_CHUNK_NUMEL.
+
+    Returns:
+        torch.Tensor: The scores, [t, wq, w].
+    """
+    t, wq, c = query.size()
+    w = support.size(1)
+    i, j = _get_pairs(c, query.device, num_pairs)
+    grad = torch.is_grad_enabled() and (support.requires_grad or query.requires_grad)
+
+    score = 0
+    for chunk in _chunks(i.size(0), t * wq * w, max_chunk_numel):
+        if grad:
+            score = score + checkpoint(
+                _diffkendall_chunk, support, query, i[chunk], j[chunk], beta, use_reentrant=False
+            )
+        else:
+            score = score + _diffkendall_chunk(support, query, i[chunk], j[chunk], beta)
+
+    return score / i.size(0) / T
+
+
+def kendall_ranking_correlation_for_batches(
+    support, query, num_pairs=None, max_chunk_numel=MAX_CHUNK_NUMEL
+):
+    """
+    Kendall's rank correlation, the mean of sign(ds) * sign(dq) over the channel pairs of a support and a
+    query feature.
+
+    Args:
+        support (torch.Tensor): The support features (prototypes), [t, w, c].
+        query (torch.Tensor): The query features, [t, wq, c].
+        num_pairs (int, optional): Score a random subset of num_pairs pairs. Defaults to None, all pairs.
+        max_chunk_numel (int, optional): The number of elements of the intermediate of a chunk of pairs.
+            Defaults to MAX_CHUNK_NUMEL.
+
+    Returns:
+        torch.Tensor: The correlations, [t, wq, w].
+    """
+    t, wq, c = query.size()
+    w = support.size(1)
+    i, j = _get_pairs(c, query.device, num_pairs)
+
+    score = 0
+    for chunk in _chunks(i.size(0), t * (wq + w), max_chunk_numel):
+        support_prank = (support[..., j[chunk]] - support[..., i[chunk]]).sign()
+        query_prank = (query[..., j[chunk]] - query[..., i[chunk]]).sign()
+        # t, wq, p - t, p, w -> t, wq, w
+        score = score + torch.bmm(query_prank, support_prank.transpose(1, 2))
+
+    return score / i.size(0)
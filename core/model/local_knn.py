@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+The image-to-class k-nearest-neighbour search over local descriptors of DN4 and ADM.
+
+Each query descriptor keeps its n_k most similar descriptors of each class. The similarities are
+computed in tiles of query descriptors and chunks of support descriptors, merged into a running
+top-k, so the full [t, wq, way, hw, shot * hw] relation is never materialized.
+
+For many-way/many-shot evaluation, `Int8DescriptorIndex` answers the same queries approximately
+from int8 descriptors, and `KNNIndexReport` measures it against the exact search.
+"""
+import torch
+
+# 2 ** 25 fp32 elements, 128MB of relation per tile
+MAX_CHUNK_NUMEL = 2 ** 25
+
+
+def local_topk(query, support, n_k, max_chunk_numel=MAX_CHUNK_NUMEL, return_index=False):
+    """
+    The n_k largest similarities of each query descriptor to the descriptors of each class.
+
+    The values, and their gradients, are the ones of `torch.topk` on the full relation. When the
+    relation fits in `max_chunk_numel` it is computed in one tile, as before the tiling.
+
+    Args:
+        query (torch.Tensor): The query descriptors, [t, wq, hw, c].
+        support (torch.Tensor): The support descriptors of each class, transposed, [t, way, c, shw].
+        n_k (int): The number of neighbours.
+        max_chunk_numel (int, optional): The number of elements of the relation of a tile.
+            Defaults to MAX_CHUNK_NUMEL.
+        return_index (bool, optional): Also return the indices of the neighbours. Defaults to False.
+
+    Returns:
+        torch.Tensor: The similarities, in descending order, [t, wq, way, hw, n_k], and the indices of
+            the neighbours among the shw descriptors of their class with `return_index`.
+    """
+    t, wq, hw, _ = query.size()
+    _, way, _, shw = support.size()
+    numel = t * wq * way
+    # tile the query descriptors first, the support descriptors are only chunked, and merged into the
+    # running top-k, when the relation of a single query descriptor exceeds the budget
+    query_chunk = min(hw, max(1, max_chunk_numel // (numel * shw)))
+    support_chunk = min(shw, max(n_k, max_chunk_numel // (numel * query_chunk)))
+
+    # t, wq, 1, hw, c - t, 1, way, c, shw
+    query = query.unsqueeze(2)
+    support = support.unsqueeze(1)
+
+    topk_values, topk_indices = [], []
+    for q_start in range(0, hw, query_chunk):
+        query_tile = query[:, :, :, q_start : q_start + query_chunk]
+        topk_value, topk_index = None, None
+        for s_start in range(0, shw, support_chunk):
+            # t, wq, way, hw_tile, s_chunk
+            relation = torch.matmul(
+                query_tile, support[..., s_start : s_start + support_chunk]
+            )
+            index = None
+            if return_index:
+                index = torch.arange(
+                    s_start, s_start + relation.size(-1), device=relation.device
+                ).expand_as(relation)
+            if topk_value is not None:
+                relation = torch.cat([topk_value, relation], dim=-1)
+                if return_index:
+                    index = torch.cat([topk_index, index], dim=-1)
+            topk_value, position = torch.topk(relation, n_k, dim=-1)
+            if return_index:
+                topk_index = index.gather(-1, position)
+        topk_values.append(topk_value)
+        topk_indices.append(topk_index)
+
+    if len(topk_values) == 1:
+        topk_value = topk_values[0]
+    else:
+        topk_value = torch.cat(topk_values, dim=3)
+        if return_index:
+            topk_index = torch.cat(topk_indices, dim=3)
+
+    if return_index:
+        return topk_value, topk_index
+    return topk_value
+
+
+def quantize_int8(x, dim=-1):
+    """
+    The symmetric int8 quantization of vectors, each scaled by its own max-abs value.
+
+    Args:
+        x (torch.Tensor): The vectors.
+        dim (int, optional): The dim of the vector elements. Defaults to -1.
+
+    Returns:
+        tuple: The int8 values, and the fp32 scales (keeping `dim` as a singleton) so that x ~ values * scales.
+    """
+    scale = x.detach().abs().amax(dim, keepdim=True).clamp_min(1e-12).float() / 127
+    return torch.round(x.detach() / scale).to(torch.int8), scale
+
+
+def _int8_matmul(a, b):
+    # torch._int_mm multiplies int8 matrices into int32 on CUDA, under its shape constraints
+    if (
+        a.is_cuda
+        and hasattr(torch, "_int_mm")
+        and a.size(0) > 16
+        and a.size(1) % 8 == 0
+        and b.size(1) % 8 == 0
+    ):
+        return torch._int_mm(a, b).float()
+    # elsewhere the int8 values are multiplied as floats, the products are exact up to 2 ** 24
+    return torch.matmul(a.float(), b.float())
+
+
+class Int8DescriptorIndex(object):
+    """
+    An eval-time brute-force index of the support descriptors of a batch of episodes, stored in int8.
+
+    The query descriptors are quantized as well, and the similarities of a tile of them to the
+    descriptors of all the classes of an episode are one int8 matrix product. The similarities, and
+    thus the neighbours, are approximate; they carry no gradients.
+    """
+
+    def __init__(self, support):
+        """
+        Args:
+            support (torch.Tensor): The support descriptors of each class, transposed, [t, way, c, shw].
+        """
+        t, way, c, shw = support.size()
+        self.way_num = way
+        self.shw = shw
+        # t, c, way * shw
+        self.support, self.scale = quantize_int8(
+            support.permute(0, 2, 1, 3).reshape(t, c, way * shw), dim=1
+        )
+
+    def topk(self, query, n_k, max_chunk_numel=MAX_CHUNK_NUMEL):
+        """
+        The approximate n_k largest similarities of each query descriptor to the descriptors of each class.
+
+        Args:
+            query (torch.Tensor): The query descriptors, [t, wq, hw, c].
+            n_k (int): The number of neighbours.
+            max_chunk_numel (int, optional): The number of elements of the relation of a tile.
+                Defaults to MAX_CHUNK_NUMEL.
+
+        Returns:
+            tuple: The similarities, in descending order, and the indices of the neighbours among the shw
+                descriptors of their class, both [t, wq, way, hw, n_k].
+        """
+        t, wq, hw, c = query.size()
+        query = query.reshape(t, wq * hw, c)
+        query_chunk = max(1, max_chunk_numel // (self.way_num * self.shw))
+
+        topk_values, topk_indices = [], []
+        for i in range(t):
+            values, indices = [], []
+            for start in range(0, wq * hw, query_chunk):
+                query_int8, query_scale = quantize_int8(
+                    query[i, start : start + query_chunk]
+                )
+                # hw_tile, way * shw
+                relation = (
+                    _int8_matmul(query_int8, self.support[i])
+                    * query_scale
+                    * self.scale[i]
+                )
+                value, index = torch.topk(
+                    relation.view(-1, self.way_num, self.shw), n_k, dim=-1
+                )
+                values.append(value)
+                indices.append(index)
+            topk_values.append(torch.cat(values))
+            topk_indices.append(torch.cat(indices))
+
+        # t, wq * hw, way, n_k -> t, wq, way, hw, n_k
+        topk_value = torch.stack(topk_values).view(t, wq, hw, self.way_num, n_k)
+        topk_index = torch.stack(topk_indices).view(t, wq, hw, self.way_num, n_k)
+        return (
+            topk_value.permute(0, 1, 3, 2, 4).to(query.dtype),
+            topk_index.permute(0, 1, 3, 2, 4),
+        )
+
+
+class KNNIndexReport(object):
+    """
+    The recall of the neighbours found by an approximate descriptor index, and the accuracy of the
+    scores computed from them, against the exact search, accumulated over the test episodes.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n_k = 0
+        self.hits = 0
+        self.neighbours = 0
+        self.correct = 0
+        self.exact_correct = 0
+        self.agree = 0
+        self.queries = 0
+
+    @torch.no_grad()
+    def update(self, topk_index, exact_index, output, exact_output, target):
+        """
+        Args:
+            topk_index (torch.Tensor): The neighbours found by the index, [..., n_k].
+            exact_index (torch.Tensor): The exact neighbours, [..., n_k].
+            output (torch.Tensor): The scores from the index, [t, wq, way].
+            exact_output (torch.Tensor): The exact scores, [t, wq, way].
+            target (torch.Tensor): The query targets, broadcastable to [t, wq].
+        """
+        self.n_k = exact_index.size(-1)
+        self.hits += int(
+            (topk_index.unsqueeze(-1) == exact_index.unsqueeze(-2)).any(-1).sum()
+        )
+        self.neighbours += exact_index.numel()
+
+        pred = output.argmax(-1)
+        exact_pred = exact_output.argmax(-1)
+        self.correct += int((pred == target).sum())
+        self.exact_correct += int((exact_pred == target).sum())
+        self.agree += int((pred == exact_pred).sum())
+        self.queries += pred.numel()
+
+    def summary(self):
+        """
+        Returns:
+            str: The recall@n_k of the neighbours, and the accuracy with the index and with the exact search.
+        """
+        return "recall@{} {:.4f}\tAcc@1 {:.3f} (exact {:.3f})\tagreement {:.4f}".format(
+            self.n_k,
+            self.hits / max(self.neighbours, 1),
+            100.0 * self.correct / max(self.queries, 1),
+            100.0 * self.exact_correct / max(self.queries, 1),
+            self.agree / max(self.queries, 1),
+        )
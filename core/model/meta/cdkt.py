@@ -37,7 +37,6 @@ class CDKT(MetaModel):
         self.feat_dim = self.feature.final_feat_dim
         self.change_way = True
 
-        self.device = 'cuda:0'
         ## GP parameters
         self.leghtscale_list = None
         self.noise_list = None
@@ -59,7 +58,7 @@ class CDKT(MetaModel):
         self.get_loss(loss)
 
     def parse_feature(self, x, is_feature):
-        x = Variable(x.cuda())
+        x = Variable(x.to(self.device))
         if is_feature:
             z_all = x
         else:
@@ -77,16 +76,16 @@ class CDKT(MetaModel):
         # z_query = z_query.contiguous().view(abs(self.n_way * self.n_query), -1)
 
         y_support = torch.from_numpy(np.repeat(range(self.n_way), self.n_support))
-        y_support = Variable(y_support.cuda())
+        y_support = Variable(y_support.to(self.device))
 
         linear_clf = nn.Linear(self.feat_dim, self.n_way)
-        linear_clf = linear_clf.cuda()
+        linear_clf = linear_clf.to(self.device)
 
         set_optimizer = torch.optim.SGD(linear_clf.parameters(), lr=0.01, momentum=0.9, dampening=0.9,
                                         weight_decay=0.001)
 
         loss_function = nn.CrossEntropyLoss()
-        loss_function = loss_function.cuda()
+        loss_function = loss_function.to(self.device)
 
         batch_size = 4
         support_size = self.n_way * self.n_support
@@ -94,7 +93,7 @@ class CDKT(MetaModel):
             rand_id = np.random.permutation(support_size)
             for i in range(0, support_size, batch_size):
                 set_optimizer.zero_grad()
-                selected_id = torch.from_numpy(rand_id[i: min(i + batch_size, support_size)]).cuda()
+                selected_id = torch.from_numpy(rand_id[i: min(i + batch_size, support_size)]).to(self.device)
                 z_batch = z_support[selected_id]
                 y_batch = y_support[selected_id]
                 scores = linear_clf(z_batch)
@@ -165,7 +165,8 @@ class FullyContextualEmbedding(nn.Module):
         super(FullyContextualEmbedding, self).__init__()
         self.lstmcell = nn.LSTMCell(feat_dim * 2, feat_dim)
         self.softmax = nn.Softmax(dim=1)
-        self.c_0 = Variable(torch.zeros(1, feat_dim))
+        # a buffer to follow the module across devices, not saved for compatible checkpoints
+        self.register_buffer("c_0", torch.zeros(1, feat_dim), persistent=False)
         self.feat_dim = feat_dim
 
     def forward(self, f, G):
@@ -182,19 +183,13 @@ class FullyContextualEmbedding(nn.Module):
             h = h + f
         return h
 
-    def cuda(self):
-        super(FullyContextualEmbedding, self).cuda()
-        self.c_0 = self.c_0.cuda()
-        self.lstmcell = self.lstmcell.cuda()
-        return self
-
 
 class MatchingNetLayer(nn.Module):
     def __init__(self, feat_dim):
         super(MatchingNetLayer, self).__init__()
         self.feat_dim = feat_dim
-        self.FCE = FullyContextualEmbedding(self.feat_dim).cuda()
-        self.G_encoder = nn.LSTM(self.feat_dim, self.feat_dim, 1, batch_first=True, bidirectional=True).cuda()
+        self.FCE = FullyContextualEmbedding(self.feat_dim)
+        self.G_encoder = nn.LSTM(self.feat_dim, self.feat_dim, 1, batch_first=True, bidirectional=True)
 
     def forward(self, support, query):
         G_encoder = self.G_encoder
@@ -205,12 +200,6 @@ class MatchingNetLayer(nn.Module):
         F = FCE(query, G)
         return G, F
 
-    def cuda(self):
-        super(MatchingNetLayer, self).cuda()
-        self.FCE = self.FCE.cuda()
-        self.G_encoder = self.G_encoder.cuda()
-        return self
-
 
 class DMatchingNet(MetaModel):
     def __init__(self, inner_param, feat_dim, ifsl_param, **kwargs):
@@ -230,15 +219,15 @@ class DMatchingNet(MetaModel):
             self.single = False
         if self.single is True:
             self.feat_dim = self.utils.get_feat_dim()
-            self.blocks = nn.ModuleList([MatchingNetLayer(self.feat_dim).cuda() for i in range(self.n_splits)])
+            self.blocks = nn.ModuleList([MatchingNetLayer(self.feat_dim) for i in range(self.n_splits)])
         else:
             x_feat_dim = int(self.feat_dim / self.n_splits)
             if self.d_feature == "pd":
                 d_feat_dim = self.num_classes
             else:
                 d_feat_dim = x_feat_dim
-            self.x_blocks = nn.ModuleList([MatchingNetLayer(x_feat_dim).cuda() for i in range(self.n_splits)])
-            self.d_blocks = nn.ModuleList([MatchingNetLayer(d_feat_dim).cuda() for i in range(self.n_splits)])
+            self.x_blocks = nn.ModuleList([MatchingNetLayer(x_feat_dim) for i in range(self.n_splits)])
+            self.d_blocks = nn.ModuleList([MatchingNetLayer(d_feat_dim) for i in range(self.n_splits)])
         convert_maml_module(self)
 
     def set_forward(self, batch):
@@ -280,7 +269,7 @@ class DMatchingNet(MetaModel):
                         self.utils.normalize(query_x_new).mm(self.utils.normalize(support_x_new).transpose(0, 1)))
                     d_score = self.relu(
                         self.utils.normalize(query_d_new).mm(self.utils.normalize(support_d_new).transpose(0, 1)))
-                    c_x_scores = torch.ones_like(x_score).cuda()
+                    c_x_scores = torch.ones_like(x_score)
                     if self.use_x_only:
                         scores[j] = x_score * self.temp
                         c_scores[j] = c_x_scores * self.temp
@@ -291,7 +280,7 @@ class DMatchingNet(MetaModel):
                 scores = scores - c_scores
             scores = self.softmax(scores)
             labels = torch.from_numpy(np.repeat(range(self.way_num),self.shot_num))
-            labels = Variable(self.utils.one_hot(labels, self.way_num)).cuda()
+            labels = Variable(self.utils.one_hot(labels, self.way_num)).to(self.device)
             proba = scores.mean(dim=0)
             logprobs = (proba.mm(labels) + 1e-6).log()
             output_list.append(logprobs)
@@ -339,7 +328,7 @@ class DMatchingNet(MetaModel):
                         self.utils.normalize(query_x_new).mm(self.utils.normalize(support_x_new).transpose(0, 1)))
                     d_score = self.relu(
                         self.utils.normalize(query_d_new).mm(self.utils.normalize(support_d_new).transpose(0, 1)))
-                    c_x_scores = torch.ones_like(x_score).cuda()
+                    c_x_scores = torch.ones_like(x_score)
                     if self.use_x_only:
                         scores[j] = x_score * self.temp
                         c_scores[j] = c_x_scores * self.temp
@@ -350,7 +339,7 @@ class DMatchingNet(MetaModel):
                 scores = scores - c_scores
             scores = self.softmax(scores)
             labels = torch.from_numpy(np.repeat(range(self.way_num), self.shot_num))
-            labels = Variable(self.utils.one_hot(labels,self.way_num)).cuda()
+            labels = Variable(self.utils.one_hot(labels,self.way_num)).to(self.device)
             proba = scores.mean(dim=0)
             logprobs = (proba.mm(labels) + 1e-6).log()
             output_list.append(logprobs)
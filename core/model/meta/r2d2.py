@@ -20,6 +20,7 @@ from torch import nn
 
 from core.utils import accuracy
 from .meta_model import MetaModel
+from ..solver import ridge_solve
 
 
 def computeGramMatrix(A, B):
@@ -42,23 +43,6 @@ def computeGramMatrix(A, B):
     return torch.bmm(A, B.transpose(1, 2))
 
 
-def binv(b_mat):
-    """
-    Computes an inverse of each matrix in the batch.
-    Pytorch 0.4.1 does not support batched matrix inverse.
-    Hence, we are solving AX=I.
-
-    Parameters:
-      b_mat:  a (n_batch, n, n) Tensor.
-    Returns: a (n_batch, n, n) Tensor.
-    """
-
-    id_matrix = b_mat.new_ones(b_mat.size(-1)).diag().expand_as(b_mat).to(b_mat.device)
-    b_inv, _ = torch.solve(id_matrix, b_mat)
-
-    return b_inv
-
-
 def one_hot(indices, depth):
     """
     Returns a one-hot tensor.
@@ -107,18 +91,9 @@ class R2D2Layer(nn.Module):
             tasks_per_batch, n_support, way_num
         )
 
-        id_matrix = (
-            torch.eye(n_support)
-            .expand(tasks_per_batch, n_support, n_support)
-            .to(query.device)
-        )
-
-        # Compute the dual form solution of the ridge regression.
-        # W = X^T(X X^T - lambda * I)^(-1) Y
-        ridge_sol = computeGramMatrix(support, support) + self.gamma * id_matrix
-        ridge_sol = binv(ridge_sol)
-        ridge_sol = torch.bmm(support.transpose(1, 2), ridge_sol)
-        ridge_sol = torch.bmm(ridge_sol, support_labels_one_hot)
+        # Compute the solution of the ridge regression, in the dual form for fewer samples than features.
+        # W = X^T(X X^T + lambda * I)^(-1) Y
+        ridge_sol = ridge_solve(support, support_labels_one_hot, self.gamma)
 
         # Compute the classification score.
         # score = W X
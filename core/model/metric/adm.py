@@ -25,15 +25,36 @@ from torch.nn import functional as F
 
 from core.utils import accuracy
 from .metric_model import MetricModel
+from ..local_knn import (
+    MAX_CHUNK_NUMEL,
+    Int8DescriptorIndex,
+    KNNIndexReport,
+    local_topk,
+)
+from ..solver import SPDFactor
 
 
 class ADMLayer(nn.Module):
-    def __init__(self, way_num, shot_num, query_num, n_k, device):
+    def __init__(
+        self,
+        way_num,
+        shot_num,
+        query_num,
+        n_k,
+        device,
+        max_chunk_numel=MAX_CHUNK_NUMEL,
+        knn_index=False,
+    ):
         super(ADMLayer, self).__init__()
         self.way_num = way_num
         self.shot_num = shot_num
         self.query_num = query_num
         self.n_k = n_k
+        self.max_chunk_numel = max_chunk_numel
+        # search the neighbours in an Int8DescriptorIndex at eval time
+        self.knn_index = knn_index
+        # a KNNIndexReport comparing the index with the exact search, set with `knn_index_report`
+        self.knn_report = None
         self.device = device
         self.normLayer = nn.BatchNorm1d(self.way_num * 2, affine=True)
         self.fcLayer = nn.Conv1d(1, 1, kernel_size=2, stride=1, dilation=5, bias=False)
@@ -71,38 +92,19 @@ class ADMLayer(nn.Module):
         :return:
         """
 
-        cov2_inverse = torch.inverse(cov2)  # e * 5 * 64 * 64
+        # factor each class covariance once for the queries
+        cov2_factor = SPDFactor(cov2.unsqueeze(1))  # e * 1 * 5 * 64 * 64
         mean_diff = -(mean1 - mean2.squeeze(2).unsqueeze(1))  # e * 75 * 5 * 64
 
-        # Calculate the trace
-        matrix_prod = torch.matmul(
-            cov1.unsqueeze(2), cov2_inverse.unsqueeze(1)
-        )  # e * 75 * 5 * 64 * 64
-        # trace_dist = [[torch.trace(matrix_prod[e][j][i]).unsqueeze(0) # modified for multi-task, stack for 64*64
-        # tensors
-        #                for j in range(matrix_prod.size(1))
-        #                for i in range(matrix_prod.size(2))]
-        #               for e in range(matrix_prod.size(0))] # list of trace_dist
-        # trace_dist = torch.stack([torch.cat(trace_dist_list, 0) for trace_dist_list in trace_dist]) #
-        trace_dist = torch.diagonal(
-            matrix_prod, offset=0, dim1=-2, dim2=-1
-        )  # e * 75 * 5 * 64
-        trace_dist = torch.sum(trace_dist, dim=-1)  # e * 75 * 5
-        # trace_dist = trace_dist.view(matrix_prod.size(0),matrix_prod.size(1), matrix_prod.size(2))  # e * 75 * 5
+        # Calculate the trace, tr(cov1 cov2^-1) of the symmetric matrices
+        trace_dist = torch.einsum(
+            "eqij,ewij->eqw", cov1, cov2_factor.inverse().squeeze(1)
+        )  # e * 75 * 5
 
         # Calcualte the Mahalanobis Distance
-        maha_prod = torch.matmul(
-            mean_diff.unsqueeze(3), cov2_inverse.unsqueeze(1)
-        )  # e * 75 * 5 * 1 * 64
-        maha_prod = torch.matmul(
-            maha_prod, mean_diff.unsqueeze(4)
-        )  # e * 75 * 5 * 1 * 1
-        maha_prod = maha_prod.squeeze(4)
-        maha_prod = maha_prod.squeeze(3)  # e * 75 * 5
-
-        matrix_det = torch.slogdet(cov2).logabsdet.unsqueeze(1) - torch.slogdet(
-            cov1
-        ).logabsdet.unsqueeze(2)
+        maha_prod = cov2_factor.inv_quad(mean_diff)  # e * 75 * 5
+
+        matrix_det = cov2_factor.logdet() - SPDFactor(cov1).logdet().unsqueeze(2)
 
         kl_dist = trace_dist + maha_prod + matrix_det - mean1.size(3)
 
@@ -143,17 +145,42 @@ class ADMLayer(nn.Module):
         support_norm = F.normalize(support_feat, p=2, dim=3)
         support_norm = support_norm.reshape(e, self.way_num, self.shot_num * h * w, c)
 
-        # cosine similarity between a query set and a support set
-        # e * 75 * 5 * 441 * 2205
-        inner_prod_matrix = torch.matmul(
-            query_norm.unsqueeze(2),
-            support_norm.permute(0, 1, 3, 2).unsqueeze(1),
-        )
-
-        # choose the top-k nearest neighbors
-        # e * 75 * 5 * 441 * 1
-        topk_value, topk_index = torch.topk(inner_prod_matrix, self.n_k, 4)
+        # cosine similarity between a query set and a support set, e * 75 * 5 * 441 * 2205,
+        # reduced to the top-k nearest neighbors tile by tile
+        # e * 75 * 5 * 441 * n_k
+        support_norm = support_norm.permute(0, 1, 3, 2)
+        use_index = self.knn_index and not self.training
+        if use_index:
+            topk_value, topk_index = Int8DescriptorIndex(support_norm).topk(
+                query_norm, self.n_k, self.max_chunk_numel
+            )
+        else:
+            topk_value = local_topk(
+                query_norm, support_norm, self.n_k, self.max_chunk_numel
+            )
         inner_sim = torch.sum(torch.sum(topk_value, 4), 3)  # e * 75 * 5
+        adm_sim_soft = self._fuse_sim(kl_dis, inner_sim)
+
+        if use_index and self.knn_report is not None:
+            exact_value, exact_index = local_topk(
+                query_norm,
+                support_norm,
+                self.n_k,
+                self.max_chunk_numel,
+                return_index=True,
+            )
+            exact_sim = self._fuse_sim(kl_dis, torch.sum(torch.sum(exact_value, 4), 3))
+            target = torch.arange(
+                self.way_num, device=adm_sim_soft.device
+            ).repeat_interleave(b // self.way_num)
+            self.knn_report.update(
+                topk_index, exact_index, adm_sim_soft, exact_sim, target
+            )
+
+        return adm_sim_soft
+
+    def _fuse_sim(self, kl_dis, inner_sim):
+        e, b, _ = kl_dis.size()
 
         # Using FC layer to combine two parts ---- The original
         adm_sim_soft = torch.cat((kl_dis, inner_sim), 2)
@@ -172,12 +199,37 @@ class ADMLayer(nn.Module):
 
 
 class ADM(MetricModel):
-    def __init__(self, n_k=3, **kwargs):
+    def __init__(
+        self,
+        n_k=3,
+        max_chunk_numel=MAX_CHUNK_NUMEL,
+        knn_index=False,
+        knn_index_report=False,
+        **kwargs
+    ):
+        """
+        Args:
+            n_k (int, optional): The number of neighbours of each query descriptor. Defaults to 3.
+            max_chunk_numel (int, optional): The number of elements of the relation of a tile of the
+                neighbour search. Defaults to MAX_CHUNK_NUMEL.
+            knn_index (bool, optional): Search the neighbours approximately in an int8 descriptor index
+                at eval time. Defaults to False.
+            knn_index_report (bool, optional): Also run the exact search at eval time and report the
+                recall and accuracy of the index against it. Defaults to False.
+        """
         super(ADM, self).__init__(**kwargs)
         self.n_k = n_k
         self.adm_layer = ADMLayer(
-            self.way_num, self.shot_num, self.query_num, n_k, self.device
+            self.way_num,
+            self.shot_num,
+            self.query_num,
+            n_k,
+            self.device,
+            max_chunk_numel,
+            knn_index,
         )
+        if knn_index and knn_index_report:
+            self.adm_layer.knn_report = KNNIndexReport()
         self.loss_func = nn.CrossEntropyLoss()
 
     def set_forward(self, batch):
@@ -24,6 +24,7 @@ from torch import nn
 
 from core.utils import accuracy
 from .metric_model import MetricModel
+from ..solver import SPDFactor
 
 
 class KLLayer(nn.Module):
@@ -69,30 +70,19 @@ class KLLayer(nn.Module):
         :return:
         """
 
-        cov2_inverse = torch.inverse(cov2)  # e * 5 * 64 * 64
+        # factor each class covariance once for the queries
+        cov2_factor = SPDFactor(cov2.unsqueeze(1))  # e * 1 * 5 * 64 * 64
         mean_diff = -(mean1 - mean2.squeeze(2).unsqueeze(1))  # e * 75 * 5 * 64
 
-        # Calculate the trace
-        matrix_prod = torch.matmul(
-            cov1.unsqueeze(2), cov2_inverse.unsqueeze(1)
-        )  # e * 75 * 5 * 64 * 64
-
-        trace_dist = torch.diagonal(
-            matrix_prod, offset=0, dim1=-2, dim2=-1
-        )  # e * 75 * 5 * 64
-        trace_dist = torch.sum(trace_dist, dim=-1)  # e * 75 * 5
+        # Calculate the trace, tr(cov1 cov2^-1) of the symmetric matrices
+        trace_dist = torch.einsum(
+            "eqij,ewij->eqw", cov1, cov2_factor.inverse().squeeze(1)
+        )  # e * 75 * 5
 
         # Calcualte the Mahalanobis Distance
-        maha_prod = torch.matmul(
-            mean_diff.unsqueeze(3), cov2_inverse.unsqueeze(1)
-        )  # e * 75 * 5 * 1 * 64
-        maha_prod = torch.matmul(
-            maha_prod, mean_diff.unsqueeze(4)
-        )  # e * 75 * 5 * 1 * 1
-        maha_prod = maha_prod.squeeze(4)
-        maha_prod = maha_prod.squeeze(3)  # e * 75 * 5
-
-        matrix_det = torch.logdet(cov2).unsqueeze(1) - torch.logdet(cov1).unsqueeze(2)
+        maha_prod = cov2_factor.inv_quad(mean_diff)  # e * 75 * 5
+
+        matrix_det = cov2_factor.logdet() - SPDFactor(cov1).logdet().unsqueeze(2)
 
         kl_dist = trace_dist + maha_prod + matrix_det - mean1.size(3)
 
@@ -40,20 +40,18 @@ class CrossEntropyLoss(nn.Module):
         inputs = inputs.view(inputs.size(0), inputs.size(1), -1)
 
         log_probs = self.logsoftmax(inputs)
-        targets = torch.zeros(inputs.size(0), inputs.size(1)).scatter_(
-            1, targets.unsqueeze(1).data.cpu(), 1
-        )
+        targets = torch.zeros(
+            inputs.size(0), inputs.size(1), device=inputs.device
+        ).scatter_(1, targets.unsqueeze(1).data, 1)
         targets = targets.unsqueeze(-1)
-        targets = targets.cuda()
         loss = (-targets * log_probs).mean(0).sum()
         return loss / inputs.size(2)
 
 
-def one_hot(indices, depth, use_cuda=True):
-    if use_cuda:
-        encoded_indicies = torch.zeros(indices.size() + torch.Size([depth])).cuda()
-    else:
-        encoded_indicies = torch.zeros(indices.size() + torch.Size([depth]))
+def one_hot(indices, depth):
+    encoded_indicies = torch.zeros(
+        indices.size() + torch.Size([depth]), device=indices.device
+    )
     index = indices.view(indices.size() + torch.Size([1]))
     encoded_indicies = encoded_indicies.scatter_(1, index, 1)
     return encoded_indicies
@@ -26,10 +26,7 @@ def rearrange_data(data, num_classes, k):
 
 def accuracy(logits, label):
     pred = torch.argmax(logits, dim=1)
-    if torch.cuda.is_available():
-        return (pred == label).type(torch.cuda.FloatTensor).mean().item()
-    else:
-        return (pred == label).type(torch.FloatTensor).mean().item()
+    return (pred == label).float().mean().item()
 
 
 class SmoothCELoss(nn.Module):
@@ -125,10 +122,7 @@ class CPEANet(MetricModel):
         self.loss_func = SmoothCELoss()
 
     def set_forward(self, batch):
-        if torch.cuda.is_available():
-            data, _ = [_.cuda() for _ in batch]
-        else:
-            data = batch[0]
+        data = batch[0].to(self.device)
         data = rearrange_data(data, self.way_num, self.shot_num + self.query_num)
         p = self.shot_num * self.way_num
         data_shot, data_query = data[:p], data[p:]
@@ -150,10 +144,7 @@ class CPEANet(MetricModel):
         return results, acc
 
     def set_forward_loss(self, batch):
-        if torch.cuda.is_available():
-            data, _ = [_.cuda() for _ in batch]
-        else:
-            data = batch[0]
+        data = batch[0].to(self.device)
 
         data = rearrange_data(data, self.way_num, self.shot_num + self.query_num)
         p = self.shot_num * self.way_num
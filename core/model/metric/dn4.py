@@ -27,12 +27,23 @@ from torch.nn import functional as F
 
 from core.utils import accuracy
 from .metric_model import MetricModel
+from ..local_knn import (
+    MAX_CHUNK_NUMEL,
+    Int8DescriptorIndex,
+    KNNIndexReport,
+    local_topk,
+)
 
 
 class DN4Layer(nn.Module):
-    def __init__(self, n_k):
+    def __init__(self, n_k, max_chunk_numel=MAX_CHUNK_NUMEL, knn_index=False):
         super(DN4Layer, self).__init__()
         self.n_k = n_k
+        self.max_chunk_numel = max_chunk_numel
+        # search the neighbours in an Int8DescriptorIndex at eval time
+        self.knn_index = knn_index
+        # a KNNIndexReport comparing the index with the exact search, set with `knn_index_report`
+        self.knn_report = None
 
     def forward(
         self,
@@ -45,33 +56,73 @@ class DN4Layer(nn.Module):
         t, wq, c, h, w = query_feat.size()
         _, ws, _, _, _ = support_feat.size()
 
-        # t, wq, c, hw -> t, wq, hw, c -> t, wq, 1, hw, c
+        # t, wq, c, hw -> t, wq, hw, c
         query_feat = query_feat.view(t, way_num * query_num, c, h * w).permute(
             0, 1, 3, 2
         )
-        query_feat = F.normalize(query_feat, p=2, dim=-1).unsqueeze(2)
+        query_feat = F.normalize(query_feat, p=2, dim=-1)
 
-        # t, ws, c, h, w -> t, w, s, c, hw -> t, 1, w, c, shw
+        # t, ws, c, h, w -> t, w, s, c, hw -> t, w, c, shw
         support_feat = (
             support_feat.view(t, way_num, shot_num, c, h * w)
             .permute(0, 1, 3, 2, 4)
             .contiguous()
             .view(t, way_num, c, shot_num * h * w)
         )
-        support_feat = F.normalize(support_feat, p=2, dim=2).unsqueeze(1)
+        support_feat = F.normalize(support_feat, p=2, dim=2)
 
         # t, wq, w, hw, shw -> t, wq, w, hw, n_k -> t, wq, w
-        relation = torch.matmul(query_feat, support_feat)
-        topk_value, _ = torch.topk(relation, self.n_k, dim=-1)
+        if self.knn_index and not self.training:
+            topk_value, topk_index = Int8DescriptorIndex(support_feat).topk(
+                query_feat, self.n_k, self.max_chunk_numel
+            )
+        else:
+            topk_value = local_topk(
+                query_feat, support_feat, self.n_k, self.max_chunk_numel
+            )
         score = torch.sum(topk_value, dim=[3, 4])
 
+        if self.knn_index and not self.training and self.knn_report is not None:
+            exact_value, exact_index = local_topk(
+                query_feat,
+                support_feat,
+                self.n_k,
+                self.max_chunk_numel,
+                return_index=True,
+            )
+            target = torch.arange(way_num, device=score.device).repeat_interleave(
+                query_num
+            )
+            self.knn_report.update(
+                topk_index, exact_index, score, torch.sum(exact_value, dim=[3, 4]), target
+            )
+
         return score
 
 
 class DN4(MetricModel):
-    def __init__(self, n_k=3, **kwargs):
+    def __init__(
+        self,
+        n_k=3,
+        max_chunk_numel=MAX_CHUNK_NUMEL,
+        knn_index=False,
+        knn_index_report=False,
+        **kwargs
+    ):
+        """
+        Args:
+            n_k (int, optional): The number of neighbours of each query descriptor. Defaults to 3.
+            max_chunk_numel (int, optional): The number of elements of the relation of a tile of the
+                neighbour search. Defaults to MAX_CHUNK_NUMEL.
+            knn_index (bool, optional): Search the neighbours approximately in an int8 descriptor index
+                at eval time. Defaults to False.
+            knn_index_report (bool, optional): Also run the exact search at eval time and report the
+                recall and accuracy of the index against it. Defaults to False.
+        """
         super(DN4, self).__init__(**kwargs)
-        self.dn4_layer = DN4Layer(n_k)
+        self.dn4_layer = DN4Layer(n_k, max_chunk_numel, knn_index)
+        if knn_index and knn_index_report:
+            self.dn4_layer.knn_report = KNNIndexReport()
         self.loss_func = nn.CrossEntropyLoss()
 
     def set_forward(self, batch):
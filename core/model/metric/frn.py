@@ -17,6 +17,7 @@ import torch.nn.functional as F
 import numpy as np
 from core.utils import accuracy
 from .metric_model import MetricModel
+from ..solver import ridge_hat
 
 
 class FRNLayer(nn.Module):
@@ -39,10 +40,11 @@ class FRNLayer(nn.Module):
         log_prediction = F.log_softmax(logits, dim=2)
         return log_prediction
 
-    def get_recon_dist(self, query, support, alpha, beta, Woodbury=True):
+    def get_recon_dist(self, query, support, alpha, beta, Woodbury=None):
         # query: n, way*query_shot*resolution, d
         # support: n, way, shot*resolution, d
-        # Woodbury: whether to use the Woodbury Identity as the implementation or not
+        # Woodbury: whether to use the Woodbury Identity (Equation 10, a d*d system) or Equation 8 (a
+        # shot*resolution square system), None for the smaller system
 
         # correspond to kr/d in the paper
         reg = support.size(2) / support.size(3)
@@ -53,35 +55,9 @@ class FRNLayer(nn.Module):
         # correspond to gamma in the paper
         rho = beta.exp()
 
-        st = support.permute(0, 1, 3, 2)  # n, way, d, shot*resolution
-
-        if Woodbury:
-            # correspond to Equation 10 in the paper
-
-            sts = st.matmul(support)  # n, way, d, d
-            m_inv = (
-                sts
-                + torch.eye(sts.size(-1))
-                .to(sts.device)
-                .unsqueeze(0)
-                .unsqueeze(0)
-                .mul(lam)
-            ).inverse()  # n, way, d, d
-            hat = m_inv.matmul(sts)  # n, way, d, d
-
-        else:
-            # correspond to Equation 8 in the paper
-
-            sst = support.matmul(st)  # n, way, shot*resolution, shot*resolution
-            m_inv = (
-                sst
-                + torch.eye(sst.size(-1))
-                .to(sst.device)
-                .unsqueeze(0)
-                .unsqueeze(0)
-                .mul(lam)
-            ).inverse()  # n, way, shot*resolution, shot*resolutionsf
-            hat = st.matmul(m_inv).matmul(support)  # n, way, d, d
+        hat = ridge_hat(
+            support, lam, dual=None if Woodbury is None else not Woodbury
+        )  # n, way, d, d
         Q_bar = query.unsqueeze(1).matmul(hat).mul(rho)  # n, way, way*query_shot*resolution, d
         dist = (
             (Q_bar - query.unsqueeze(1)).pow(2).sum(3).permute(0, 2, 1)
@@ -108,7 +84,7 @@ class FRN(MetricModel):
     def __init__(self, **kwargs):
         super(FRN, self).__init__(**kwargs)
         self.frn_layer = FRNLayer()
-        self.loss_func = nn.NLLLoss().cuda()
+        self.loss_func = nn.NLLLoss()
 
     def set_forward(self, batch):
         image, global_target = batch
@@ -171,14 +147,8 @@ def auxrank(support):
     way = support.size(1)
     shot = support.size(2)
     support = support / support.norm(2).unsqueeze(-1)
-    L1 = torch.zeros((way**2 - way) // 2).long().cuda()
-    L2 = torch.zeros((way**2 - way) // 2).long().cuda()
-    counter = 0
-    for i in range(way):
-        for j in range(i):
-            L1[counter] = i
-            L2[counter] = j
-            counter += 1
+    # all pairs (i, j) with j < i
+    L1, L2 = torch.tril_indices(way, way, offset=-1, device=support.device)
     s1 = support.index_select(1, L1)  # (s^2-s)/2, s, d
     s2 = support.index_select(1, L2)  # (s^2-s)/2, s, d
     dists = s1.matmul(s2.permute(0, 1, 3, 2))  # (s^2-s)/2, s, s
@@ -38,6 +38,36 @@ def l2distance(x, y):
     return ret
 
 
+def bipartite_katz(T_sq, T_qs, katz_factor):
+    """
+    The Katz centrality ((I - a T)^-1 - I) 1 of the bipartite graph T = [[0, T_sq^T], [T_qs^T, 0]] of the
+    support and query descriptors.
+
+    With x = (I - a T)^-1 1, the support part x_s = 1 + a T_sq^T x_q, so the query part solves the
+    M_q x M_q system (I - a^2 T_qs^T T_sq^T) x_q = 1 + a T_qs^T 1 (and the other way around when the
+    support side is smaller), instead of inverting the (M_s + M_q) square matrix.
+
+    Args:
+        T_sq (torch.Tensor): The query to support transitions, N * M_q * M_s.
+        T_qs (torch.Tensor): The support to query transitions, N * M_s * M_q.
+        katz_factor (float): The decay a.
+
+    Returns:
+        torch.Tensor: The centrality of the support then the query descriptors, N * (M_s + M_q).
+    """
+    A = T_sq.transpose(-2, -1)  # N * M_s * M_q
+    B = T_qs.transpose(-2, -1)  # N * M_q * M_s
+    if B.size(-2) > A.size(-2):
+        # eliminate the query side instead
+        return bipartite_katz(T_qs, T_sq, katz_factor).roll(A.size(-2), dims=-1)
+
+    eye = torch.eye(B.size(-2), dtype=B.dtype, device=B.device)
+    rhs = 1 + katz_factor * B.sum(-1, keepdim=True)  # N * M_q * 1
+    x_q = torch.linalg.solve(eye - katz_factor ** 2 * B.matmul(A), rhs)
+    katz_s = katz_factor * A.matmul(x_q)
+    return torch.cat([katz_s, x_q - 1], dim=-2).squeeze(-1)
+
+
 class Similarity(nn.Module):
     def __init__(self, metric='cosine'):
         super().__init__()
@@ -96,23 +126,15 @@ class MCLMask(nn.Module):
         M_q = S.shape[-2]
         M_s = S.shape[2] * S.shape[-1]
         S = S.permute(0, 1, 3, 2, 4).contiguous().view(b * q, M_q, M_s)
-        N_examples = b * q
         St = S.transpose(-2, -1)
-        device = S.device
 
         T_sq = torch.exp(self.gamma * (S - S.max(-1, keepdim=True)[0]))
         T_sq = T_sq / T_sq.sum(-1, keepdim=True)
         T_qs = torch.exp(self.gamma2 * (St - St.max(-1, keepdim=True)[0]))
         T_qs = T_qs / T_qs.sum(-1, keepdim=True)
 
-        T = torch.cat([
-            torch.cat([torch.zeros((N_examples, M_s, M_s), device=device), T_sq.transpose(-2, -1)], dim=-1),
-            torch.cat([T_qs.transpose(-2, -1), torch.zeros((N_examples, M_q, M_q), device=device)], dim=-1),
-        ], dim=-2)
-
-        katz = (torch.inverse(torch.eye(M_s + M_q, device=device)[None].repeat(N_examples, 1, 1) - self.katz_factor * T) - \
-                torch.eye(M_s + M_q, device=S.device)[None].repeat(N_examples, 1, 1))@torch.ones((N_examples, M_s + M_q, 1), device=device)
-        katz_query = katz.squeeze(-1)[:, M_s:] / katz.squeeze(-1)[:, M_s:].sum(-1, keepdim=True)
+        katz = bipartite_katz(T_sq, T_qs, self.katz_factor)
+        katz_query = katz[:, M_s:] / katz[:, M_s:].sum(-1, keepdim=True)
         # katz_support = katz.squeeze(-1)[:, :M_s] / katz.squeeze(-1)[:, :M_s].sum(-1, keepdim=True)
         # katz_support = katz_support.view(b, q, self.n_way, -1)
         # katz_support = katz_support / katz_support.sum(-1, keepdim=True)
@@ -147,20 +169,14 @@ class MCLLayer(nn.Module):
         S = similarity_f(support_xf, support_y, query_xf, query_y)
         N_examples, M_q, M_s = S.shape
         St = S.transpose(-2, -1)
-        device = S.device
 
         T_sq = torch.exp(self.gamma * (S - S.max(-1, keepdim=True)[0]))
         T_sq = T_sq / T_sq.sum(-1, keepdim=True)
         T_qs = torch.exp(self.gamma2 * (St - St.max(-1, keepdim=True)[0])) 
         T_qs = T_qs / T_qs.sum(-1, keepdim=True)
 
-        T = torch.cat([
-            torch.cat([torch.zeros((N_examples, M_s, M_s), device=device), T_sq.transpose(-2, -1)], dim=-1),
-            torch.cat([T_qs.transpose(-2, -1), torch.zeros((N_examples, M_q, M_q), device=device)], dim=-1),
-        ], dim=-2)
-        katz = (torch.inverse(torch.eye(M_s + M_q, device=device)[None].repeat(N_examples, 1, 1) - katz_factor * T) - \
-                torch.eye(M_s + M_q, device=S.device)[None].repeat(N_examples, 1, 1))@torch.ones((N_examples, M_s + M_q, 1), device=device)
-        partial_katz = katz.squeeze(-1)[:, :M_s] / katz.squeeze(-1)[:, :M_s].sum(-1, keepdim=True)
+        katz = bipartite_katz(T_sq, T_qs, katz_factor)
+        partial_katz = katz[:, :M_s] / katz[:, :M_s].sum(-1, keepdim=True)
         predicts = partial_katz.view(N_examples, self.n_way, -1).sum(-1)
         return predicts
 
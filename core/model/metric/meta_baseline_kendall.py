@@ -15,108 +15,22 @@ https://arxiv.org/abs/2307.15317
 
 Adapter from https://github.com/kaipengm2/DiffKendall
 '''
-from itertools import combinations
 import torch
 from torch import nn
 from core.utils import accuracy
 from .metric_model import MetricModel
-from torch.nn import functional as F
-import random
+from ..kendall import (
+    MAX_CHUNK_NUMEL,
+    diffkendall_for_batches,
+    kendall_ranking_correlation_for_batches,
+)
 
 
-
-def compute_c_pair(c):
-    return list(combinations(list(range(c)), 2))
-
-def diffkendall(support, query, c_pair, beta=1, T=0.0125):
-    '''The differentiable Kendall's rank correlation.'''
-    support_prank = support[:, c_pair].diff().squeeze()
-    query_prank = query[:, c_pair].diff().squeeze(-1)
-    score = support_prank.repeat([query.shape[0], 1, 1]) * query_prank.unsqueeze(1).repeat([1, support.shape[0], 1])
-    score = 1 / (1 + (-score * beta).exp())
-    score = 2 * score - 1
-    score = score.mean(dim=-1)
-    score = score / T
-    return score
-
-def diffkendall_for_batches(support, query, beta=1, T=0.0125):
-    c = support.shape[-1]
-    c_pair = compute_c_pair(c)
-    batches = support.shape[0]
-    scores = [diffkendall(support[i], query[i], c_pair, beta, T) for i in range(batches)]
-    return torch.stack(scores)
-
-def kendall_ranking_correlation(support, query, c_pair):
-    '''Kendall's rank correlation.'''
-    support_prank = support[:, c_pair].diff(dim=-1).sign().squeeze()
-    query_prank = query[:, c_pair].diff(dim=-1).sign().squeeze()
-    score = torch.mm(query_prank, support_prank.T)
-    return score / len(c_pair)
-
-def kendall_ranking_correlation_for_batches(support, query):
-    c = support.shape[-1]
-    c_pair = compute_c_pair(c)
-    batches = support.shape[0]
-    
-    scores = [kendall_ranking_correlation(support[i], query[i], c_pair) for i in range(batches)]
-    return torch.stack(scores)
-
-
-
-# def compute_c_pair(c):
-#     return list(combinations(list(range(c)), 2))
-
-# def diffkendall(support, query, c_pair, beta=1, T=0.0125):
-#     support_diff = support[:, c_pair].diff().squeeze()
-#     query_diff = query[:, c_pair].diff().squeeze(-1)
-    
-#     support_prank = support_diff.unsqueeze(0)
-#     query_prank = query_diff.unsqueeze(1)
-    
-#     score = support_prank * query_prank
-#     score = 1 / (1 + (-score * beta).exp())
-#     score = 2 * score - 1
-#     score = score.mean(dim=-1)
-#     score = score / T
-#     return score
-
-# def diffkendall_for_batches(support, query, beta=1, T=0.0125):
-#     c = support.shape[-1]
-#     c_pair = compute_c_pair(c)
-#     support_diff = support[:, :, c_pair].diff(dim=-1).squeeze(-1)
-#     query_diff = query[:, :, c_pair].diff(dim=-1).squeeze(-1)
-    
-#     support_prank = support_diff.unsqueeze(1)
-#     query_prank = query_diff.unsqueeze(2)
-    
-#     score = support_prank * query_prank
-#     score = 1 / (1 + (-score * beta).exp())
-#     score = 2 * score - 1
-#     score = score.mean(dim=-1)
-#     score = score / T
-#     return score
-
-# def kendall_ranking_correlation(support, query, c_pair):
-#     '''Kendall's rank correlation.'''
-#     support_prank = support[:, c_pair].diff(dim=-1).sign().squeeze()
-#     query_prank = query[:, c_pair].diff(dim=-1).sign().squeeze()
-#     score = torch.mm(query_prank, support_prank.T)
-#     return score / len(c_pair)
-
-# def kendall_ranking_correlation_for_batches(support, query):
-#     c = support.shape[-1]
-#     c_pair = compute_c_pair(c)
-#     c_pair_tensor = torch.tensor(c_pair, dtype=torch.long)
-#     support_prank = support[:, :, c_pair_tensor].diff(dim=-1).sign()
-#     query_prank = query[:, :, c_pair_tensor].diff(dim=-1).sign()
-#     support_prank = support_prank.view(support.shape[0], -1, len(c_pair))
-#     query_prank = query_prank.view(query.shape[0], -1, len(c_pair))
-#     scores = torch.bmm(query_prank, support_prank.transpose(1, 2)) / len(c_pair)
-#     return scores
-
 class ProtoLayer(nn.Module):
-    def __init__(self):
+    def __init__(self, num_pairs=None, max_chunk_numel=MAX_CHUNK_NUMEL):
         super(ProtoLayer, self).__init__()
+        self.num_pairs = num_pairs
+        self.max_chunk_numel = max_chunk_numel
 
     def forward(
         self,
@@ -136,17 +50,33 @@ class ProtoLayer(nn.Module):
         support_feat = support_feat.reshape(t, way_num, shot_num, c)
         proto_feat = torch.mean(support_feat, dim=2)
         if mode == "kendall":
-            return kendall_ranking_correlation_for_batches(proto_feat, query_feat)
+            return kendall_ranking_correlation_for_batches(
+                proto_feat, query_feat, self.num_pairs, self.max_chunk_numel
+            )
         elif mode == "diffkendall":
-            return diffkendall_for_batches(proto_feat, query_feat), kendall_ranking_correlation_for_batches(proto_feat, query_feat)
+            return diffkendall_for_batches(
+                proto_feat,
+                query_feat,
+                num_pairs=self.num_pairs,
+                max_chunk_numel=self.max_chunk_numel,
+            ), kendall_ranking_correlation_for_batches(
+                proto_feat.detach(), query_feat.detach(), self.num_pairs, self.max_chunk_numel
+            )
         else:
             raise ValueError("Invalid mode")
 
 
 class MetaBaselineKendall(MetricModel):
-    def __init__(self, **kwargs):
+    def __init__(self, num_pairs=None, max_chunk_numel=MAX_CHUNK_NUMEL, **kwargs):
+        """
+        Args:
+            num_pairs (int, optional): Score a random subset of num_pairs channel pairs, an approximate
+                Kendall's rank correlation. Defaults to None, all pairs.
+            max_chunk_numel (int, optional): The memory budget, in elements, of the intermediate of a
+                chunk of channel pairs. Defaults to MAX_CHUNK_NUMEL.
+        """
         super(MetaBaselineKendall, self).__init__(**kwargs)
-        self.proto_layer = ProtoLayer()
+        self.proto_layer = ProtoLayer(num_pairs, max_chunk_numel)
         self.loss_func = nn.CrossEntropyLoss()
     def set_forward(self, batch):
         """
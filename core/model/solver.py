@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Batched linear solvers of the closed-form heads (R2D2, FRN) and the covariance metrics (ADM, KL).
+
+All functions work on the last two dims and broadcast over the leading (episode, way, ...) dims.
+"""
+import torch
+
+
+def add_diag(A, lam):
+    """
+    Add lam to the diagonal of a batch of square matrices.
+
+    Args:
+        A (torch.Tensor): [..., n, n].
+        lam (float or torch.Tensor): A scalar, or a (learnable) tensor broadcastable to A.
+
+    Returns:
+        torch.Tensor: A + lam * I.
+    """
+    return A + lam * torch.eye(A.size(-1), dtype=A.dtype, device=A.device)
+
+
+class SPDFactor(object):
+    """
+    The Cholesky factor of a batch of symmetric positive-definite matrices, reused by all solves with them.
+
+    The matrices that are not numerically positive-definite (e.g. a ridge with a negative learnt
+    regularization) fall back to an LU factor, the batch is then solved as a general system.
+    """
+
+    def __init__(self, A):
+        """
+        Args:
+            A (torch.Tensor): The SPD matrices, [..., n, n].
+        """
+        self.A = A
+        L, info = torch.linalg.cholesky_ex(A)
+        self.spd = not bool(info.any())
+        if self.spd:
+            self.L = L
+        else:
+            self.LU, self.pivots = torch.linalg.lu_factor(A)
+        self._inverse = None
+
+    def solve(self, B):
+        """
+        Args:
+            B (torch.Tensor): The right-hand sides, [..., n, k].
+
+        Returns:
+            torch.Tensor: A^-1 B, [..., n, k].
+        """
+        if self.spd:
+            return torch.cholesky_solve(B, self.L)
+        return torch.linalg.lu_solve(self.LU, self.pivots, B)
+
+    def inverse(self):
+        """
+        Returns:
+            torch.Tensor: A^-1 from the factor, computed once, [..., n, n].
+        """
+        if self._inverse is None:
+            if self.spd:
+                self._inverse = torch.cholesky_inverse(self.L)
+            else:
+                self._inverse = self.solve(
+                    torch.eye(self.A.size(-1), dtype=self.A.dtype, device=self.A.device)
+                    .expand_as(self.A)
+                )
+        return self._inverse
+
+    def inv_quad(self, x):
+        """
+        The quadratic forms x^T A^-1 x, with one triangular solve of each x against the factor.
+
+        Args:
+            x (torch.Tensor): [..., n], its leading dims broadcast with the ones of A.
+
+        Returns:
+            torch.Tensor: [...].
+        """
+        if self.spd:
+            y = torch.linalg.solve_triangular(self.L, x.unsqueeze(-1), upper=False)
+            return y.pow(2).sum((-2, -1))
+        batch_shape = torch.broadcast_shapes(x.shape[:-1], self.A.shape[:-2])
+        x = x.expand(batch_shape + x.shape[-1:]).unsqueeze(-1)
+        y = torch.linalg.lu_solve(
+            self.LU.expand(batch_shape + self.LU.shape[-2:]),
+            self.pivots.expand(batch_shape + self.pivots.shape[-1:]),
+            x,
+        )
+        return (x * y).sum((-2, -1))
+
+    def logdet(self):
+        """
+        Returns:
+            torch.Tensor: log|det A|, [...].
+        """
+        if self.spd:
+            return 2 * self.L.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+        return torch.linalg.slogdet(self.A).logabsdet
+
+
+def _use_dual(X, dual):
+    # the dual form solves the n x n Gram system of the samples, the primal one the d x d system of the features
+    return X.size(-2) < X.size(-1) if dual is None else dual
+
+
+def ridge_solve(X, Y, lam, dual=None):
+    """
+    The ridge regression W = (X^T X + lam I)^-1 X^T Y = X^T (X X^T + lam I)^-1 Y.
+
+    Args:
+        X (torch.Tensor): The samples, [..., n, d].
+        Y (torch.Tensor): The targets, [..., n, k].
+        lam (float or torch.Tensor): The regularization.
+        dual (bool, optional): Solve the n x n dual system (the Woodbury form) instead of the d x d primal
+            one. Defaults to None, the smaller one.
+
+    Returns:
+        torch.Tensor: W, [..., d, k].
+    """
+    Xt = X.transpose(-2, -1)
+    if _use_dual(X, dual):
+        return Xt.matmul(SPDFactor(add_diag(X.matmul(Xt), lam)).solve(Y))
+    return SPDFactor(add_diag(Xt.matmul(X), lam)).solve(Xt.matmul(Y))
+
+
+def ridge_hat(X, lam, dual=None):
+    """
+    The ridge hat matrix (X^T X + lam I)^-1 X^T X = X^T (X X^T + lam I)^-1 X, a row vector q is reconstructed
+    from the rows of X as q @ hat.
+
+    Args:
+        X (torch.Tensor): The samples, [..., n, d].
+        lam (float or torch.Tensor): The regularization.
+        dual (bool, optional): Solve the n x n dual system instead of the d x d primal one. Defaults to None,
+            the smaller one.
+
+    Returns:
+        torch.Tensor: The hat matrix, [..., d, d].
+    """
+    Xt = X.transpose(-2, -1)
+    if _use_dual(X, dual):
+        return Xt.matmul(SPDFactor(add_diag(X.matmul(Xt), lam)).solve(X))
+    XtX = Xt.matmul(X)
+    return SPDFactor(add_diag(XtX, lam)).solve(XtX)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import torch
+import torch.distributed as dist
+
+import core.model as arch
+from core.probe import synthetic_episodes
+from core.utils import ModelType, feed_features, get_instance
+
+# the model of a head pool worker
+_head_model = None
+
+
+class HeadPool(object):
+    """
+    Run the heads of a model in a pool of CPU processes on the backbone features of the main process.
+
+    With a pool, the evaluation embeds the images of batch i+1 while the workers run everything of
+    `set_forward` after the backbone (the per-episode head fitting of the finetuning methods, the
+    metric layers, ...) on batch i. Each worker builds the model from the config, loads the weights of
+    the evaluated model and gets the features fed in place of its backbone (see `feed_features`), so
+    the methods have to call their backbone once on the whole batch.
+    """
+
+    def __init__(self, config, model, workers):
+        """
+        Args:
+            config (dict): Parsed config file.
+            model (nn.Module): The (unwrapped) model, in the val/test setting.
+            workers (int): The number of worker processes.
+        """
+        self.workers = workers
+        self.device = model.device
+        snapshot = {
+            k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()
+        }
+        # the workers share the cores left by the main process
+        num_threads = max(1, len(os.sched_getaffinity(0)) // (workers + 1))
+        self.executor = ProcessPoolExecutor(
+            workers,
+            mp_context=torch.multiprocessing.get_context("spawn"),
+            initializer=_init_head_worker,
+            initargs=(config, snapshot, num_threads),
+        )
+
+    def submit(self, batch, feat):
+        """
+        Run the heads of a batch on its features in a worker.
+
+        Args:
+            batch (list): The batch, its images are only used for their size.
+            feat (torch.Tensor): The backbone features of the images.
+
+        Returns:
+            concurrent.futures.Future: The future (output, acc) of the model.
+        """
+        placeholder = torch.zeros(()).expand(batch[0].size())
+        return self.executor.submit(_run_head, [placeholder] + batch[1:], feat.cpu())
+
+    def close(self):
+        # the batches still pending after an error are dropped
+        self.executor.shutdown(cancel_futures=True)
+
+
+def check_head_pool(model, config):
+    """
+    Check whether the heads of a model can run in a `HeadPool`, on a synthetic val/test episode.
+
+    The workers feed the features of the whole batch in place of the backbone, so the methods calling their
+    backbone more than once (e.g. MAML, BOIL, LEO adapting through it) cannot run there. The kNN index
+    reports (`knn_index_report`) are only collected in the main process.
+
+    Args:
+        model (nn.Module): The (unwrapped) model.
+        config (dict): Parsed config file.
+
+    Returns:
+        str: Why the heads cannot run in a pool, None if they can.
+    """
+    if any(getattr(m, "knn_report", None) is not None for m in model.modules()):
+        return "the knn_index_report of {} is collected in the main process".format(
+            type(model).__name__
+        )
+
+    training = model.training
+    model.eval()
+    model.reverse_setting_info()
+    try:
+        batch = synthetic_episodes(model, config, 1, model.device)
+        with torch.no_grad():
+            feat = model.emb_func(batch[0])
+        with torch.set_grad_enabled(
+            model.model_type != ModelType.METRIC
+        ), feed_features(model, feat) as feeder:
+            try:
+                model(batch)
+            except AssertionError:
+                if feeder.misused:
+                    return "{} does not call its backbone once on the whole batch".format(
+                        type(model).__name__
+                    )
+                raise
+    finally:
+        model.reverse_setting_info()
+        model.train(training)
+
+    return None
+
+
+def log_knn_reports(model):
+    """
+    Print and reset the reports of the approximate descriptor indices (`knn_index`) of a model against the
+    exact search, collected with `knn_index_report` since the last call.
+
+    Args:
+        model (nn.Module): The (unwrapped) model.
+    """
+    for name, module in model.named_modules():
+        report = getattr(module, "knn_report", None)
+        if report is not None and report.queries > 0:
+            print(" * kNN index of {}: {}".format(name, report.summary()))
+            report.reset()
+
+
+def eval_outputs(model, loader, head_pool=None):
+    """
+    Evaluate a model on all batches of a val/test loader.
+
+    Without a pool, each batch goes through the model. With a pool, the main process only embeds the
+    images and up to `head_pool.workers` batches are in the pool at a time, the results come back in
+    the order of the batches.
+
+    Args:
+        model (nn.Module): The model, possibly wrapped by DDP.
+        loader (tuple): The val/test loaders.
+        head_pool (HeadPool, optional): The pool to run the heads in. Defaults to None.
+
+    Yields:
+        tuple: (output, acc, data_time, calc_time) of each batch.
+    """
+    end = time()
+    if head_pool is None:
+        for batch in zip(*loader):
+            data_time = time() - end
+            calc_begin = time()
+            output, acc = model([elem for each_batch in batch for elem in each_batch])
+            yield output, acc, data_time, time() - calc_begin
+            end = time()
+        return
+
+    emb_func = getattr(model, "module", model).emb_func
+    pending = deque()
+    for batch in zip(*loader):
+        data_time = time() - end
+        calc_begin = time()
+        batch = [elem for each_batch in batch for elem in each_batch]
+        with torch.no_grad():
+            feat = emb_func(batch[0].to(head_pool.device))
+        pending.append((head_pool.submit(batch, feat), data_time, time() - calc_begin))
+        if len(pending) > head_pool.workers:
+            yield _collect(pending.popleft(), head_pool.device)
+        end = time()
+    while pending:
+        yield _collect(pending.popleft(), head_pool.device)
+
+
+def _collect(item, device):
+    """
+    Wait for the result of a batch, its calc time is the embedding time plus the wait.
+    """
+    future, data_time, calc_time = item
+    wait_begin = time()
+    output, acc = future.result()
+    if isinstance(output, torch.Tensor):
+        output = output.to(device)
+    if dist.is_initialized():
+        # the workers have no process group, reduce the acc over the ranks as `accuracy` does,
+        # weighted by the number of queries
+        num_query = output.size(0) if isinstance(output, torch.Tensor) else 1
+        acc_sum = torch.tensor([acc * num_query, num_query], dtype=torch.float64, device=device)
+        dist.all_reduce(acc_sum, op=dist.ReduceOp.SUM)
+        acc = (acc_sum[0] / acc_sum[1]).item()
+
+    return output, acc, data_time, calc_time + time() - wait_begin
+
+
+def _init_head_worker(config, snapshot, num_threads):
+    global _head_model
+    torch.set_num_threads(num_threads)
+    device = torch.device("cpu")
+    emb_func = get_instance(arch, "backbone", config)
+    model_kwargs = {
+        "way_num": config["way_num"],
+        "shot_num": config["shot_num"] * config["augment_times"],
+        "query_num": config["query_num"],
+        "test_way": config["test_way"],
+        "test_shot": config["test_shot"] * config["augment_times"],
+        "test_query": config["test_query"],
+        "emb_func": emb_func,
+        "device": device,
+    }
+    _head_model = get_instance(arch, "classifier", config, **model_kwargs)
+    _head_model.load_state_dict(snapshot)
+    _head_model.eval()
+    _head_model.reverse_setting_info()
+
+
+def _run_head(batch, feat):
+    model = _head_model
+    with torch.set_grad_enabled(
+        model.model_type != ModelType.METRIC
+    ), feed_features(model, feat):
+        output, acc = model(batch)
+    if isinstance(output, torch.Tensor):
+        output = output.detach()
+
+    return output, acc
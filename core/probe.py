@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import gc
+import os
+import resource
+import threading
+
+import torch
+
+import core.model as arch
+from core.utils import ModelType, get_instance
+
+
+def probe_episode_size(
+    config, device, headroom=0.8, max_episode_size=64, stages=("train", "eval")
+):
+    """
+    Probe the largest train episode_size (batch_size for finetuning methods) and eval episode batch that fit
+    in the memory of a device.
+
+    The configured backbone and classifier are built on `device` and run forward/backward (train) or forward
+    (eval) on synthetic episodes of increasing size, until the peak memory exceeds `headroom` of the device
+    memory or runs out of memory. On CUDA the peak allocated memory is measured, on CPU the peak RSS sampled
+    during each step. The sizes are per device, those reported are multiplied by `n_gpu`, and only the sizes accepted
+    by `Trainer._check_data_config` are probed. A train size is measured on its micro-batch of
+    `accumulation_steps`, the part of the batch the trainer runs at once.
+
+    Args:
+        config (dict): Parsed config file.
+        device (torch.device): The device to probe.
+        headroom (float, optional): The fraction of the device memory to fill at most. Defaults to 0.8.
+        max_episode_size (int, optional): The largest episode_size (or batch_size) to probe. Defaults to 64.
+        stages (tuple, optional): The stages to probe. Defaults to ("train", "eval").
+
+    Returns:
+        dict: The probed peak memory of each size in "train" and/or "eval", a list of (size, peak bytes, fits),
+            the largest fitting sizes in "episode_size" (or "batch_size") and/or "eval_episode_size" (None if
+            none fits), "memory" and "capacity" in bytes.
+    """
+    emb_func = get_instance(arch, "backbone", config)
+    model_kwargs = {
+        "way_num": config["way_num"],
+        "shot_num": config["shot_num"] * config["augment_times"],
+        "query_num": config["query_num"],
+        "test_way": config["test_way"],
+        "test_shot": config["test_shot"] * config["augment_times"],
+        "test_query": config["test_query"],
+        "emb_func": emb_func,
+        "device": device,
+    }
+    model = get_instance(arch, "classifier", config, **model_kwargs).to(device)
+    n_gpu = max(config["n_gpu"], 1)
+    capacity = _get_capacity(device)
+    is_finetuning = model.model_type == ModelType.FINETUNING
+    train_key = "batch_size" if is_finetuning else "episode_size"
+
+    def train_step(size):
+        # the trainer runs a batch as accumulation_steps micro-batches, the peak is the one of a micro-batch
+        size //= config["accumulation_steps"]
+        model.train()
+        model.zero_grad(set_to_none=True)
+        batch = (
+            synthetic_batch(config, size, device)
+            if is_finetuning
+            else synthetic_episodes(model, config, size, device)
+        )
+        output, acc, loss = model(batch)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    def eval_step(size):
+        model.eval()
+        model.reverse_setting_info()
+        try:
+            with torch.set_grad_enabled(model.model_type != ModelType.METRIC):
+                model(synthetic_episodes(model, config, size, device))
+        finally:
+            model.reverse_setting_info()
+
+    # keep the sizes Trainer._check_data_config accepts
+    train_sizes = [
+        size
+        for size in range(1, max_episode_size // n_gpu + 1)
+        if size % config["accumulation_steps"] == 0
+        and (
+            is_finetuning
+            or (
+                config["train_episode"] % (size * n_gpu) == 0
+                and config["test_episode"] % (size * n_gpu) == 0
+            )
+        )
+    ]
+    eval_sizes = [
+        size
+        for size in range(1, max_episode_size // n_gpu + 1)
+        if config["test_episode"] % (size * n_gpu) == 0
+    ]
+
+    report = {"memory": "cuda allocated" if device.type == "cuda" else "cpu rss"}
+    # the smaller eval stage first, the memory a stage leaves to the allocator is not measured again
+    for stage, step, sizes in [
+        ("eval", eval_step, eval_sizes),
+        ("train", train_step, train_sizes),
+    ]:
+        if stage not in stages:
+            continue
+        results = []
+        for size in sizes:
+            peak = _measure_peak(step, size, device)
+            fits = peak is not None and peak <= headroom * capacity
+            results.append((size * n_gpu, peak, fits))
+            print(
+                "{} with {} {}: peak {}".format(
+                    stage,
+                    train_key if stage == "train" else "eval_episode_size",
+                    size * n_gpu,
+                    "out of memory" if peak is None else _format_bytes(peak),
+                )
+            )
+            if not fits:
+                break
+        report[stage] = results
+
+    for stage, key in [("train", train_key), ("eval", "eval_episode_size")]:
+        if stage in report:
+            report[key] = max(
+                [size for size, _, fits in report[stage] if fits], default=None
+            )
+    report["capacity"] = capacity
+
+    # release the model, the step closures keep referring to these names
+    model = emb_func = None
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+    return report
+
+
+def synthetic_episodes(model, config, episode_size, device):
+    """
+    Generate `episode_size` random episodes with the current way/shot/query setting of the model, shaped as
+    the few-shot dataloaders yield them.
+    """
+    way_num = model.way_num
+    sample_num = model.shot_num + model.query_num
+    num_class = max(get_num_class(config), way_num)
+    images = torch.randn(
+        episode_size * way_num * sample_num,
+        3,
+        config["image_size"],
+        config["image_size"],
+        device=device,
+    )
+    global_labels = (
+        torch.stack([torch.randperm(num_class)[:way_num] for _ in range(episode_size)])
+        .view(episode_size, way_num, 1)
+        .repeat(1, 1, sample_num)
+        .to(device)
+    )
+
+    return [images, global_labels]
+
+
+def synthetic_batch(config, batch_size, device):
+    """
+    Generate a random batch of images and targets, shaped as the finetuning train dataloader yields it.
+    """
+    num_class = get_num_class(config) or config["way_num"]
+    images = torch.randn(
+        batch_size, 3, config["image_size"], config["image_size"], device=device
+    )
+    targets = torch.randint(num_class, (batch_size,), device=device)
+
+    return [images, targets]
+
+
+def get_num_class(config):
+    """
+    Get the number of train classes of the classifier heads, 0 if the classifier has none.
+    """
+    return (config["classifier"]["kwargs"] or {}).get("num_class") or 0
+
+
+def _measure_peak(step, size, device):
+    """
+    Run `step(size)` and return the peak memory in bytes, or None if it runs out of memory.
+    """
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    try:
+        if device.type == "cuda" or not os.path.exists("/proc/self/statm"):
+            step(size)
+        else:
+            return _measure_cpu_peak(step, size)
+    except RuntimeError as e:
+        if "out of memory" not in str(e) and "can't allocate memory" not in str(e):
+            raise
+        return None
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    # without /proc, the peak RSS of the process, which never decreases
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_cpu_peak(step, size):
+    """
+    Run `step(size)` and return the peak of the current RSS sampled while it runs.
+
+    Unlike the lifetime peak RSS of the process, the sampled peak of a step does not include the peaks of
+    the steps before it. The heap freed by them is given back to the system first where glibc allows it.
+    """
+    _trim_heap()
+    peak = [_current_rss()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.001):
+            peak[0] = max(peak[0], _current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        step(size)
+    finally:
+        done.set()
+        sampler.join()
+
+    return max(peak[0], _current_rss())
+
+
+def _current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _trim_heap():
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _get_capacity(device):
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _format_bytes(num):
+    return "{:.1f} MB".format(num / 1024**2)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import itertools
+import os
+import queue
+import traceback
+from time import time
+
+import pandas as pd
+import torch
+
+from core.config import Config
+from core.data.dataset import build_image_cache
+
+
+def expand_sweep(configs, grid=None):
+    """
+    Expand a list of configs and a parameter grid to the list of experiments of a sweep.
+
+    Every config is combined with every point of the grid, e.g. `configs=["./config/proto.yaml",
+    "./config/dn4.yaml"]` and `grid={"shot_num": [1, 5]}` give four experiments.
+
+    Args:
+        configs (list): Config files, or (config file, variable dict) pairs.
+        grid (dict, optional): A list of values for each swept key, the keys are merged as a run_*.py
+            variable dict. Defaults to None.
+
+    Returns:
+        list: A list of (config file, variable dict).
+    """
+    grid = grid if grid is not None else {}
+    keys = list(grid.keys())
+    experiments = []
+    for config in configs:
+        config_file, variable_dict = (
+            (config, {}) if isinstance(config, str) else config
+        )
+        for values in itertools.product(*[grid[key] for key in keys]):
+            experiments.append(
+                (config_file, dict(variable_dict, **dict(zip(keys, values))))
+            )
+
+    return experiments
+
+
+def run_sweep(experiments, slots, shared_cache=None, result_file=None):
+    """
+    Run the experiments of a sweep concurrently, one per slot at a time, and collect their results.
+
+    A slot is the `device_ids` of a run, e.g. "0" or "2,3" for a run on two GPUs, or "cpu" for a run on
+    CPU. The CPU slots share the cores evenly. Each run trains in its own process as run_trainer.py does.
+    With `shared_cache`, the images of every split are decoded once into memmap caches before the
+    runs start (see `build_image_cache`), and all concurrent runs and their dataloader workers read
+    them through the shared OS page cache instead of each decoding the dataset.
+
+    Args:
+        experiments (list): A list of (config file, variable dict), e.g. from `expand_sweep`.
+        slots (list): The device_ids of each slot.
+        shared_cache (str, optional): The directory of the shared image caches. Defaults to None.
+        result_file (str, optional): Write the results table to this CSV file. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The results table, one row per experiment in the given order.
+    """
+    cpu_slots = sum(1 for slot in slots if slot == "cpu")
+    configs = []
+    ports = set()
+    for idx, (config_file, variable_dict) in enumerate(experiments):
+        config = Config(config_file, variable_dict).get_config_dict()
+        if shared_cache is not None:
+            config["shared_cache"] = shared_cache
+        # runs of the same method start within the same second, keep their result dirs apart
+        if config["tag"] is None and config["log_name"] is None:
+            config["tag"] = "sweep{}".format(idx)
+        while int(config["port"]) in ports:
+            config["port"] = int(config["port"]) + 1
+        ports.add(int(config["port"]))
+        configs.append(config)
+
+    if shared_cache is not None:
+        for data_root in sorted(set(config["data_root"] for config in configs)):
+            for mode in ["train", "val", "test"]:
+                build_image_cache(data_root, mode, shared_cache)
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    results = [None] * len(configs)
+    pending = list(range(len(configs)))
+    running = {}
+    while pending or running:
+        for slot in slots:
+            if slot in running or not pending:
+                continue
+            idx = pending.pop(0)
+            config = _assign_slot(configs[idx], slot, cpu_slots)
+            print("[sweep] start {} on {}".format(_describe(experiments[idx]), slot))
+            process = ctx.Process(target=sweep_worker, args=(idx, config, result_queue))
+            process.start()
+            running[slot] = (idx, process, time())
+
+        try:
+            idx, result = result_queue.get(timeout=10)
+            results[idx] = result
+        except queue.Empty:
+            pass
+
+        for slot, (idx, process, start) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            # drain the result the process put just before exiting
+            while results[idx] is None:
+                try:
+                    other_idx, result = result_queue.get(timeout=1)
+                    results[other_idx] = result
+                except queue.Empty:
+                    results[idx] = {
+                        "status": "failed",
+                        "error": "exit code {}".format(process.exitcode),
+                    }
+            results[idx]["time"] = time() - start
+            if results[idx]["status"] == "failed":
+                print(results[idx]["error"])
+            print(
+                "[sweep] {} {} on {}".format(
+                    _describe(experiments[idx]), results[idx]["status"], slot
+                )
+            )
+            del running[slot]
+
+    table = _results_table(experiments, results)
+    print(table.to_string(index=False))
+    if result_file is not None:
+        table.to_csv(result_file, index=False)
+
+    return table
+
+
+def sweep_worker(idx, config, result_queue):
+    """
+    The process of one sweep run: train as run_trainer.py does and put (idx, result) to `result_queue`.
+    """
+    try:
+        if config["n_gpu"] > 1:
+            run_queue = torch.multiprocessing.get_context("spawn").SimpleQueue()
+            os.environ["CUDA_VISIBLE_DEVICES"] = config["device_ids"]
+            torch.multiprocessing.spawn(
+                _train, nprocs=config["n_gpu"], args=(config, run_queue)
+            )
+            result = run_queue.get()
+        else:
+            result = _train(0, config)
+        result["status"] = "done"
+    except Exception:
+        result = {"status": "failed", "error": traceback.format_exc()}
+    result_queue.put((idx, result))
+
+
+def _train(rank, config, run_queue=None):
+    # import here, the sweep process itself does not build any model
+    from core import Trainer
+
+    trainer = Trainer(rank, config)
+    trainer.train_loop(rank)
+    result = {
+        "result_path": trainer.result_path,
+        "best_val_acc": trainer.best_val_acc,
+        "best_test_acc": trainer.best_test_acc,
+    }
+    if rank == 0 and run_queue is not None:
+        run_queue.put(result)
+
+    return result
+
+
+def _assign_slot(config, slot, cpu_slots):
+    """
+    Set the devices of a run to those of its slot.
+    """
+    config = dict(config)
+    if slot == "cpu":
+        config.update(device_ids="", n_gpu=1, use_cpu=True)
+        if config["num_threads"] is None:
+            config["num_threads"] = max(1, (os.cpu_count() or 1) // cpu_slots)
+    else:
+        config.update(device_ids=slot, n_gpu=len(slot.split(",")))
+
+    return config
+
+
+def _describe(experiment):
+    config_file, variable_dict = experiment
+    return " ".join(
+        [os.path.basename(config_file)]
+        + ["{}={}".format(key, value) for key, value in variable_dict.items()]
+    )
+
+
+def _results_table(experiments, results):
+    """
+    Gather the results in a table with the config file and swept values of each experiment.
+    """
+    rows = []
+    for (config_file, variable_dict), result in zip(experiments, results):
+        row = {"config": config_file}
+        row.update({key: str(value) for key, value in variable_dict.items()})
+        row.update(
+            {
+                "status": result["status"],
+                "best_val_acc": result.get("best_val_acc"),
+                "best_test_acc": result.get("best_test_acc"),
+                "time": "{:.0f}s".format(result["time"]),
+                "result_path": result.get(
+                    "result_path", result.get("error", "").strip().split("\n")[-1]
+                ),
+            }
+        )
+        rows.append(row)
+
+    return pd.DataFrame(rows)
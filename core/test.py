@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import logging
 import os
 import builtins
 from logging import getLogger
@@ -11,6 +12,8 @@ import torch.distributed as dist
 
 import core.model as arch
 from core.data import get_dataloader
+from core.pipeline import HeadPool, check_head_pool, eval_outputs, log_knn_reports
+from core.probe import probe_episode_size
 from core.utils import (
     init_logger_config,
     prepare_device,
@@ -19,9 +22,13 @@ from core.utils import (
     AverageMeter,
     count_parameters,
     ModelType,
+    StageProfiler,
     TensorboardWriter,
     mean_confidence_interval,
     get_instance,
+    init_threads,
+    get_rng_state,
+    set_rng_state,
 )
 
 
@@ -41,11 +48,14 @@ class Test(object):
         self.viz_path, self.state_dict_path = self._init_files(config)
         self.logger = self._init_logger()
         self.device, self.list_ids = self._init_device(rank, config)
+        self._init_eval_episode_size(config)
         self.writer = self._init_writer(self.viz_path)
         self.test_meter = self._init_meter()
         print(config)
         self.model, self.model_type = self._init_model(config)
+        self._check_head_pool(config)
         self.test_loader = self._init_dataloader(config)
+        self.profiler = self._init_profiler(config)
 
     def test_loop(self):
         """
@@ -93,72 +103,243 @@ class Test(object):
             self.model.reverse_setting_info()
         meter = self.test_meter
         meter.reset()
-        episode_size = self.config["episode_size"]
+        if self.profiler is not None:
+            self.profiler.set_mode("test")
+        episode_size = self.config["eval_episode_size"]
         accuracies = []
 
         end = time()
         enable_grad = self.model_type != ModelType.METRIC
-        log_scale = self.config["episode_size"]
+        log_scale = self.config["eval_episode_size"]
         with torch.set_grad_enabled(enable_grad):
             loader = self.test_loader
-            for batch_idx, batch in enumerate(zip(*loader)):
-                if self.rank == 0:
-                    self.writer.set_step(
-                        int(
-                            (
-                                epoch_idx * len(self.test_loader)
-                                + batch_idx * episode_size
+            head_pool = self._init_head_pool()
+            try:
+                outputs = eval_outputs(self.model, loader, head_pool)
+                for batch_idx, (output, acc, data_time, calc_time) in enumerate(outputs):
+                    if self.rank == 0:
+                        self.writer.set_step(
+                            int(
+                                (
+                                    epoch_idx * len(self.test_loader)
+                                    + batch_idx * episode_size
+                                )
+                                * self.config["tb_scale"]
                             )
-                            * self.config["tb_scale"]
                         )
-                    )
 
-                meter.update("data_time", time() - end)
-
-                # calculate the output
-                calc_begin = time()
-                output, acc = self.model([elem for each_batch in batch for elem in each_batch])
-                accuracies.append(acc)
-                meter.update("calc_time", time() - calc_begin)
-
-                # measure accuracy and record loss
-                meter.update("acc", acc)
-
-                # measure elapsed time
-                meter.update("batch_time", time() - end)
-
-                if ((batch_idx + 1) * log_scale % self.config["log_interval"] == 0) or (
-                    batch_idx + 1
-                ) * episode_size >= max(map(len, loader)) * log_scale:
-                    info_str = (
-                        "Epoch-({}): [{}/{}]\t"
-                        "Time {:.3f} ({:.3f})\t"
-                        "Calc {:.3f} ({:.3f})\t"
-                        "Data {:.3f} ({:.3f})\t"
-                        "Acc@1 {:.3f} ({:.3f})".format(
-                            epoch_idx,
-                            (batch_idx + 1) * log_scale,
-                            max(map(len, loader)) * log_scale,
-                            meter.last("batch_time"),
-                            meter.avg("batch_time"),
-                            meter.last("calc_time"),
-                            meter.avg("calc_time"),
-                            meter.last("data_time"),
-                            meter.avg("data_time"),
-                            meter.last("acc"),
-                            meter.avg("acc"),
+                    meter.update("data_time", data_time)
+                    accuracies.extend(self._split_accuracies(output, acc, episode_size))
+                    meter.update("calc_time", calc_time)
+                    if self.profiler is not None:
+                        self.profiler.step()
+
+                    # measure accuracy and record loss
+                    meter.update("acc", acc)
+
+                    # measure elapsed time
+                    meter.update("batch_time", time() - end)
+
+                    if ((batch_idx + 1) * log_scale % self.config["log_interval"] == 0) or (
+                        batch_idx + 1
+                    ) * episode_size >= max(map(len, loader)) * log_scale:
+                        info_str = (
+                            "Epoch-({}): [{}/{}]\t"
+                            "Time {:.3f} ({:.3f})\t"
+                            "Calc {:.3f} ({:.3f})\t"
+                            "Data {:.3f} ({:.3f})\t"
+                            "Acc@1 {:.3f} ({:.3f})".format(
+                                epoch_idx,
+                                (batch_idx + 1) * log_scale,
+                                max(map(len, loader)) * log_scale,
+                                meter.last("batch_time"),
+                                meter.avg("batch_time"),
+                                meter.last("calc_time"),
+                                meter.avg("calc_time"),
+                                meter.last("data_time"),
+                                meter.avg("data_time"),
+                                meter.last("acc"),
+                                meter.avg("acc"),
+                            )
                         )
-                    )
-                    print(info_str)
-                end = time()
-
-
+                        print(info_str)
+                        self._log_profiler()
+                    end = time()
+            finally:
+                if head_pool is not None:
+                    head_pool.close()
+
+        self._log_knn_report()
+        if self.profiler is not None:
+            print(" * Stages:\n{}".format(self.profiler.summary()))
         if self.distribute:
             self.model.module.reverse_setting_info()
         else:
             self.model.reverse_setting_info()
         return meter.avg("acc"), accuracies
 
+    def _check_head_pool(self, config):
+        """
+        Fall back to running the whole model in the test loop if `eval_pipeline_workers` is set but the
+        heads of the model cannot run in a pool, before any training or testing.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if not config["eval_pipeline_workers"]:
+            return
+
+        reason = check_head_pool(
+            self.model.module if self.distribute else self.model, config
+        )
+        if reason is not None:
+            config["eval_pipeline_workers"] = 0
+            print(
+                "{}, turn eval_pipeline_workers off".format(reason),
+                level="warning",
+            )
+
+    def _init_head_pool(self):
+        """
+        Start a pool running the heads of the test batches if `eval_pipeline_workers` is set.
+
+        Returns:
+            HeadPool: The head pool, None to run the whole model in the loop.
+        """
+        workers = self.config["eval_pipeline_workers"]
+        if not workers:
+            return None
+
+        return HeadPool(
+            self.config, self.model.module if self.distribute else self.model, workers
+        )
+
+    def _log_knn_report(self):
+        """
+        Print the recall and accuracy of the approximate descriptor indices of the model (`knn_index`)
+        against the exact search, if `knn_index_report` is set.
+
+        The report turns `eval_pipeline_workers` off, see `check_head_pool`.
+        """
+        log_knn_reports(self.model.module if self.distribute else self.model)
+
+    def _init_profiler(self, config):
+        """
+        Init the stage profiler if `profile_stages` or `profile_memory` is set.
+
+        Args:
+            config (dict): Parsed config file.
+
+        Returns:
+            StageProfiler: The profiler hooked on the model, None if profiling is off.
+        """
+        if not config["profile_stages"] and not config["profile_memory"]:
+            return None
+        return StageProfiler(
+            self.model.module if self.distribute else self.model,
+            self.device,
+            time_stages=config["profile_stages"],
+            track_memory=config["profile_memory"],
+        )
+
+    def _log_profiler(self):
+        """
+        Print the memory of each stage and write the stage means to tensorboard.
+        """
+        if self.profiler is None:
+            return
+        if self.profiler.track_memory:
+            print(
+                "Memory (MB, {}) {}".format(
+                    "/".join(self.profiler.memory_keys), self.profiler.memory_str()
+                )
+            )
+        if self.rank == 0:
+            self.profiler.log(self.writer)
+
+    def _split_accuracies(self, output, acc, episode_size):
+        """
+        Split the acc of a batch into the accs of its episodes, for the confidence interval.
+
+        The output is expected to be the [episode_size * way_num * query_num, way_num] logits of the query
+        samples, in the order of the episodes. Otherwise each episode gets the acc of the batch.
+
+        Args:
+            output (torch.Tensor): The output of the model.
+            acc (float): The acc of the batch.
+            episode_size (int): The number of episodes in the batch of all ranks.
+
+        Returns:
+            list: The accs of the episodes.
+        """
+        if episode_size == 1:
+            return [acc]
+
+        model = self.model.module if self.distribute else self.model
+        way_num, query_num = model.way_num, model.query_num
+        rank_episode_size = episode_size // self.config["n_gpu"]
+        if (
+            isinstance(output, torch.Tensor)
+            and output.numel() == rank_episode_size * way_num * query_num * way_num
+        ):
+            target = torch.arange(way_num, device=output.device).repeat_interleave(
+                query_num
+            )
+            episode_acc = (
+                (
+                    output.detach().reshape(rank_episode_size, -1, way_num).argmax(-1)
+                    == target
+                )
+                .float()
+                .mean(-1)
+                * 100
+            )
+            if self.distribute:
+                episode_accs = [torch.zeros_like(episode_acc) for _ in range(self.config["n_gpu"])]
+                dist.all_gather(episode_accs, episode_acc)
+                episode_acc = torch.cat(episode_accs)
+            if abs(episode_acc.mean().item() - acc) < 1e-3:
+                return episode_acc.tolist()
+
+        if not getattr(self, "_warned_split", False):
+            self._warned_split = True
+            print(
+                "can not split the acc of {} by episode, the confidence interval is computed over batches".format(
+                    self.config["classifier"]["name"]
+                ),
+                level="warning",
+            )
+        return [acc] * episode_size
+
+    def _init_eval_episode_size(self, config):
+        """
+        Use episode_size as eval_episode_size when it is ~, probe the largest one that fits in the memory
+        headroom when it is auto.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if config["eval_episode_size"] is None:
+            config["eval_episode_size"] = config["episode_size"]
+        elif config["eval_episode_size"] == "auto":
+            print("============ Probe the eval episode size ============")
+            rng_state = get_rng_state()
+            report = probe_episode_size(
+                config,
+                self.device,
+                config["probe_headroom"],
+                config["probe_max_episode_size"],
+                ["eval"],
+            )
+            set_rng_state(rng_state)
+            size = torch.tensor(report["eval_episode_size"] or 0, device=self.device)
+            if self.distribute:
+                dist.all_reduce(size, op=dist.ReduceOp.MIN)
+            if size.item() == 0:
+                print("no eval_episode_size fits in the memory headroom", level="warning")
+            config["eval_episode_size"] = max(size.item(), config["n_gpu"])
+            print("use eval_episode_size {}".format(config["eval_episode_size"]))
+
     def _init_files(self, config):
         """
         Init result_path(log_path, viz_path) from the config dict.
@@ -204,8 +385,10 @@ class Test(object):
         self.logger = getLogger(__name__)
 
         # Hack print
-        def use_logger(msg, level="info"):
+        def use_logger(msg, level="info", all_rank=False):
             if self.rank != 0:
+                if all_rank:
+                    getattr(logging, level)(msg)
                 return
             if level == "info":
                 self.logger.info(msg)
@@ -260,10 +443,18 @@ class Test(object):
             self.config["train_episode"], self.config["episode_size"]
         )
 
+        # check: the test episodes split evenly into eval_episode_size batches on n_gpu
+        assert (
+            self.config["eval_episode_size"] % self.config["n_gpu"] == 0
+            and self.config["eval_episode_size"] != 0
+        ), "eval_episode_size {} % n_gpu {} != 0".format(
+            self.config["eval_episode_size"], self.config["n_gpu"]
+        )
+
         assert (
-            self.config["test_episode"] % self.config["episode_size"] == 0
-        ), "test_episode {} % episode_size  {} != 0".format(
-            self.config["test_episode"], self.config["episode_size"]
+            self.config["test_episode"] % self.config["eval_episode_size"] == 0
+        ), "test_episode {} % eval_episode_size  {} != 0".format(
+            self.config["test_episode"], self.config["eval_episode_size"]
         )
 
     def _init_model(self, config):
@@ -296,26 +487,30 @@ class Test(object):
         model.load_state_dict(state_dict)
 
         if self.distribute:
-            # higher order grad of BN in multi gpu will conflict with syncBN
-            # FIXME MAML with multi GPU is conflict with syncBN
-            if not (
-                self.config["classifier"]["name"] in ["MAML"]
-                and self.config["n_gpu"] > 1
-            ):
-                model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
-            else:
-                print(
-                    "{} with multi GPU will conflict with syncBN".format(
-                        self.config["classifier"]["name"]
-                    ),
-                    level="warning",
-                )
-            model = model.to(self.rank)
+            if self.config["sync_bn"]:
+                # higher order grad of BN in multi gpu will conflict with syncBN
+                # FIXME MAML with multi GPU is conflict with syncBN
+                if not (
+                    self.config["classifier"]["name"] in ["MAML"]
+                    and self.config["n_gpu"] > 1
+                ):
+                    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+                else:
+                    print(
+                        "{} with multi GPU will conflict with syncBN".format(
+                            self.config["classifier"]["name"]
+                        ),
+                        level="warning",
+                    )
+            model = model.to(self.device)
             model = nn.parallel.DistributedDataParallel(
                 model,
-                device_ids=[self.rank],
-                output_device=self.rank,
-                find_unused_parameters=True,
+                device_ids=[self.rank] if self.device.type == "cuda" else None,
+                output_device=self.rank if self.device.type == "cuda" else None,
+                # no train step to detect the unused parameters, keep the safe default
+                find_unused_parameters=self.config["find_unused_parameters"] is not False,
+                static_graph=bool(self.config["static_graph"]),
+                bucket_cap_mb=self.config["bucket_cap_mb"],
             )
 
             return model, model.module.model_type
@@ -339,14 +534,24 @@ class Test(object):
             rank,
             config["device_ids"],
             config["n_gpu"],
-            backend="nccl"
+            backend=None
             if "dist_backend" not in self.config
             else self.config["dist_backend"],
             dist_url="tcp://127.0.0.1:" + str(config["port"])
             if "dist_url" not in self.config
             else self.config["dist_url"],
+            use_cpu=config["use_cpu"],
+        )
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        init_threads(
+            rank,
+            config["n_gpu"],
+            device,
+            config["num_threads"],
+            config["num_interop_threads"],
+            config["cpu_affinity"],
         )
-        torch.cuda.set_device(self.rank)
 
         return device, list_ids
 
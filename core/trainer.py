@@ -2,7 +2,10 @@
 import datetime
 import logging
 import os
+import signal
+import sys
 import builtins
+import contextlib
 from logging import getLogger
 from time import time
 
@@ -14,10 +17,16 @@ import torch.distributed as dist
 from queue import Queue
 import core.model as arch
 from core.data import get_dataloader
+from core.data.collates import use_teacher_cache
+from core.evaluator import AsyncEvaluator
+from core.model.finetuning.teacher_cache import TeacherLogitCache, get_teacher_cache_path
+from core.pipeline import HeadPool, check_head_pool, eval_outputs, log_knn_reports
+from core.probe import probe_episode_size
 from core.utils import (
     AverageMeter,
     ModelType,
     SaveType,
+    StageProfiler,
     TensorboardWriter,
     count_parameters,
     create_dirs,
@@ -27,8 +36,11 @@ from core.utils import (
     prepare_device,
     save_model,
     get_instance,
+    init_threads,
     data_prefetcher,
     GradualWarmupScheduler,
+    get_rng_state,
+    set_rng_state,
 )
 
 
@@ -52,15 +64,20 @@ class Trainer(object):
         ) = self._init_files(config)
         self.logger = self._init_logger()
         self.device, self.list_ids = self._init_device(rank, config)
+        self._init_episode_size(config)
         self.writer = self._init_writer(self.viz_path)
         self.train_meter, self.val_meter, self.test_meter = self._init_meter()
         print(self.config)
+        self.resume_dict = self._init_resume_dict(config)
         self.model, self.model_type = self._init_model(config)
+        self._check_head_pool(config)
+        self._check_teacher_cache(config)
         (
             self.train_loader,
             self.val_loader,
             self.test_loader,
         ) = self._init_dataloader(config)
+        self._init_teacher_cache(config)
         (
             self.optimizer,
             self.scheduler,
@@ -68,7 +85,12 @@ class Trainer(object):
             self.best_val_acc,
             self.best_test_acc,
         ) = self._init_optim(config)
+        self.from_batch = self._init_resume_state()
         self.val_per_epoch = config["val_per_epoch"]
+        self.preempt_signal = 0
+        self._init_preempt_handler(config)
+        self.evaluator = self._init_evaluator(config)
+        self.profiler = self._init_profiler(config)
 
     def train_loop(self, rank):
         """
@@ -76,41 +98,76 @@ class Trainer(object):
         """
         experiment_begin = time()
         for epoch_idx in range(self.from_epoch + 1, self.config["epoch"]):
-            if self.distribute and self.model_type == ModelType.FINETUNING:
+            if (
+                self.distribute
+                and self.model_type == ModelType.FINETUNING
+                and not self._is_train_seekable()
+            ):
                 self.train_loader[0].sampler.set_epoch(epoch_idx)
             print("============ Train on the train set ============")
             print("learning rate: {}".format(self.scheduler.get_last_lr()))
-            train_acc = self._train(epoch_idx)
+            train_acc = self._train(
+                epoch_idx, self.from_batch if epoch_idx == self.from_epoch + 1 else 0
+            )
             print(" * Acc@1 {:.3f} ".format(train_acc))
-            if ((epoch_idx + 1) % self.val_per_epoch) == 0:
+            if (
+                (epoch_idx + 1) % self.val_per_epoch
+            ) == 0 and self.config["async_eval_device"] is not None:
+                # only rank 0 holds the evaluator, the other ranks go on training
+                if self.evaluator is not None:
+                    print("============ Submit to the async evaluator ============")
+                    self.evaluator.submit(
+                        epoch_idx, self.model.module if self.distribute else self.model
+                    )
+            elif ((epoch_idx + 1) % self.val_per_epoch) == 0:
                 print("============ Validation on the val set ============")
                 val_acc = self._validate(epoch_idx, is_test=False)
                 print(
                     " * Acc@1 {:.3f} Best acc {:.3f}".format(val_acc, self.best_val_acc)
                 )
-                print("============ Testing on the test set ============")
-                test_acc = self._validate(epoch_idx, is_test=True)
-                print(
-                    " * Acc@1 {:.3f} Best acc {:.3f}".format(
-                        test_acc, self.best_test_acc
+                # val_acc is reduced over the ranks, so all ranks agree on whether to test
+                is_best = val_acc > self.best_val_acc
+                test_acc = None
+                if self._should_test(is_best):
+                    print("============ Testing on the test set ============")
+                    test_acc = self._validate(epoch_idx, is_test=True)
+                    print(
+                        " * Acc@1 {:.3f} Best acc {:.3f}".format(
+                            test_acc, self.best_test_acc
+                        )
                     )
-                )
+                if is_best:
+                    self.best_val_acc = val_acc
+                    self.best_test_acc = test_acc
             time_scheduler = self._cal_time_scheduler(experiment_begin, epoch_idx)
             print(" * Time: {}".format(time_scheduler))
             self.scheduler.step()
 
             if self.rank == 0:
-                if ((epoch_idx + 1) % self.val_per_epoch) == 0:
-                    if val_acc > self.best_val_acc:
-                        self.best_val_acc = val_acc
-                        self.best_test_acc = test_acc
+                if self.evaluator is not None:
+                    self._collect_eval_results()
+                elif ((epoch_idx + 1) % self.val_per_epoch) == 0:
+                    if is_best:
                         self._save_model(epoch_idx, SaveType.BEST)
 
+                if ((epoch_idx + 1) % self.val_per_epoch) == 0:
                     if epoch_idx != 0 and epoch_idx % self.config["save_interval"] == 0:
                         self._save_model(epoch_idx, SaveType.NORMAL)
 
                 self._save_model(epoch_idx, SaveType.LAST)
 
+            if self._sync_preempt_signal():
+                if self.evaluator is not None:
+                    # save the best accuracies of the pending evaluations with the last model
+                    self._close_evaluator()
+                    self._save_model(epoch_idx, SaveType.LAST)
+                self._exit_preempted()
+
+        self._close_evaluator()
+
+        if self.config["lazy_test"] == "end":
+            self._test_best_model()
+
         if self.rank == 0:
             print(
                 "End of experiment, took {}".format(
@@ -126,20 +183,24 @@ class Trainer(object):
         elif self.distribute:
             dist.barrier()
 
-    def _train(self, epoch_idx):
+    def _train(self, epoch_idx, from_batch=0):
         """
         The train stage.
 
         Args:
             epoch_idx (int): Epoch index.
+            from_batch (int, optional): The batch index to resume the epoch from. Defaults to 0.
 
         Returns:
             float: Acc.
         """
         self.model.train()
+        if self.profiler is not None:
+            self.profiler.set_mode("train")
 
         meter = self.train_meter
-        meter.reset()
+        if from_batch == 0:
+            meter.reset()
         episode_size = (
             1
             if self.model_type == ModelType.FINETUNING
@@ -148,7 +209,13 @@ class Trainer(object):
 
         end = time()
         log_scale = 1 if self.model_type == ModelType.FINETUNING else episode_size
-        for batch_idx, batch in enumerate(zip(*self.train_loader)):
+        seekable = self._is_train_seekable()
+        checkpoint_episode = self.config["checkpoint_episode"]
+        # the seekable sampler has already skipped the finished batches of a resumed epoch
+        for batch_idx, batch in zip(
+            range(from_batch, max(map(len, self.train_loader))),
+            zip(*self.train_loader),
+        ):
             if self.rank == 0:
                 self.writer.set_step(
                     epoch_idx * max(map(len, self.train_loader))
@@ -163,25 +230,29 @@ class Trainer(object):
                         self.writer.add_histogram(save_name, param)
 
             meter.update("data_time", time() - end)
+            if self.profiler is not None:
+                self.profiler.trace_step(epoch_idx, batch_idx * log_scale)
 
-            # calculate the output
             calc_begin = time()
-            output, acc, loss = self.model(
+            # calculate the output and gradients
+            self.optimizer.zero_grad()
+            acc, loss = self._forward_backward(
                 [elem for each_batch in batch for elem in each_batch]
             )
-
-            # compute gradients
-            self.optimizer.zero_grad()
-            loss.backward()
+            if self.distribute and self.detect_unused:
+                self._detect_unused_parameters()
             # nn.utils.clip_grad_norm_(self.model.parameters(), 2.0)
             # for param in self.model.parameters():
             #     if (param.grad != param.grad).float().sum() != 0:  # nan detected
             #         param.grad.zero_()
-            self.optimizer.step()
+            with self._profile_stage("optimizer_step"):
+                self.optimizer.step()
             meter.update("calc_time", time() - calc_begin)
+            if self.profiler is not None:
+                self.profiler.step()
 
             # measure accuracy and record loss
-            meter.update("loss", loss.item())
+            meter.update("loss", loss)
             meter.update("acc1", acc)
 
             # measure elapsed time
@@ -214,10 +285,73 @@ class Trainer(object):
                     )
                 )
                 print(info_str)
+                self._log_profiler()
+
+            preempt_signal = self._sync_preempt_signal()
+            if preempt_signal:
+                # save the best accuracies of the pending evaluations with the resume state
+                self._close_evaluator()
+            if seekable and (
+                preempt_signal
+                or checkpoint_episode > 0
+                and (batch_idx + 1) * log_scale // checkpoint_episode
+                > batch_idx * log_scale // checkpoint_episode
+            ):
+                self._save_resume_state(epoch_idx, batch_idx + 1)
+            if preempt_signal:
+                self._train_epoch_end()
+                self._exit_preempted()
             end = time()
 
+        self._train_epoch_end()
+        if self.profiler is not None:
+            self.profiler.stop_trace()
+            print(" * Stages:\n{}".format(self.profiler.summary()))
         return meter.avg("acc1")
 
+    def _train_epoch_end(self):
+        """
+        Let the model finish a train epoch, e.g. IfslPretrain stores its class-mean features.
+        """
+        (self.model.module if self.distribute else self.model).train_epoch_end()
+
+    def _forward_backward(self, batch):
+        """
+        Calculate the loss of a train batch and backpropagate it.
+
+        With `accumulation_steps` > 1, the batch is split into micro-batches along the first dim (episodes
+        for the few-shot loaders, images for the finetuning loaders) whose gradients are accumulated. Under
+        DDP the gradients are only all-reduced for the last micro-batch.
+
+        Args:
+            batch (list): The flattened batch of all train loaders.
+
+        Returns:
+            tuple: A tuple of (acc, loss) of the whole batch.
+        """
+        steps = self.config["accumulation_steps"]
+        if steps == 1:
+            output, acc, loss = self.model(batch)
+            with self._profile_stage("backward"):
+                loss.backward()
+            return acc, loss.item()
+
+        acc, loss = 0.0, 0.0
+        micro_batches = zip(*[elem.chunk(steps) for elem in batch])
+        for step, micro_batch in enumerate(micro_batches):
+            with (
+                self.model.no_sync()
+                if self.distribute and step < steps - 1
+                else contextlib.nullcontext()
+            ):
+                output, micro_acc, micro_loss = self.model(list(micro_batch))
+                with self._profile_stage("backward"):
+                    (micro_loss / steps).backward()
+            acc += micro_acc / steps
+            loss += micro_loss.item() / steps
+
+        return acc, loss
+
     def _validate(self, epoch_idx, is_test=False):
         """
         The val/test stage.
@@ -236,65 +370,73 @@ class Trainer(object):
             self.model.reverse_setting_info()
         meter = self.test_meter if is_test else self.val_meter
         meter.reset()
-        episode_size = self.config["episode_size"]
+        if self.profiler is not None:
+            self.profiler.set_mode("test" if is_test else "val")
+        episode_size = self.config["eval_episode_size"]
 
         end = time()
         enable_grad = self.model_type != ModelType.METRIC
-        log_scale = self.config["episode_size"]
+        log_scale = self.config["eval_episode_size"]
         with torch.set_grad_enabled(enable_grad):
             loader = self.test_loader if is_test else self.val_loader
-            for batch_idx, batch in enumerate(zip(*loader)):
-                if self.rank == 0:
-                    self.writer.set_step(
-                        int(
-                            (
-                                epoch_idx * max(map(len, loader))
-                                + batch_idx * episode_size
+            head_pool = self._init_head_pool()
+            try:
+                outputs = eval_outputs(self.model, loader, head_pool)
+                for batch_idx, (output, acc, data_time, calc_time) in enumerate(outputs):
+                    if self.rank == 0:
+                        self.writer.set_step(
+                            int(
+                                (
+                                    epoch_idx * max(map(len, loader))
+                                    + batch_idx * episode_size
+                                )
+                                * self.config["tb_scale"]
                             )
-                            * self.config["tb_scale"]
                         )
-                    )
-
-                meter.update("data_time", time() - end)
 
-                # calculate the output
-                calc_begin = time()
-                output, acc = self.model(
-                    [elem for each_batch in batch for elem in each_batch]
-                )
-                meter.update("calc_time", time() - calc_begin)
-
-                # measure accuracy and record loss
-                meter.update("acc1", acc)
-
-                # measure elapsed time
-                meter.update("batch_time", time() - end)
-
-                if ((batch_idx + 1) * log_scale % self.config["log_interval"] == 0) or (
-                    batch_idx + 1
-                ) * episode_size >= max(map(len, loader)) * log_scale:
-                    info_str = (
-                        "Epoch-({}): [{}/{}]\t"
-                        "Time {:.3f} ({:.3f})\t"
-                        "Calc {:.3f} ({:.3f})\t"
-                        "Data {:.3f} ({:.3f})\t"
-                        "Acc@1 {:.3f} ({:.3f})".format(
-                            epoch_idx,
-                            (batch_idx + 1) * log_scale,
-                            max(map(len, loader)) * log_scale,
-                            meter.last("batch_time"),
-                            meter.avg("batch_time"),
-                            meter.last("calc_time"),
-                            meter.avg("calc_time"),
-                            meter.last("data_time"),
-                            meter.avg("data_time"),
-                            meter.last("acc1"),
-                            meter.avg("acc1"),
+                    meter.update("data_time", data_time)
+                    meter.update("calc_time", calc_time)
+                    if self.profiler is not None:
+                        self.profiler.step()
+
+                    # measure accuracy and record loss
+                    meter.update("acc1", acc)
+
+                    # measure elapsed time
+                    meter.update("batch_time", time() - end)
+
+                    if ((batch_idx + 1) * log_scale % self.config["log_interval"] == 0) or (
+                        batch_idx + 1
+                    ) * episode_size >= max(map(len, loader)) * log_scale:
+                        info_str = (
+                            "Epoch-({}): [{}/{}]\t"
+                            "Time {:.3f} ({:.3f})\t"
+                            "Calc {:.3f} ({:.3f})\t"
+                            "Data {:.3f} ({:.3f})\t"
+                            "Acc@1 {:.3f} ({:.3f})".format(
+                                epoch_idx,
+                                (batch_idx + 1) * log_scale,
+                                max(map(len, loader)) * log_scale,
+                                meter.last("batch_time"),
+                                meter.avg("batch_time"),
+                                meter.last("calc_time"),
+                                meter.avg("calc_time"),
+                                meter.last("data_time"),
+                                meter.avg("data_time"),
+                                meter.last("acc1"),
+                                meter.avg("acc1"),
+                            )
                         )
-                    )
-                    print(info_str)
-                end = time()
-
+                        print(info_str)
+                        self._log_profiler()
+                    end = time()
+            finally:
+                if head_pool is not None:
+                    head_pool.close()
+
+        self._log_knn_report()
+        if self.profiler is not None:
+            print(" * Stages:\n{}".format(self.profiler.summary()))
         if self.distribute:
             self.model.module.reverse_setting_info()
         else:
@@ -397,6 +539,47 @@ class Trainer(object):
 
         return train_loader, val_loader, test_loader
 
+    def _check_teacher_cache(self, config):
+        """
+        Turn `teacher_cache` off before the dataloaders are built if the model has no distillation teacher,
+        so that the train batches do not carry the keys of the cache.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if not use_teacher_cache(config, "train", self.model_type):
+            return
+
+        model = self.model.module if self.distribute else self.model
+        distill_layer = getattr(model, "distill_layer", None)
+        if distill_layer is None or distill_layer.emb_func is None:
+            config["teacher_cache"] = None
+            print(
+                "{} has no distillation teacher, turn teacher_cache off".format(
+                    config["classifier"]["name"]
+                ),
+                level="warning",
+            )
+
+    def _init_teacher_cache(self, config):
+        """
+        Cache the logits of the distillation teacher of the model if `teacher_cache` is set.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if not use_teacher_cache(config, "train", self.model_type):
+            return
+
+        model = self.model.module if self.distribute else self.model
+        cache_path = get_teacher_cache_path(config["teacher_cache"], config)
+        print("cache the teacher logits in {}".format(cache_path))
+        model.distill_layer.cache = TeacherLogitCache(
+            cache_path,
+            len(self.train_loader[0].dataset) * config["teacher_cache_seeds"],
+            model.num_class,
+        )
+
     def _init_model(self, config):
         """
         Init model(backbone+classifier) from the config dict and load the pretrained params or resume from a
@@ -437,12 +620,9 @@ class Trainer(object):
             if len(msg.unexpected_keys) != 0:
                 print("Unexpected keys:{}".format(msg.unexpected_keys), level="warning")
 
-        if self.config["resume"]:
-            resume_path = os.path.join(
-                self.config["resume_path"], "checkpoints", "model_last.pth"
-            )
-            print("load the resume model checkpoints dict from {}.".format(resume_path))
-            state_dict = torch.load(resume_path, map_location="cpu")["model"]
+        if self.resume_dict is not None:
+            print("load the resume model checkpoints dict.")
+            state_dict = self.resume_dict["model"]
             msg = model.load_state_dict(state_dict, strict=False)
 
             if len(msg.missing_keys) != 0:
@@ -451,34 +631,92 @@ class Trainer(object):
                 print("unexpected keys:{}".format(msg.unexpected_keys), level="warning")
 
         if self.distribute:
-            # higher order grad of BN in multi gpu will conflict with syncBN
-            # FIXME MAML with multi GPU conflict with syncBN
-            if not (
-                self.config["classifier"]["name"] in ["MAML"]
-                and self.config["n_gpu"] > 1
-            ):
-                model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
-            else:
-                print(
-                    "{} with multi GPU will conflict with syncBN".format(
-                        self.config["classifier"]["name"]
-                    ),
-                    level="warning",
-                )
-            model = model.to(self.rank)
-            model = nn.parallel.DistributedDataParallel(
+            if self.config["sync_bn"]:
+                # higher order grad of BN in multi gpu will conflict with syncBN
+                # FIXME MAML with multi GPU conflict with syncBN
+                if not (
+                    self.config["classifier"]["name"] in ["MAML"]
+                    and self.config["n_gpu"] > 1
+                ):
+                    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+                else:
+                    print(
+                        "{} with multi GPU will conflict with syncBN".format(
+                            self.config["classifier"]["name"]
+                        ),
+                        level="warning",
+                    )
+            model = model.to(self.device)
+            # find the unused parameters until the first train step tells whether there are any
+            self.detect_unused = self.config["find_unused_parameters"] is None
+            model = self._wrap_ddp(
                 model,
-                device_ids=[self.rank],
-                output_device=self.rank,
-                find_unused_parameters=True,
+                self.detect_unused or self.config["find_unused_parameters"],
+                bool(self.config["static_graph"]),
             )
 
             return model, model.module.model_type
         else:
-            model = model.to(self.rank)
+            model = model.to(self.device)
 
             return model, model.model_type
 
+    def _wrap_ddp(self, model, find_unused_parameters, static_graph):
+        """
+        Wrap the model with DistributedDataParallel.
+
+        Args:
+            model (nn.Module): The model on this rank's device.
+            find_unused_parameters (bool): Traverse the autograd graph for unused parameters at each step.
+            static_graph (bool): Use the static graph mode, requires the same used parameters at each step.
+
+        Returns:
+            nn.parallel.DistributedDataParallel: The wrapped model.
+        """
+        print(
+            "DDP with find_unused_parameters={}, static_graph={}, bucket_cap_mb={}".format(
+                find_unused_parameters, static_graph, self.config["bucket_cap_mb"]
+            )
+        )
+        return nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[self.rank] if self.device.type == "cuda" else None,
+            output_device=self.rank if self.device.type == "cuda" else None,
+            find_unused_parameters=find_unused_parameters,
+            static_graph=static_graph,
+            bucket_cap_mb=self.config["bucket_cap_mb"],
+        )
+
+    def _detect_unused_parameters(self):
+        """
+        After the first train step, check whether all parameters received gradients on all ranks.
+        If so, re-wrap the model without the unused parameter traversal, and in the static graph mode
+        unless `static_graph` is False.
+        """
+        self.detect_unused = False
+        all_used = torch.tensor(
+            float(
+                all(
+                    param.grad is not None
+                    for param in self.model.parameters()
+                    if param.requires_grad
+                )
+            ),
+            device=self.device,
+        )
+        dist.all_reduce(all_used, op=dist.ReduceOp.MIN)
+        if all_used.item() == 0:
+            print("{} has unused parameters".format(self.config["classifier"]["name"]))
+            return
+
+        static_graph = self.config["static_graph"]
+        if static_graph is None:
+            # keep no_sync of the gradient accumulation off the static graph mode
+            static_graph = self.config["accumulation_steps"] == 1
+        module = self.model.module
+        del self.model
+        self.model = self._wrap_ddp(module, False, static_graph)
+
     def _init_optim(self, config):
         """
         Init the optimizers and scheduler from config, if necessary, load the state dict from a checkpoint.
@@ -544,27 +782,326 @@ class Trainer(object):
         from_epoch = -1
         best_val_acc = float("-inf")
         best_test_acc = float("-inf")
-        if self.config["resume"]:
-            resume_path = os.path.join(
-                self.config["resume_path"], "checkpoints", "model_last.pth"
-            )
-            print(
-                "load the optimizer, lr_scheduler and epoch checkpoints dict from {}.".format(
-                    resume_path
-                )
-            )
-            all_state_dict = torch.load(resume_path, map_location="cpu")
+        if self.resume_dict is not None:
+            print("load the optimizer, lr_scheduler and epoch checkpoints dict.")
+            all_state_dict = self.resume_dict
             state_dict = all_state_dict["optimizer"]
             optimizer.load_state_dict(state_dict)
             state_dict = all_state_dict["lr_scheduler"]
             scheduler.load_state_dict(state_dict)
             from_epoch = all_state_dict["epoch"]
+            if "batch_idx" in all_state_dict:
+                # a mid-epoch state saves the epoch in progress
+                from_epoch -= 1
             best_val_acc = all_state_dict["best_val_acc"]
             best_test_acc = all_state_dict["best_val_acc"]
             print("model resume from the epoch {}".format(from_epoch))
 
         return optimizer, scheduler, from_epoch, best_val_acc, best_test_acc
 
+    def _init_resume_dict(self, config):
+        """
+        Load the checkpoint to resume from. The mid-epoch `model_resume.pth` is used if it is ahead of
+        `model_last.pth`, and the position to resume is passed to the train sampler by the config.
+
+        Args:
+            config (dict): Parsed config file.
+
+        Returns:
+            dict: The checkpoint dict, None if not resuming.
+        """
+        if not config["resume"]:
+            return None
+
+        resume_dict, resume_path = None, None
+        for name in ["model_last.pth", "model_resume.pth"]:
+            path = os.path.join(self.checkpoints_path, name)
+            if not os.path.exists(path):
+                continue
+            state_dict = torch.load(path, map_location="cpu")
+            if resume_dict is None or state_dict["epoch"] > resume_dict["epoch"]:
+                resume_dict, resume_path = state_dict, path
+        assert resume_dict is not None, "no checkpoint to resume in {}".format(
+            self.checkpoints_path
+        )
+        print("load the resume checkpoints dict from {}.".format(resume_path))
+
+        if "batch_idx" in resume_dict:
+            config["resume_position"] = (resume_dict["epoch"], resume_dict["batch_idx"])
+        else:
+            config["resume_position"] = (resume_dict["epoch"] + 1, 0)
+
+        return resume_dict
+
+    def _init_resume_state(self):
+        """
+        Restore the RNG states, the resume state of the model and the train meter of a mid-epoch checkpoint.
+
+        Returns:
+            int: The batch index to resume the epoch from.
+        """
+        if self.resume_dict is None or "batch_idx" not in self.resume_dict:
+            return 0
+
+        rng_state = self.resume_dict["rng_state"]
+        set_rng_state(rng_state[min(self.rank, len(rng_state) - 1)])
+        # the checkpoints saved before the model resume states have none
+        model_state = self.resume_dict.get("model_state", [None])
+        model_state = model_state[min(self.rank, len(model_state) - 1)]
+        if model_state is not None:
+            (self.model.module if self.distribute else self.model).set_resume_state(
+                model_state
+            )
+        self.train_meter.load_state_dict(self.resume_dict["train_meter"])
+        print(
+            "model resume from the batch {} of epoch {}".format(
+                self.resume_dict["batch_idx"], self.resume_dict["epoch"]
+            )
+        )
+
+        return self.resume_dict["batch_idx"]
+
+    def _init_preempt_handler(self, config):
+        """
+        Install the handlers of `preempt_signals`. A received signal is only recorded, the resumable
+        state is saved at the end of the running batch.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if config["preempt_signals"] is not None:
+
+            def handle_preempt_signal(signum, frame):
+                self.preempt_signal = signum
+
+            for name in config["preempt_signals"]:
+                signal.signal(getattr(signal, name), handle_preempt_signal)
+
+    def _sync_preempt_signal(self):
+        """
+        Agree on the received preempt signal across ranks, so that all ranks stop at the same batch.
+
+        Returns:
+            int: The received signal number, 0 if none.
+        """
+        if self.distribute and self.config["preempt_signals"] is not None:
+            preempt_signal = torch.tensor(self.preempt_signal, device=self.device)
+            dist.all_reduce(preempt_signal, op=dist.ReduceOp.MAX)
+            self.preempt_signal = int(preempt_signal.item())
+
+        return self.preempt_signal
+
+    def _exit_preempted(self):
+        """
+        Exit after a preempt signal, the latest resumable state has been saved.
+        """
+        print(
+            "received signal {}, exit. Resume from {}".format(
+                self.preempt_signal, self.result_path
+            ),
+            level="warning",
+        )
+        if self.writer is not None:
+            self.writer.close()
+        if self.distribute:
+            dist.barrier()
+        sys.exit(128 + self.preempt_signal)
+
+    def _init_evaluator(self, config):
+        """
+        Start the async evaluator on rank 0 if `async_eval_device` is set.
+
+        Args:
+            config (dict): Parsed config file.
+
+        Returns:
+            AsyncEvaluator: The async evaluator, None to evaluate in the train loop.
+        """
+        if config["async_eval_device"] is None or self.rank != 0:
+            return None
+
+        print("evaluate val/test asynchronously on {}".format(config["async_eval_device"]))
+        return AsyncEvaluator(
+            config, self.checkpoints_path, self.log_path, self.best_val_acc
+        )
+
+    def _close_evaluator(self):
+        """
+        Wait for the pending async evaluations and stop the evaluator, if any. The best accuracies are then
+        the ones of the `model_best.pth` it saved.
+        """
+        if self.evaluator is None:
+            return
+
+        print("============ Wait for the async evaluator ============")
+        self._collect_eval_results(block=True)
+        self.evaluator.close()
+        self.evaluator = None
+
+    def _check_head_pool(self, config):
+        """
+        Fall back to running the whole model in the val/test loop if `eval_pipeline_workers` is set but the
+        heads of the model cannot run in a pool, before any training or testing.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        if not config["eval_pipeline_workers"]:
+            return
+
+        reason = check_head_pool(
+            self.model.module if self.distribute else self.model, config
+        )
+        if reason is not None:
+            config["eval_pipeline_workers"] = 0
+            print(
+                "{}, turn eval_pipeline_workers off".format(reason),
+                level="warning",
+            )
+
+    def _init_head_pool(self):
+        """
+        Start a pool running the heads of the val/test batches if `eval_pipeline_workers` is set.
+
+        The pool is started for each val/test stage, its workers load the current weights.
+
+        Returns:
+            HeadPool: The head pool, None to run the whole model in the loop.
+        """
+        workers = self.config["eval_pipeline_workers"]
+        if not workers:
+            return None
+
+        return HeadPool(
+            self.config, self.model.module if self.distribute else self.model, workers
+        )
+
+    def _log_knn_report(self):
+        """
+        Print the recall and accuracy of the approximate descriptor indices of the model (`knn_index`)
+        against the exact search, if `knn_index_report` is set.
+
+        The report turns `eval_pipeline_workers` off, see `check_head_pool`.
+        """
+        log_knn_reports(self.model.module if self.distribute else self.model)
+
+    def _init_profiler(self, config):
+        """
+        Init the stage profiler if `profile_stages`, `profile_memory` or `profile_trace` is set.
+
+        Args:
+            config (dict): Parsed config file.
+
+        Returns:
+            StageProfiler: The profiler hooked on the model, None if profiling is off.
+        """
+        if (
+            not config["profile_stages"]
+            and not config["profile_memory"]
+            and config["profile_trace"] is None
+        ):
+            return None
+        return StageProfiler(
+            self.model.module if self.distribute else self.model,
+            self.device,
+            time_stages=config["profile_stages"],
+            # the trace is captured on rank 0
+            trace_episodes=config["profile_trace"] if self.rank == 0 else None,
+            trace_path=self.log_path,
+            track_memory=config["profile_memory"],
+        )
+
+    def _profile_stage(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name)
+
+    def _log_profiler(self):
+        """
+        Print the memory of each stage and write the stage means to tensorboard.
+        """
+        if self.profiler is None:
+            return
+        if self.profiler.track_memory:
+            print(
+                "Memory (MB, {}) {}".format(
+                    "/".join(self.profiler.memory_keys), self.profiler.memory_str()
+                )
+            )
+        if self.rank == 0:
+            self.profiler.log(self.writer)
+
+    def _should_test(self, is_best):
+        """
+        Decide whether to evaluate the test set after a validation, according to `lazy_test`.
+
+        Args:
+            is_best (bool): Whether the val acc is a new best.
+
+        Returns:
+            bool: True to evaluate the test set.
+        """
+        lazy_test = self.config["lazy_test"]
+        assert lazy_test in [None, "best", "end"], "lazy_test should be ~, best or end"
+
+        return lazy_test is None or (lazy_test == "best" and is_best)
+
+    def _test_best_model(self):
+        """
+        Evaluate the test set once with `model_best.pth`, for `lazy_test: end`.
+        """
+        if self.distribute:
+            dist.barrier()
+        best_path = os.path.join(self.checkpoints_path, "model_best.pth")
+        if not os.path.exists(best_path):
+            print("no {} to test".format(best_path), level="warning")
+            return
+
+        print("============ Testing model_best on the test set ============")
+        state_dict = torch.load(best_path, map_location="cpu")
+        (self.model.module if self.distribute else self.model).load_state_dict(
+            state_dict
+        )
+        self.best_test_acc = self._validate(self.config["epoch"], is_test=True)
+        print(
+            " * Acc@1 {:.3f} Best val acc {:.3f}".format(
+                self.best_test_acc, self.best_val_acc
+            )
+        )
+
+    def _collect_eval_results(self, block=False):
+        """
+        Collect the async evaluation results and track the best accuracies. The evaluator has already
+        saved the best model.
+
+        Args:
+            block (bool, optional): Wait for all submitted evaluations. Defaults to False.
+        """
+        for epoch_idx, val_acc, test_acc in self.evaluator.collect(block):
+            if val_acc > self.best_val_acc:
+                self.best_val_acc = val_acc
+                self.best_test_acc = test_acc
+            print(
+                "Epoch-({}): val Acc@1 {:.3f} test Acc@1 {} Best acc {:.3f}".format(
+                    epoch_idx,
+                    val_acc,
+                    "-" if test_acc is None else "{:.3f}".format(test_acc),
+                    self.best_val_acc,
+                )
+            )
+
+    def _is_train_seekable(self):
+        """
+        Check whether the train episodes can be resumed from the middle of an epoch.
+
+        Returns:
+            bool: True if the train loader is driven by a seekable sampler.
+        """
+        batch_sampler = self.train_loader[0].batch_sampler
+        # MultiEpochsDataLoader wraps the episode sampler with a _RepeatSampler
+        batch_sampler = getattr(batch_sampler, "sampler", batch_sampler)
+        return getattr(batch_sampler, "seekable", False)
+
     def _init_device(self, rank, config):
         """
         Init the devices from the config file.
@@ -580,17 +1117,79 @@ class Trainer(object):
             rank,
             config["device_ids"],
             config["n_gpu"],
-            backend="nccl"
+            backend=None
             if "dist_backend" not in self.config
             else self.config["dist_backend"],
             dist_url="tcp://127.0.0.1:" + str(config["port"])
             if "dist_url" not in self.config
             else self.config["dist_url"],
+            use_cpu=config["use_cpu"],
+        )
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        init_threads(
+            rank,
+            config["n_gpu"],
+            device,
+            config["num_threads"],
+            config["num_interop_threads"],
+            config["cpu_affinity"],
         )
-        torch.cuda.set_device(self.rank)
 
         return device, list_ids
 
+    def _init_episode_size(self, config):
+        """
+        Probe the largest episode_size (batch_size for finetuning) that fits in the memory headroom when
+        `auto_episode_size` is set, use it and record it in the run config. A resumed run keeps its sizes.
+        Probe the eval_episode_size as well when it is auto, and use episode_size when it is ~.
+
+        Args:
+            config (dict): Parsed config file.
+        """
+        stages = []
+        if config["auto_episode_size"] and not config["resume"]:
+            stages.append("train")
+        if config["eval_episode_size"] == "auto":
+            stages.append("eval")
+        report = {}
+        if len(stages) > 0:
+            print("============ Probe the episode size ============")
+            # the probe model must not shift the RNG streams of the run
+            rng_state = get_rng_state()
+            report = probe_episode_size(
+                config,
+                self.device,
+                config["probe_headroom"],
+                config["probe_max_episode_size"],
+                stages,
+            )
+            set_rng_state(rng_state)
+
+        is_written = False
+        for key in ["episode_size", "batch_size", "eval_episode_size"]:
+            if key not in report:
+                continue
+            size = torch.tensor(report[key] or 0, device=self.device)
+            if self.distribute:
+                dist.all_reduce(size, op=dist.ReduceOp.MIN)
+            if size.item() == 0:
+                print(
+                    "no {} fits in the memory headroom".format(key), level="warning"
+                )
+                continue
+            print("use {} {} (was {})".format(key, size.item(), config[key]))
+            config[key] = size.item()
+            is_written = is_written or key != "eval_episode_size"
+        if config["eval_episode_size"] in [None, "auto"]:
+            config["eval_episode_size"] = config["episode_size"]
+
+        if is_written and self.rank == 0:
+            with open(
+                os.path.join(self.result_path, "config.yaml"), "w", encoding="utf-8"
+            ) as fout:
+                fout.write(yaml.dump(config))
+
     def _save_model(self, epoch, save_type=SaveType.NORMAL):
         """
         Save the model, optimizer, scheduler and epoch.
@@ -611,7 +1210,7 @@ class Trainer(object):
             self.best_val_acc,
             self.best_test_acc,
             save_type,
-            len(self.list_ids) > 1,
+            self.distribute,
         )
 
         if save_type != SaveType.LAST:
@@ -630,7 +1229,7 @@ class Trainer(object):
                             self.best_val_acc,
                             self.best_test_acc,
                             save_type,
-                            len(self.list_ids) > 1,
+                            self.distribute,
                         )
                     else:
                         print(
@@ -640,6 +1239,44 @@ class Trainer(object):
                             level="warning",
                         )
 
+    def _save_resume_state(self, epoch, batch_idx):
+        """
+        Save a mid-epoch resumable state: the model, optimizer, scheduler, the position in the epoch,
+        the RNG states and the model resume states (`get_resume_state`) of all ranks and the train meter.
+
+        Args:
+            epoch (int): the current epoch index.
+            batch_idx (int): the number of finished batches in the epoch.
+        """
+        model = self.model.module if self.distribute else self.model
+        rng_state = [get_rng_state()]
+        model_state = [model.get_resume_state()]
+        if self.distribute:
+            rng_state = [None] * dist.get_world_size()
+            dist.all_gather_object(rng_state, get_rng_state())
+            model_state = [None] * dist.get_world_size()
+            dist.all_gather_object(model_state, model.get_resume_state())
+
+        if self.rank == 0:
+            save_model(
+                self.model,
+                self.optimizer,
+                self.scheduler,
+                self.checkpoints_path,
+                "model",
+                epoch,
+                self.best_val_acc,
+                self.best_test_acc,
+                SaveType.RESUME,
+                self.distribute,
+                extra_state={
+                    "batch_idx": batch_idx,
+                    "rng_state": rng_state,
+                    "model_state": model_state,
+                    "train_meter": self.train_meter.state_dict(),
+                },
+            )
+
     def _init_meter(self):
         """
         Init the AverageMeter of train/val/test stage to cal avg... of batch_time, data_time,calc_time ,loss and acc1.
@@ -697,6 +1334,19 @@ class Trainer(object):
             self.config["episode_size"], self.config["n_gpu"]
         )
 
+        # check: the train batch of a rank splits evenly into accumulation_steps micro-batches
+        rank_batch_size = (
+            self.config["batch_size"]
+            if self.model_type == ModelType.FINETUNING
+            else self.config["episode_size"]
+        ) // self.config["n_gpu"]
+        assert (
+            rank_batch_size % self.config["accumulation_steps"] == 0
+        ), "{} per gpu % accumulation_steps {} != 0".format(
+            "batch_size" if self.model_type == ModelType.FINETUNING else "episode_size",
+            self.config["accumulation_steps"],
+        )
+
         # check: episode_num % episode_size == 0
         assert (
             self.config["train_episode"] % self.config["episode_size"] == 0
@@ -704,10 +1354,18 @@ class Trainer(object):
             self.config["train_episode"], self.config["episode_size"]
         )
 
+        # check: the val/test episodes split evenly into eval_episode_size batches on n_gpu
+        assert (
+            self.config["eval_episode_size"] % self.config["n_gpu"] == 0
+            and self.config["eval_episode_size"] != 0
+        ), "eval_episode_size {} % n_gpu {} != 0".format(
+            self.config["eval_episode_size"], self.config["n_gpu"]
+        )
+
         assert (
-            self.config["test_episode"] % self.config["episode_size"] == 0
-        ), "test_episode {} % episode_size  {} != 0".format(
-            self.config["test_episode"], self.config["episode_size"]
+            self.config["test_episode"] % self.config["eval_episode_size"] == 0
+        ), "test_episode {} % eval_episode_size  {} != 0".format(
+            self.config["test_episode"], self.config["eval_episode_size"]
         )
 
     def _cal_time_scheduler(self, start_time, epoch_idx):
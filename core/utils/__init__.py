@@ -3,3 +3,4 @@ from .enum_type import ModelType, SaveType
 from .logger import init_logger_config
 from .utils import *
 from .visualizer import TensorboardWriter
+from .profiler import StageProfiler
@@ -13,3 +13,4 @@ class SaveType(Enum):
     NORMAL = 0
     BEST = 1
     LAST = 2
+    RESUME = 3
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+import functools
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+import torch
+import pandas as pd
+from torch.autograd.profiler import record_function
+
+from .utils import AverageMeter
+
+MODEL_METHODS = ["split_by_episode", "set_forward_adaptation"]
+TRAINER_STAGES = ["backward", "optimizer_step"]
+
+
+class StageProfiler(object):
+    """
+    Mark the stages of the hot path with profiler ranges, time them and capture a torch.profiler trace.
+
+    The backbone (`emb_func`), `split_by_episode`, the heads (the `*_layer` modules of the model) and
+    `set_forward_adaptation` are hooked on the model, the trainer marks `backward` and `optimizer_step`
+    with `stage`. Each stage is a `record_function` range, which shows in torch.profiler traces, and an
+    NVTX range on CUDA, which shows in Nsight Systems. With `time_stages`, the time of each stage in a
+    batch is measured, synchronizing CUDA at the range bounds. With `track_memory`, the peak allocated
+    and reserved CUDA memory during each stage is measured, or on CPU the RSS growth over the stage.
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        time_stages=True,
+        trace_episodes=None,
+        trace_path=None,
+        track_memory=False,
+    ):
+        """
+        Args:
+            model (nn.Module): The (unwrapped) model to hook.
+            device (torch.device): The device the model runs on.
+            time_stages (bool, optional): Measure the time of the stages. Defaults to True.
+            trace_episodes (list, optional): Capture a torch.profiler trace of the train episodes [N, M)
+                of the first epoch. Defaults to None.
+            trace_path (str, optional): The directory to export the trace to. Defaults to None.
+            track_memory (bool, optional): Measure the memory of the stages. Defaults to False.
+        """
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.time_stages = time_stages
+        self.track_memory = track_memory
+        self.memory_keys = (
+            ["peak_allocated", "peak_reserved"]
+            if self.use_cuda
+            else ["rss_delta"]
+        )
+        self.trace_episodes = trace_episodes
+        self.trace_path = trace_path
+        self.trace = None
+        self.trace_epoch = None
+
+        self.handles = []
+        self.wrapped = []
+        self.stages = self._hook(model) + TRAINER_STAGES
+        self.meters = {
+            mode: AverageMeter("{}_stage".format(mode), self.stages)
+            for mode in ["train", "val", "test"]
+        }
+        self.mode = "train"
+        self.ran = set()
+        self.batch_times = defaultdict(float)
+        # the open stages with the memory measured so far, the stages may nest
+        self.open_stages = []
+        # {stage: {memory key: bytes}} of the current batch, and the largest of the current mode
+        self.batch_memory = defaultdict(dict)
+        self.last_memory = {}
+        self.peak_memory = defaultdict(dict)
+
+    def _hook(self, model):
+        """
+        Put the ranges around the forward of the backbone and heads and the model stages.
+
+        Returns:
+            list: The names of the hooked stages.
+        """
+        stages = []
+        modules = [("emb_func", getattr(model, "emb_func", None))] + [
+            (name, module)
+            for name, module in model.named_children()
+            if name.endswith("_layer")
+        ]
+        for name, module in modules:
+            if module is None:
+                continue
+            contexts = []
+
+            def pre_hook(module, inputs, name=name, contexts=contexts):
+                context = self.stage(name)
+                context.__enter__()
+                contexts.append(context)
+
+            def hook(module, inputs, outputs, contexts=contexts):
+                contexts.pop().__exit__(None, None, None)
+
+            self.handles.append(module.register_forward_pre_hook(pre_hook))
+            self.handles.append(module.register_forward_hook(hook))
+            stages.append(name)
+
+        for name in MODEL_METHODS:
+            method = getattr(model, name, None)
+            if method is None:
+                continue
+
+            setattr(model, name, self._wrap(name, method))
+            self.wrapped.append((model, name))
+            stages.append(name)
+
+        return stages
+
+    def _wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return method(*args, **kwargs)
+
+        return wrapper
+
+    def remove(self):
+        """
+        Remove the hooks from the model.
+        """
+        for handle in self.handles:
+            handle.remove()
+        for model, name in self.wrapped:
+            delattr(model, name)
+        self.handles, self.wrapped = [], []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Mark a stage with profiler ranges and add its time to the current batch.
+        """
+        with record_function(name):
+            if self.use_cuda:
+                torch.cuda.nvtx.range_push(name)
+            start = self._now()
+            if self.track_memory:
+                self._enter_memory(name)
+            try:
+                yield
+            finally:
+                if self.track_memory:
+                    self._exit_memory()
+                self.batch_times[name] += self._now() - start
+                if self.use_cuda:
+                    torch.cuda.nvtx.range_pop()
+
+    def _now(self):
+        if self.time_stages and self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        return time()
+
+    def _enter_memory(self, name):
+        if self.use_cuda:
+            # the peak counters are reset for the new stage, hand the peak so far to the open ones
+            self._update_open_stages()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.open_stages.append({"name": name})
+        else:
+            self.open_stages.append({"name": name, "rss": _get_rss()})
+
+    def _exit_memory(self):
+        stage = self.open_stages.pop()
+        if self.use_cuda:
+            self._update_open_stages()
+            memory = {
+                "peak_allocated": max(
+                    stage.get("peak_allocated", 0),
+                    torch.cuda.max_memory_allocated(self.device),
+                ),
+                "peak_reserved": max(
+                    stage.get("peak_reserved", 0),
+                    torch.cuda.max_memory_reserved(self.device),
+                ),
+            }
+        else:
+            # the peak RSS of the process never decreases, it is not the one of the stage
+            memory = {"rss_delta": _get_rss() - stage["rss"]}
+        batch_memory = self.batch_memory[stage["name"]]
+        for key, value in memory.items():
+            batch_memory[key] = max(batch_memory.get(key, value), value)
+
+    def _update_open_stages(self):
+        allocated = torch.cuda.max_memory_allocated(self.device)
+        reserved = torch.cuda.max_memory_reserved(self.device)
+        for stage in self.open_stages:
+            stage["peak_allocated"] = max(stage.get("peak_allocated", 0), allocated)
+            stage["peak_reserved"] = max(stage.get("peak_reserved", 0), reserved)
+
+    def set_mode(self, mode):
+        """
+        Attribute the following stages to the train, val or test stage and reset its means.
+        """
+        self.mode = mode
+        self.meters[mode].reset()
+        self.ran.clear()
+        self.batch_times.clear()
+        self.batch_memory.clear()
+        self.last_memory = {}
+        self.peak_memory.clear()
+
+    def step(self):
+        """
+        Close a batch: update the means of the stages that ran in it.
+        """
+        if self.time_stages:
+            for name, value in self.batch_times.items():
+                self.meters[self.mode].update(name, value)
+                self.ran.add(name)
+        for name, memory in self.batch_memory.items():
+            peak_memory = self.peak_memory[name]
+            for key, value in memory.items():
+                peak_memory[key] = max(peak_memory.get(key, value), value)
+        self.last_memory = dict(self.batch_memory)
+        self.batch_times.clear()
+        self.batch_memory.clear()
+
+    def log(self, writer):
+        """
+        Write the mean time and the memory of the last batch of each stage of the current mode to
+        tensorboard, in MB.
+        """
+        meter = self.meters[self.mode]
+        for name in self.stages:
+            if name in self.ran:
+                writer.add_scalar("{}/{}".format(meter.name, name), meter.avg(name))
+        for name, memory in self.last_memory.items():
+            for key, value in memory.items():
+                writer.add_scalar(
+                    "{}_memory/{}_{}".format(self.mode, name, key), value / 1024**2
+                )
+
+    def means(self):
+        """
+        Returns:
+            dict: The mean time per batch of each stage that ran in the current mode.
+        """
+        meter = self.meters[self.mode]
+        return {name: float(meter.avg(name)) for name in self.stages if name in self.ran}
+
+    def memory_str(self):
+        """
+        Returns:
+            str: The memory of each stage in the last batch, in MB.
+        """
+        return " ".join(
+            "{} {}".format(
+                name,
+                "/".join(
+                    "{:.0f}".format(memory[key] / 1024**2) for key in self.memory_keys
+                ),
+            )
+            for name, memory in self.last_memory.items()
+        )
+
+    def summary(self):
+        """
+        Returns:
+            str: A table of the mean time per batch and the largest memory of each stage that ran in
+                the current mode.
+        """
+        meter = self.meters[self.mode]
+        rows = {}
+        for name in self.stages:
+            if name not in self.ran and name not in self.peak_memory:
+                continue
+            row = {}
+            if name in self.ran:
+                row["time"] = "{:.4f}".format(meter.avg(name))
+            for key in self.memory_keys:
+                if key in self.peak_memory[name]:
+                    row["{} (MB)".format(key)] = "{:.1f}".format(
+                        self.peak_memory[name][key] / 1024**2
+                    )
+            rows[name] = row
+
+        return pd.DataFrame.from_dict(rows, orient="index").fillna("-").to_string()
+
+    def trace_step(self, epoch_idx, episode):
+        """
+        Start or stop the trace before the train batch starting at `episode`.
+        """
+        if self.trace_episodes is None:
+            return
+        if self.trace_epoch is None:
+            self.trace_epoch = epoch_idx
+        if epoch_idx != self.trace_epoch:
+            return
+
+        start, end = self.trace_episodes
+        if self.trace is None and start <= episode < end:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True
+            )
+            self.trace.__enter__()
+        elif self.trace is not None and episode >= end:
+            self.stop_trace()
+
+    def stop_trace(self):
+        """
+        Stop the trace if it is running and export it as a chrome trace.
+        """
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        trace_file = os.path.join(
+            self.trace_path,
+            "trace_episode_{}-{}.json".format(*self.trace_episodes),
+        )
+        self.trace.export_chrome_trace(trace_file)
+        print(
+            self.trace.key_averages().table(
+                sort_by="{}_time_total".format("cuda" if self.use_cuda else "cpu"),
+                row_limit=20,
+            )
+        )
+        print("export the profiler trace to {}".format(trace_file))
+        self.trace = None
+        # only the first epoch is traced
+        self.trace_episodes = None
+
+
+def _get_rss():
+    """
+    Get the current resident set size of the process in bytes.
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import errno
+import glob
 import os
 import random
 from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from logging import getLogger
 
 import numpy as np
@@ -13,6 +16,7 @@ import scipy.stats
 import torch
 import torch.multiprocessing
 import torch.distributed as dist
+from torch import nn
 from torch.optim.lr_scheduler import _LRScheduler
 from core.utils import SaveType
 
@@ -70,6 +74,17 @@ class AverageMeter(object):
     def last(self, key):
         return self._data.last_value[key]
 
+    def state_dict(self):
+        return {
+            col: {key: float(value) for key, value in values.items()}
+            for col, values in self._data.to_dict().items()
+        }
+
+    def load_state_dict(self, state_dict):
+        for col, values in state_dict.items():
+            for key, value in values.items():
+                self._data.loc[key, col] = value
+
 
 def get_local_time():
     cur_time = datetime.now().strftime("%b-%d-%Y-%H-%M-%S")
@@ -146,6 +161,37 @@ def topk_(matrix, K, axis):
     return topk_data_sort, topk_index_sort
 
 
+def rotate_images(image, target, rotations=(0, 1, 2, 3)):
+    """
+    Build the batch of the rotation self-supervision from a batch of images.
+
+    The whole batch is rotated by k * 90 degrees (counterclockwise) with one rot90 for each k of
+    `rotations`, and the rotated batches are concatenated in the order of `rotations`. Leave 0 out of
+    `rotations` to skip the copy of the unrotated images when the caller has them already.
+
+    Args:
+        image (torch.Tensor): The images, [batch_size, C, H, W].
+        target (torch.Tensor): The class targets, [batch_size].
+        rotations (tuple, optional): The rotations k. Defaults to (0, 1, 2, 3).
+
+    Returns:
+        tuple: A tuple of (rotated images [len(rotations) * batch_size, C, H, W], their class targets,
+            their rotation targets k). The rotation targets are cached for each batch size and device,
+            they must not be modified in place.
+    """
+    rotations = tuple(rotations)
+    rot_image = torch.cat(
+        [torch.rot90(image, k, dims=(2, 3)) if k else image for k in rotations], dim=0
+    )
+    rot_target = _rotation_target(image.size(0), rotations, image.device)
+    return rot_image, target.repeat(len(rotations)), rot_target
+
+
+@lru_cache(maxsize=32)
+def _rotation_target(batch_size, rotations, device):
+    return torch.tensor(rotations, device=device).repeat_interleave(batch_size)
+
+
 def mean_confidence_interval(data, confidence=0.95):
     """
 
@@ -173,21 +219,27 @@ def create_dirs(dir_paths):
             os.mkdir(dir_path)
 
 
-def prepare_device(rank, device_ids, n_gpu_use, backend, dist_url):
+def prepare_device(rank, device_ids, n_gpu_use, backend, dist_url, use_cpu=False):
     """
 
-    :param n_gpu_use:
+    :param n_gpu_use: the number of processes, one per GPU (or a share of the CPU cores on CPU)
+    :param backend: the distributed backend, None for nccl on GPU and gloo on CPU
+    :param use_cpu: run on CPU even if CUDA is available
     :return:
     """
+    # before any CUDA call, which would make it ignored
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(device_ids)
+
+    use_cpu = use_cpu or not torch.cuda.is_available()
     if n_gpu_use > 1:
+        if backend is None:
+            backend = "gloo" if use_cpu else "nccl"
         dist.init_process_group(
             backend=backend, init_method=dist_url, world_size=n_gpu_use, rank=rank
         )
         dist.barrier()
 
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(device_ids)
-
-    n_gpu = torch.cuda.device_count()
+    n_gpu = 0 if use_cpu else torch.cuda.device_count()
     if n_gpu_use > 0 and n_gpu == 0:
         print("the model will be performed on CPU.")
         n_gpu_use = 0
@@ -205,6 +257,95 @@ def prepare_device(rank, device_ids, n_gpu_use, backend, dist_url):
     return device, list_ids
 
 
+def _parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            begin, end = part.split("-")
+            cpus.extend(range(int(begin), int(end) + 1))
+        elif part != "":
+            cpus.append(int(part))
+    return cpus
+
+
+def _get_allowed_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def get_rank_cpus(rank, world_size):
+    """
+    Get the cores of a process: whole NUMA nodes if there are at least as many nodes as processes, otherwise
+    an even share of the cores this process may run on.
+
+    :param rank:
+    :param world_size:
+    :return: a sorted list of core ids
+    """
+    allowed = _get_allowed_cpus()
+    nodes = []
+    node_paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(node_paths, key=lambda p: int(p.split("node")[-1].split("/")[0])):
+        with open(path) as fin:
+            cpus = [cpu for cpu in _parse_cpulist(fin.read()) if cpu in allowed]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+
+    if len(nodes) >= world_size:
+        return sorted(cpu for node in nodes[rank::world_size] for cpu in node)
+    share = max(len(allowed) // world_size, 1)
+    return allowed[rank * share : (rank + 1) * share] or allowed
+
+
+def init_threads(
+    rank, world_size, device, num_threads=None, num_interop_threads=None, cpu_affinity=False
+):
+    """
+    Set the CPU threads of a process and optionally pin it to its cores. The dataloader workers inherit
+    the affinity of the process.
+
+    :param rank:
+    :param world_size: the number of processes
+    :param device: the device of the process
+    :param num_threads: intra-op threads, None for torch's default, or for an even share of the cores in a
+        multi-process CPU run
+    :param num_interop_threads: inter-op threads, None for torch's default
+    :param cpu_affinity: pin the process to the cores of get_rank_cpus
+    :return:
+    """
+    cpus = None
+    if cpu_affinity:
+        if hasattr(os, "sched_setaffinity"):
+            cpus = get_rank_cpus(rank, world_size)
+            os.sched_setaffinity(0, cpus)
+        else:
+            print("cpu_affinity is not supported on this platform", level="warning")
+
+    if num_threads is None and device.type == "cpu" and world_size > 1:
+        num_threads = (
+            len(cpus)
+            if cpus is not None
+            else max(len(_get_allowed_cpus()) // world_size, 1)
+        )
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print("can not set num_interop_threads: {}".format(e), level="warning")
+
+    print(
+        "rank {} runs {} threads{}".format(
+            rank,
+            torch.get_num_threads(),
+            "" if cpus is None else " on cores {}".format(cpus),
+        ),
+        all_rank=True,
+    )
+
+
 def save_model(
     model,
     optimizer,
@@ -216,6 +357,7 @@ def save_model(
     best_test_acc=0,
     save_type=SaveType.LAST,
     is_parallel=False,
+    extra_state=None,
 ):
     """
 
@@ -227,6 +369,7 @@ def save_model(
     :param epoch:
     :param save_type:
     :param is_parallel:
+    :param extra_state: extra entries of a LAST/RESUME checkpoint
     :return:
     """
 
@@ -236,6 +379,8 @@ def save_model(
         save_name = os.path.join(save_path, "{}_best.pth".format(name))
     elif save_type == SaveType.LAST:
         save_name = os.path.join(save_path, "{}_last.pth".format(name))
+    elif save_type == SaveType.RESUME:
+        save_name = os.path.join(save_path, "{}_resume.pth".format(name))
 
     else:
         raise RuntimeError
@@ -251,21 +396,52 @@ def save_model(
     if save_type == SaveType.NORMAL or save_type == SaveType.BEST:
         torch.save(model_state_dict, save_name)
     else:
-        torch.save(
-            {
-                "epoch": epoch,
-                "model": model_state_dict,
-                "optimizer": optimizer.state_dict(),
-                "lr_scheduler": lr_Scheduler.state_dict(),
-                "best_val_acc": best_val_acc,
-                "best_test_acc": best_test_acc,
-            },
-            save_name,
-        )
+        state_dict = {
+            "epoch": epoch,
+            "model": model_state_dict,
+            "optimizer": optimizer.state_dict(),
+            "lr_scheduler": lr_Scheduler.state_dict(),
+            "best_val_acc": best_val_acc,
+            "best_test_acc": best_test_acc,
+        }
+        if extra_state is not None:
+            state_dict.update(extra_state)
+        # write to a temp file first, a preempted job must not leave a truncated checkpoint
+        torch.save(state_dict, save_name + ".tmp")
+        os.replace(save_name + ".tmp", save_name)
 
     return save_name
 
 
+def get_rng_state():
+    """
+    Get the states of the python, numpy, torch and cuda random number generators.
+    """
+    # keep the numpy state in builtin types, so that the checkpoint stays loadable with weights_only
+    numpy_state = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        "numpy": (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:]),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(rng_state):
+    """
+    Restore the random number generators from a `get_rng_state` dict.
+    """
+    numpy_state = rng_state["numpy"]
+    random.setstate(rng_state["python"])
+    np.random.set_state(
+        (numpy_state[0], np.array(numpy_state[1], dtype=np.uint32))
+        + tuple(numpy_state[2:])
+    )
+    torch.set_rng_state(rng_state["torch"])
+    if torch.cuda.is_available() and len(rng_state["cuda"]) > 0:
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
 def init_seed(seed=0, deterministic=False):
     """
 
@@ -327,6 +503,43 @@ class data_prefetcher:
         return [input, target]
 
 
+class FeatureFeeder(nn.Module):
+    """
+    Stands in for the backbone of a model and returns the features computed for it.
+    """
+
+    def __init__(self, feat):
+        super(FeatureFeeder, self).__init__()
+        self.feat = feat
+        self.called = False
+        # whether the method called its backbone more than once, or on part of the batch
+        self.misused = False
+
+    def forward(self, x):
+        self.misused = self.called or x.size(0) != self.feat.size(0)
+        assert (
+            not self.misused
+        ), "feeding the features needs a method calling its backbone once on the whole batch"
+        self.called = True
+        return self.feat
+
+
+@contextmanager
+def feed_features(model, feat):
+    """
+    Run the model on precomputed backbone features: its `emb_func` returns `feat` for the batch.
+
+    Yields:
+        FeatureFeeder: The backbone of the model in the context.
+    """
+    emb_func = model.emb_func
+    model.emb_func = FeatureFeeder(feat)
+    try:
+        yield model.emb_func
+    finally:
+        model.emb_func = emb_func
+
+
 # https://github.com/ildoonet/pytorch-gradual-warmup-lr/blob/master/warmup_scheduler/scheduler.py
 class GradualWarmupScheduler(_LRScheduler):
     """Gradually warm-up(increasing) learning rate in optimizer.
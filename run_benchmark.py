@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.dont_write_bytecode = True
+
+from core.benchmark import run_benchmark
+
+# ~ for all classifiers in core/model/{meta,metric,finetuning} and all backbones in config/backbones
+CLASSIFIERS = ["ProtoNet", "DN4", "RelationNet", "MAML", "Baseline"]
+BACKBONES = ["Conv64F", "resnet12"]
+SHOTS = [1, 5]
+EPISODES = 10
+DEVICE = "cpu"  # or cuda:0
+VAR_DICT = {
+    "query_num": 15,
+    "test_query": 15,
+}
+OUTPUT = "./results/benchmark.json"
+BASELINE = None  # a previous OUTPUT to compare with
+
+
+if __name__ == "__main__":
+    run_benchmark(
+        CLASSIFIERS,
+        BACKBONES,
+        SHOTS,
+        EPISODES,
+        DEVICE,
+        VAR_DICT,
+        output=OUTPUT,
+        baseline=BASELINE,
+    )
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.dont_write_bytecode = True
+
+from core.config import Config
+from core.ensemble import EnsembleTrainer
+
+CONFIG = "./config/proto.yaml"
+VAR_DICT = {
+    "device_ids": "0",
+    "n_gpu": 1,
+    "ensemble_size": 4,
+}
+
+
+if __name__ == "__main__":
+    config = Config(CONFIG, VAR_DICT).get_config_dict()
+    trainer = EnsembleTrainer(config)
+    trainer.train_loop()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.dont_write_bytecode = True
+
+from core.microbench import run_microbench
+
+# None for all heads of core.microbench.HEADS, or a list of their names, e.g. ["DN4Layer", "ProtoLayer"]
+HEADS = None
+# the values of each axis, the scaling curves vary one axis of BASE_POINT at a time
+GRID = {
+    "episode_size": [1, 2, 4, 8],
+    "way": [5, 10, 20],
+    "shot": [1, 5, 10, 20],
+    "query": [5, 15, 30],
+    "channels": [64, 160, 320, 640],
+    "spatial": [3, 5, 10],
+}
+BASE_POINT = {
+    "episode_size": 1,
+    "way": 5,
+    "shot": 5,
+    "query": 15,
+    "channels": 64,
+    "spatial": 5,
+}
+DEVICE = "cpu"  # or cuda:0
+STEPS = 10
+BACKWARD = False  # time forward + backward
+OUTPUT = "./results/microbench.json"
+
+
+if __name__ == "__main__":
+    run_microbench(
+        HEADS,
+        GRID,
+        BASE_POINT,
+        DEVICE,
+        STEPS,
+        BACKWARD,
+        output=OUTPUT,
+    )
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.dont_write_bytecode = True
+
+import torch
+from core.config import Config
+from core.probe import probe_episode_size
+from core.utils import prepare_device
+
+CONFIG = "./config/proto.yaml"
+VAR_DICT = {
+    "device_ids": "0",
+    "n_gpu": 1,
+}
+HEADROOM = 0.8
+MAX_EPISODE_SIZE = 64
+
+
+if __name__ == "__main__":
+    config = Config(CONFIG, VAR_DICT).get_config_dict()
+    # probe a single device, the reported sizes are scaled by n_gpu
+    device, _ = prepare_device(0, config["device_ids"], 1, None, None)
+    report = probe_episode_size(config, device, HEADROOM, MAX_EPISODE_SIZE)
+
+    print(
+        "{} capacity: {:.1f} MB, headroom: {}".format(
+            report["memory"], report["capacity"] / 1024**2, HEADROOM
+        )
+    )
+    for key in ["episode_size", "batch_size", "eval_episode_size"]:
+        if key in report:
+            print("largest {} that fits: {}".format(key, report[key]))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.dont_write_bytecode = True
+
+from core.sweep import expand_sweep, run_sweep
+
+CONFIGS = [
+    "./config/proto.yaml",
+    "./config/dn4.yaml",
+]
+GRID = {
+    "shot_num": [1, 5],
+}
+# device_ids of each concurrent run, "2,3" for a run on two GPUs, "cpu" for a run on CPU
+SLOTS = ["0", "1"]
+SHARED_CACHE = "./results/cache"
+RESULT_FILE = "./results/sweep.csv"
+
+
+if __name__ == "__main__":
+    experiments = expand_sweep(CONFIGS, GRID)
+    run_sweep(experiments, SLOTS, SHARED_CACHE, RESULT_FILE)